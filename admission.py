@@ -0,0 +1,109 @@
+import threading
+import time
+
+import metrics
+
+
+def parse_limits(text):
+    # "proxy=2:0,image=2:2" -> {"proxy": (2, 0), "image": (2, 2)}; concurrency:queue per route class
+    limits = {}
+    for item in text.split(','):
+        name, _, value = item.partition('=')
+        if not name.strip() or not value:
+            continue
+        concurrency, _, queue = value.partition(':')
+        limits[name.strip()] = (int(concurrency), int(queue or 0))
+    return limits
+
+
+class RouteClass:
+    def __init__(self, name, concurrency, queue=0, wait=0.0, pool='shared'):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.wait = wait
+        # Worker threads this class draws from; classes in the same pool share its capacity
+        self.pool = pool
+        self.running = 0
+        self.waiting = 0
+
+
+class Ticket:
+    def __init__(self, admission, route_class):
+        self.admission = admission
+        self.route_class = route_class
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.admission._release(self.route_class)
+        metrics.ADMISSION_INFLIGHT.dec(self.route_class.name)
+
+
+# Per-route-class concurrency limits with bounded wait queues. Each class also runs within a
+# thread pool (e.g. 'shared' for proxy/image/user, 'reserved' for webhooks and health checks).
+# A queued request still holds a worker thread, so a pool's size bounds running plus waiting
+# requests, and a flood in one pool never takes the threads set aside for another.
+class Admission:
+    def __init__(self, classes, pools):
+        self.classes = {c.name: c for c in classes}
+        self.pools = dict(pools)
+        # Requests holding a thread in each pool, running or waiting
+        self._in_use = {name: 0 for name in self.pools}
+        self._cond = threading.Condition()
+
+    def admit(self, name):
+        # A ticket to release once the response has been sent, or None when the request should get a 503
+        route_class = self.classes[name]
+        result = 'admitted'
+        with self._cond:
+            if self._in_use[route_class.pool] >= self.pools[route_class.pool]:
+                result = None
+            elif route_class.running >= route_class.concurrency:
+                result = self._wait(route_class)
+            if result is not None:
+                route_class.running += 1
+                self._in_use[route_class.pool] += 1
+        if result is None:
+            metrics.ADMISSION_REQUESTS.inc(name, 'rejected')
+            return None
+        metrics.ADMISSION_REQUESTS.inc(name, result)
+        metrics.ADMISSION_INFLIGHT.inc(name)
+        return Ticket(self, route_class)
+
+    def _wait(self, route_class):
+        # Called with the condition held and room in the pool; the waiter takes its pool slot now.
+        # A class with queue=0 is refused at once.
+        if route_class.waiting >= route_class.queue:
+            return None
+        route_class.waiting += 1
+        self._in_use[route_class.pool] += 1
+        deadline = time.monotonic() + route_class.wait
+        try:
+            while route_class.running >= route_class.concurrency:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+        finally:
+            route_class.waiting -= 1
+            self._in_use[route_class.pool] -= 1
+        return 'queued'
+
+    def _release(self, route_class):
+        with self._cond:
+            route_class.running -= 1
+            self._in_use[route_class.pool] -= 1
+            # Waiters of every class share the condition, so wake them all to re-check their own limit
+            self._cond.notify_all()
+
+    def status(self):
+        with self._cond:
+            return {
+                "pools": {name: {"in_use": self._in_use[name], "size": size} for name, size in self.pools.items()},
+                "classes": {name: {"running": c.running, "waiting": c.waiting, "concurrency": c.concurrency,
+                                   "queue": c.queue, "pool": c.pool}
+                            for name, c in self.classes.items()},
+            }
@@ -1,4 +1,5 @@
 import os
+import atexit
 import time
 import json
 import hmac
@@ -6,21 +7,121 @@ import hashlib
 import asyncio
 import threading
 import logging
+import re
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, send_from_directory, render_template
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import aiohttp
-
-logging.basicConfig(level=logging.INFO)
+from urllib.parse import quote
+from flask import Flask, Response, g, request, jsonify, render_template, send_from_directory
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import history_archive
+import logs
+import metrics
+import recommend
+import services
+import trending
+import tracing
+import updates
+from admission import Admission, RouteClass, parse_limits
+from broadcast import BroadcastWorker
+from cache import LRUCache
+from cdn import CdnRanker
+from db import DATABASE_URL, execute_prepared, get_db, get_read_db, note_write, prepare, replica_status, reset_pools
+from services import TELEGRAM_API_BASE, ReferralError, get_admin_id, is_admin, send_telegram_notification, telegram_api
+
+logs.configure()
 logger = logging.getLogger(__name__)
+# High-volume lines get their own loggers so LOG_SAMPLE can thin them out
+webhook_logger = logging.getLogger('app.webhook')
+payment_logger = logging.getLogger('app.saweria')
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dramabox-secret-key-2026')
 
-DATABASE_URL = os.environ.get('DATABASE_URL')
-API_BASE = 'https://api.sansekai.my.id/api/dramabox'
+if orjson is not None:
+    from flask.json.provider import DefaultJSONProvider
+
+    class OrjsonProvider(DefaultJSONProvider):
+        # Datetimes go through DefaultJSONProvider.default so responses keep Flask's date format
+        options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            body = orjson.dumps(obj, default=self.default, option=self.options | orjson.OPT_APPEND_NEWLINE)
+            return self._app.response_class(body, mimetype=self.mimetype)
+
+    app.json = OrjsonProvider(app)
+
+API_BASE = os.environ.get('DRAMABOX_API_BASE', 'https://api.sansekai.my.id/api/dramabox').rstrip('/')
 SAWERIA_STREAM_KEY = os.environ.get('SAWERIA_STREAM_KEY', '')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 1000))
+EXPIRY_SWEEP_INTERVAL = int(os.environ.get('EXPIRY_SWEEP_INTERVAL', 300))
+EXPIRY_REMINDER_HOURS = int(os.environ.get('EXPIRY_REMINDER_HOURS', 24))
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 25))
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', 8))
+IMGPROXY_CACHE_BYTES = int(os.environ.get('IMGPROXY_CACHE_BYTES', 32 * 1024 * 1024))
+CDN_PROBE_INTERVAL = int(os.environ.get('CDN_PROBE_INTERVAL', 300))
+RECOMMENDATION_INTERVAL = int(os.environ.get('RECOMMENDATION_INTERVAL', 3600))
+TRENDING_CACHE_SECONDS = int(os.environ.get('TRENDING_CACHE_SECONDS', 60))
+TRENDING_FLUSH_SECONDS = max(1, int(os.environ.get('TRENDING_FLUSH_SECONDS', 5)))
+PROXY_CHUNK_BYTES = 64 * 1024
+HOME_SNAPSHOT_SECONDS = int(os.environ.get('HOME_SNAPSHOT_SECONDS', 300))
+HOME_PRELOAD_COVERS = 6
+WEBHOOK_MAX_CONNECTIONS = min(100, int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 80)))
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', 32))
+UPDATE_MAX_PENDING = int(os.environ.get('UPDATE_MAX_PENDING', 1000))
+UPDATE_DRAIN_SECONDS = float(os.environ.get('UPDATE_DRAIN_SECONDS', 20))
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 4))
+RESERVED_THREADS = int(os.environ.get('RESERVED_THREADS', 1))
+ADMISSION_LIMITS = parse_limits(os.environ.get('ADMISSION_LIMITS', ''))
+WATCH_HISTORY_RETENTION_MONTHS = int(os.environ.get('WATCH_HISTORY_RETENTION_MONTHS', 12))
+WATCH_HISTORY_ARCHIVE_DIR = os.environ.get('WATCH_HISTORY_ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+
+def _asset_version():
+    digest = hashlib.sha256()
+    for name in ('js/app.js', 'css/style.css', 'js/sw.js'):
+        with open(os.path.join(app.static_folder, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+ASSET_VERSION = _asset_version()
+
+_image_cache = LRUCache(IMGPROXY_CACHE_BYTES, ttl=86400)
+cdn_ranker = CdnRanker(probe_interval=CDN_PROBE_INTERVAL)
+local_trending = trending.Trending(get_read_db, cache_ttl=TRENDING_CACHE_SECONDS, write_db=get_db)
+_process_start = time.monotonic()
+
+def _route_class(name, concurrency, queue=0, wait=0.0, pool='shared'):
+    concurrency, queue = ADMISSION_LIMITS.get(name, (concurrency, queue))
+    return RouteClass(name, concurrency, queue, wait, pool)
+
+# Upstream proxy overflow is refused at once; image and user requests wait briefly for a thread.
+# Payment/webhook and health run only on the RESERVED_THREADS kept out of the shared pool.
+admission = Admission([
+    _route_class('proxy', 2),
+    _route_class('image', 2, queue=2, wait=1.0),
+    _route_class('user', 3, queue=3, wait=2.0),
+    _route_class('webhook', RESERVED_THREADS, queue=16, wait=5.0, pool='reserved'),
+    _route_class('health', RESERVED_THREADS, queue=4, wait=5.0, pool='reserved'),
+], pools={'shared': max(1, WEB_THREADS - RESERVED_THREADS), 'reserved': max(1, RESERVED_THREADS)})
+_ready = {"db": False, "bot": False}
+
+def _mark_ready(component):
+    if not _ready[component]:
+        _ready[component] = True
+        logger.info(f"{component} ready {time.monotonic() - _process_start:.2f}s after start")
+
 def get_webapp_domain():
     webapp_url = os.environ.get('WEBAPP_URL', '')
     if webapp_url:
@@ -35,16 +136,104 @@ def get_webapp_domain():
 
 WEBAPP_DOMAIN = get_webapp_domain()
 
-def get_admin_id():
-    admin_id = os.environ.get('TELEGRAM_ADMIN_ID', '')
-    try:
-        return int(admin_id) if admin_id else None
-    except:
-        return None
-
-def get_db():
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    return conn
+SCHEMA_STATEMENTS = (
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        telegram_id BIGINT UNIQUE NOT NULL,
+        username VARCHAR(255),
+        first_name VARCHAR(255),
+        last_name VARCHAR(255),
+        avatar_url TEXT,
+        membership VARCHAR(50) DEFAULT 'Free',
+        membership_expires_at TIMESTAMP,
+        points INTEGER DEFAULT 0,
+        commission INTEGER DEFAULT 0,
+        referral_count INTEGER DEFAULT 0,
+        referred_by BIGINT,
+        language VARCHAR(10) DEFAULT 'id',
+        notifications_enabled BOOLEAN DEFAULT TRUE,
+        referral_access_expires_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        id SERIAL PRIMARY KEY,
+        telegram_id BIGINT NOT NULL,
+        saweria_transaction_id VARCHAR(255) UNIQUE,
+        plan_type VARCHAR(100),
+        amount INTEGER,
+        donator_name VARCHAR(255),
+        donator_email VARCHAR(255),
+        status VARCHAR(50) DEFAULT 'active',
+        activated_at TIMESTAMP,
+        expires_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS favorites (
+        id SERIAL PRIMARY KEY,
+        telegram_id BIGINT NOT NULL,
+        book_id VARCHAR(255) NOT NULL,
+        title VARCHAR(500),
+        cover_url TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(telegram_id, book_id)
+    );
+    CREATE TABLE IF NOT EXISTS reports (
+        id SERIAL PRIMARY KEY,
+        telegram_id BIGINT NOT NULL,
+        issue_type VARCHAR(255),
+        description TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS referral_logs (
+        id SERIAL PRIMARY KEY,
+        referrer_id BIGINT NOT NULL,
+        referred_id BIGINT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(referrer_id, referred_id)
+    );
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id SERIAL PRIMARY KEY,
+        text TEXT NOT NULL,
+        language VARCHAR(10),
+        status VARCHAR(20) DEFAULT 'pending',
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        last_telegram_id BIGINT DEFAULT 0,
+        created_by BIGINT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS app_state (
+        key VARCHAR(100) PRIMARY KEY,
+        value TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+    """
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_access_expires_at TIMESTAMP;
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS expiry_reminded_for TIMESTAMP;
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS entitlement_version INTEGER NOT NULL DEFAULT 0;
+    UPDATE users SET avatar_url = '/api/avatar/' || telegram_id WHERE avatar_url LIKE '%/file/bot%';
+    CREATE INDEX IF NOT EXISTS idx_users_vip_expiry ON users (membership_expires_at) WHERE membership = 'VIP';
+    CREATE INDEX IF NOT EXISTS idx_users_referral_expiry ON users (referral_access_expires_at) WHERE referral_access_expires_at IS NOT NULL;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_recommendations (
+        telegram_id BIGINT PRIMARY KEY,
+        items JSONB NOT NULL,
+        computed_at TIMESTAMP NOT NULL
+    );
+    """,
+    history_archive.SCHEMA_SQL,
+    trending.SCHEMA_SQL,
+)
+SCHEMA_VERSION = hashlib.sha256(''.join(SCHEMA_STATEMENTS).encode()).hexdigest()[:16]
 
 def init_db():
     if not DATABASE_URL:
@@ -53,79 +242,17 @@ def init_db():
     conn = get_db()
     cur = conn.cursor()
     try:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT UNIQUE NOT NULL,
-                username VARCHAR(255),
-                first_name VARCHAR(255),
-                last_name VARCHAR(255),
-                avatar_url TEXT,
-                membership VARCHAR(50) DEFAULT 'Free',
-                membership_expires_at TIMESTAMP,
-                points INTEGER DEFAULT 0,
-                commission INTEGER DEFAULT 0,
-                referral_count INTEGER DEFAULT 0,
-                referred_by BIGINT,
-                language VARCHAR(10) DEFAULT 'id',
-                notifications_enabled BOOLEAN DEFAULT TRUE,
-                referral_access_expires_at TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT NOT NULL,
-                saweria_transaction_id VARCHAR(255) UNIQUE,
-                plan_type VARCHAR(100),
-                amount INTEGER,
-                donator_name VARCHAR(255),
-                donator_email VARCHAR(255),
-                status VARCHAR(50) DEFAULT 'active',
-                activated_at TIMESTAMP,
-                expires_at TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            CREATE TABLE IF NOT EXISTS favorites (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT NOT NULL,
-                book_id VARCHAR(255) NOT NULL,
-                title VARCHAR(500),
-                cover_url TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(telegram_id, book_id)
-            );
-            CREATE TABLE IF NOT EXISTS watch_history (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT NOT NULL,
-                book_id VARCHAR(255) NOT NULL,
-                title VARCHAR(500),
-                cover_url TEXT,
-                episode_number VARCHAR(100),
-                watched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(telegram_id, book_id)
-            );
-            CREATE TABLE IF NOT EXISTS reports (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT NOT NULL,
-                issue_type VARCHAR(255),
-                description TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            CREATE TABLE IF NOT EXISTS referral_logs (
-                id SERIAL PRIMARY KEY,
-                referrer_id BIGINT NOT NULL,
-                referred_id BIGINT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(referrer_id, referred_id)
-            );
-        """)
-        try:
-            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_access_expires_at TIMESTAMP")
-        except:
-            pass
+        if services.get_app_state('schema_version', cur) == SCHEMA_VERSION:
+            logger.info(f"Database schema {SCHEMA_VERSION} already applied, skipping DDL.")
+            _mark_ready('db')
+            return
+        for statement in SCHEMA_STATEMENTS:
+            cur.execute(statement)
+        services.set_app_state('schema_version', SCHEMA_VERSION, cur)
         conn.commit()
-        logger.info("Database tables initialized successfully.")
+        reset_pools()
+        logger.info(f"Database tables initialized successfully (schema {SCHEMA_VERSION}).")
+        _mark_ready('db')
     except Exception as e:
         conn.rollback()
         logger.error(f"Database init error: {e}")
@@ -133,64 +260,277 @@ def init_db():
         cur.close()
         conn.close()
 
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+    request_id = request.headers.get('X-Request-ID', '')[:64] or tracing.new_request_id()
+    g.trace = tracing.start(request_id, request.method, request.path)
+
+def _request_class(path):
+    # None for the app shell and static files: served from disk or memory, never worth refusing
+    if path in ('/', '/sw.js', '/favicon.ico') or path.startswith('/static/'):
+        return None
+    if path.startswith('/api/proxy/'):
+        return 'proxy'
+    if path.startswith(('/api/imgproxy', '/api/avatar/', '/api/user/photo/')):
+        return 'image'
+    if path == WEBHOOK_PATH or path.startswith('/webhook/'):
+        return 'webhook'
+    if path in ('/health', '/ping', '/ready', '/metrics'):
+        return 'health'
+    return 'user'
+
+@app.before_request
+def _admit_request():
+    route_class = _request_class(request.path)
+    if request.method == 'OPTIONS' or route_class is None:
+        return None
+    g.admission = admission.admit(route_class)
+    if g.admission is None:
+        return jsonify({"error": "Server busy, try again"}), 503, {'Retry-After': '1'}
+
+@app.after_request
+def _release_admission_on_close(response):
+    # Streamed bodies (proxy passthrough) are sent after the request context ends, so they keep their
+    # slot until the server closes them; everything else is released in teardown_request
+    if response.is_streamed:
+        ticket = g.pop('admission', None)
+        if ticket is not None:
+            response.call_on_close(ticket.release)
+    return response
+
+@app.after_request
+def _record_request_metrics(response):
+    start = g.get('request_start')
+    if start is not None:
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_LATENCY.observe(elapsed, request.method, route)
+        metrics.HTTP_REQUESTS.inc(request.method, route, response.status_code)
+        trace = g.get('trace')
+        if trace is not None:
+            response.headers['X-Request-ID'] = trace.request_id
+            if elapsed * 1000 >= SLOW_REQUEST_MS:
+                slow = trace.to_dict(status=response.status_code, total=elapsed)
+                tracing.slow_traces.append(slow)
+                logger.warning(f"Slow request {request.method} {request.path} {slow['total_ms']}ms breakdown={slow['breakdown_ms']} other={slow['other_ms']}ms")
+    return response
+
+@app.teardown_request
+def _end_request_trace(exc):
+    ticket = g.pop('admission', None)
+    if ticket is not None:
+        ticket.release()
+    tracing.finish()
+
 @app.after_request
 def add_headers(response):
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
+    if request.path.startswith('/static/') and request.args.get('v') == ASSET_VERSION and response.status_code == 200:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    elif not response.headers.get('Cache-Control', '').startswith('public'):
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
     return response
 
+_home_snapshot = {"items": None, "fetched_at": 0.0, "refreshing": False}
+_home_lock = threading.Lock()
+
+def _book_list(data):
+    for key in ('data', 'result'):
+        if isinstance(data, dict) and key in data:
+            data = data[key]
+            break
+    if isinstance(data, dict):
+        data = data.get('bookList') or data.get('list') or []
+    return data if isinstance(data, list) else []
+
+def _refresh_home_snapshot():
+    try:
+        resp = _upstream_get('foryou', {"page": 1})
+        items = []
+        if resp.status_code == 200:
+            # The whole page: the client continues from page 2, so anything cut here would never be shown
+            for item in _book_list(app.json.loads(resp.content)):
+                book_id = item.get('bookId') or item.get('id') or item.get('book_id')
+                if book_id:
+                    items.append({
+                        "bookId": book_id,
+                        "bookName": item.get('bookName') or item.get('name') or item.get('title'),
+                        "coverWap": item.get('coverWap') or item.get('cover') or item.get('coverUrl') or item.get('image'),
+                    })
+        if items:
+            with _home_lock:
+                _home_snapshot.update(items=items, fetched_at=time.monotonic())
+    except Exception as e:
+        logger.warning(f"Home snapshot refresh failed: {e}")
+    finally:
+        with _home_lock:
+            _home_snapshot["refreshing"] = False
+
+def home_snapshot():
+    # First page of the default "Untukmu" tab, refreshed in the background; a stale copy (up to
+    # 12x the refresh interval) is still served so the page never waits on upstream
+    with _home_lock:
+        items = _home_snapshot["items"]
+        age = time.monotonic() - _home_snapshot["fetched_at"]
+        if (items is None or age > HOME_SNAPSHOT_SECONDS) and not _home_snapshot["refreshing"]:
+            _home_snapshot["refreshing"] = True
+            threading.Thread(target=_refresh_home_snapshot, name='home-snapshot', daemon=True).start()
+    if items is None or age > HOME_SNAPSHOT_SECONDS * 12:
+        return None
+    return items
+
+def _imgproxy_url(url):
+    # Same string static/js/app.js imgProxy() builds, so preloads are reused by the cards
+    return '/api/imgproxy?url=' + quote(url, safe="-_.!~*'()")
+
 @app.route('/')
 def index():
-    return render_template('index.html', cache_bust=int(time.time()))
+    items = home_snapshot()
+    covers = [_imgproxy_url(item['coverWap']) for item in (items or []) if item['coverWap']][:HOME_PRELOAD_COVERS]
+    return render_template('index.html', cache_bust=ASSET_VERSION, initial_home=items, preload_covers=covers)
+
+@app.route('/sw.js')
+def service_worker():
+    # Served from the root so its scope covers the whole app; always revalidated so updates apply
+    return send_from_directory(os.path.join(app.static_folder, 'js'), 'sw.js', mimetype='application/javascript', max_age=0)
+
+def _upstream_label(endpoint):
+    return endpoint if re.fullmatch(r'[A-Za-z0-9_-]{1,32}', endpoint) else 'other'
+
+def _upstream_get(endpoint, params, stream=False):
+    label = _upstream_label(endpoint)
+    start = time.perf_counter()
+    try:
+        resp = requests.get(f"{API_BASE}/{endpoint}", params=params, timeout=15, stream=stream)
+    except Exception:
+        metrics.UPSTREAM_REQUESTS.inc(label, 'error')
+        raise
+    elapsed = time.perf_counter() - start
+    metrics.UPSTREAM_LATENCY.observe(elapsed, label)
+    tracing.record(f"upstream.{label}", start, elapsed)
+    metrics.UPSTREAM_REQUESTS.inc(label, resp.status_code)
+    return resp
+
+def _passthrough(resp):
+    chunks = resp.iter_content(PROXY_CHUNK_BYTES)
+    first = next(chunks, b'')
+    content_type = resp.headers.get('Content-Type', '')
+    if 'json' not in content_type or first.lstrip()[:1] not in (b'{', b'['):
+        resp.close()
+        logger.error(f"Upstream returned non-JSON body ({resp.status_code}, {content_type!r})")
+        return jsonify({"error": "invalid upstream response"}), 502
+
+    def body():
+        try:
+            yield first
+            yield from chunks
+        finally:
+            resp.close()
+
+    return Response(body(), status=resp.status_code, content_type=content_type)
 
 @app.route('/api/proxy/<path:endpoint>')
 def proxy_api(endpoint):
-    import requests as req
     params = dict(request.args)
-    url = f"{API_BASE}/{endpoint}"
+    bandwidth_kbps = params.pop('bw', None)
     try:
-        resp = req.get(url, params=params, timeout=15)
-        return jsonify(resp.json()), resp.status_code
+        if endpoint != 'allepisode':
+            return _passthrough(_upstream_get(endpoint, params, stream=True))
+        resp = _upstream_get(endpoint, params)
+        data = app.json.loads(resp.content)
+        if resp.status_code == 200:
+            try:
+                bandwidth_kbps = int(bandwidth_kbps) if bandwidth_kbps else None
+            except ValueError:
+                bandwidth_kbps = None
+            data = cdn_ranker.rank(data, bandwidth_kbps)
+        return jsonify(data), resp.status_code
     except Exception as e:
         logger.error(f"API proxy error: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/foryou/<int:telegram_id>')
+def personal_foryou(telegram_id):
+    page = request.args.get('page', 1, type=int)
+    items = []
+    if DATABASE_URL:
+        try:
+            items = recommend.get_recommendations(telegram_id)
+        except Exception as e:
+            logger.error(f"Recommendation lookup error: {e}")
+    # A handful of picks would end the infinite scroll, so those users page through upstream like cold ones
+    personalised = len(items) >= 5
+    if personalised and page == 1:
+        return jsonify({"data": items, "source": "personal"})
+    if request.args.get('personal_only'):
+        return jsonify({"data": [], "source": "none"})
+    upstream_page = page - 1 if personalised else page
+    try:
+        return _passthrough(_upstream_get('foryou', {"page": upstream_page}, stream=True))
+    except Exception as e:
+        logger.error(f"For You fallback error: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/imgproxy')
 def image_proxy():
-    import requests as req
     url = request.args.get('url', '')
     if not url:
         return '', 400
+    cached = _image_cache.get(url)
+    if cached is not None:
+        metrics.CACHE_LOOKUPS.inc('imgproxy', 'hit')
+        content, content_type = cached
+        metrics.IMGPROXY_BYTES.inc('cache', amount=len(content))
+        return _image_response(content, content_type)
+    metrics.CACHE_LOOKUPS.inc('imgproxy', 'miss')
     try:
-        resp = req.get(url, timeout=10, headers={
-            'Referer': '',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        })
+        with tracing.span('upstream.imgproxy'):
+            resp = requests.get(url, timeout=10, headers={
+                'Referer': '',
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            })
         if resp.status_code == 200:
             content_type = resp.headers.get('Content-Type', 'image/jpeg')
-            from flask import Response
-            return Response(resp.content, content_type=content_type, headers={
-                'Cache-Control': 'public, max-age=86400',
-                'Access-Control-Allow-Origin': '*'
-            })
+            content = resp.content
+            _image_cache.set(url, (content, content_type), len(content))
+            metrics.IMGPROXY_BYTES.inc('origin', amount=len(content))
+            return _image_response(content, content_type)
         return '', resp.status_code
     except Exception:
         return '', 502
 
+def _image_response(content, content_type):
+    return Response(content, content_type=content_type, headers={
+        'Cache-Control': 'public, max-age=86400',
+        'Access-Control-Allow-Origin': '*'
+    })
+
+USER_BY_ID = prepare('user_by_id', ('bigint',), "SELECT * FROM users WHERE telegram_id = $1")
+USER_ACCESS = prepare('user_access', ('bigint',), """
+    SELECT telegram_id, membership, membership_expires_at, referral_access_expires_at, entitlement_version
+    FROM users WHERE telegram_id = $1
+""")
+FAVORITE_ADD = prepare('favorite_add', ('bigint', 'varchar', 'varchar', 'text'), """
+    INSERT INTO favorites (telegram_id, book_id, title, cover_url)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (telegram_id, book_id) DO NOTHING
+""")
+
 @app.route('/api/user', methods=['GET', 'POST'])
 def upsert_user():
     if request.method == 'GET':
         telegram_id = request.args.get('telegram_id')
         if not telegram_id:
             return jsonify({"error": "telegram_id required"}), 400
-        conn = get_db()
+        conn = get_read_db(telegram_id)
         cur = conn.cursor()
         try:
-            cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
+            execute_prepared(cur, USER_BY_ID, (telegram_id,))
             user = cur.fetchone()
             if user:
                 user_dict = dict(user)
@@ -207,39 +547,56 @@ def upsert_user():
     if not telegram_id:
         return jsonify({"error": "telegram_id required"}), 400
 
-    conn = get_db()
-    cur = conn.cursor()
     try:
-        cur.execute("""
-            INSERT INTO users (telegram_id, username, first_name, last_name, avatar_url)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (telegram_id) DO UPDATE SET
-                username = EXCLUDED.username,
-                first_name = EXCLUDED.first_name,
-                last_name = EXCLUDED.last_name,
-                avatar_url = EXCLUDED.avatar_url
-            RETURNING *
-        """, (telegram_id, data.get('username'), data.get('first_name'), data.get('last_name'), data.get('avatar_url')))
-        user = cur.fetchone()
-        conn.commit()
-        user_dict = dict(user)
-        admin_id = get_admin_id()
-        user_dict['is_admin'] = (admin_id is not None and int(telegram_id) == admin_id)
-        return jsonify(user_dict)
+        return jsonify(services.upsert_user(telegram_id, data.get('username'), data.get('first_name'),
+                                            data.get('last_name'), data.get('avatar_url')))
     except Exception as e:
-        conn.rollback()
         logger.error(f"User upsert error: {e}")
         return jsonify({"error": str(e)}), 500
-    finally:
-        cur.close()
-        conn.close()
+
+@app.route('/api/bootstrap', methods=['POST'])
+def bootstrap():
+    # Everything the WebApp needs at startup from the single upsert round trip
+    data = request.json or {}
+    telegram_id = data.get('telegram_id')
+    if not telegram_id:
+        return jsonify({"error": "telegram_id required"}), 400
+
+    try:
+        user = services.upsert_user(telegram_id, data.get('username'), data.get('first_name'),
+                                    data.get('last_name'), data.get('avatar_url'))
+    except Exception as e:
+        logger.error(f"Bootstrap upsert error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    referral_result = None
+    if data.get('ref_code'):
+        try:
+            referral_result = services.credit_referral(telegram_id, data['ref_code'])
+        except ReferralError as e:
+            referral_result = {"error": str(e)}
+        except Exception as e:
+            logger.error(f"Bootstrap referral error: {e}")
+            referral_result = {"error": str(e)}
+
+    now = datetime.now()
+    user['has_referral_access'] = bool(user.get('referral_access_expires_at') and user['referral_access_expires_at'] > now)
+    return jsonify({
+        "user": user,
+        "subscription": services.entitlement(user, now),
+        "entitlement": services.entitlement_token(user, now),
+        "referral": services.referral_summary(user, now),
+        "settings": {k: user[k] for k in ('language', 'notifications_enabled', 'membership')},
+        "bot_username": services.bot_username(),
+        "referral_result": referral_result,
+    })
 
 @app.route('/api/user/<int:telegram_id>')
 def get_user(telegram_id):
-    conn = get_db()
+    conn = get_read_db(telegram_id)
     cur = conn.cursor()
     try:
-        cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
+        execute_prepared(cur, USER_BY_ID, (telegram_id,))
         user = cur.fetchone()
         if user:
             user_dict = dict(user)
@@ -262,13 +619,9 @@ def add_favorite():
     conn = get_db()
     cur = conn.cursor()
     try:
-        cur.execute("""
-            INSERT INTO favorites (telegram_id, book_id, title, cover_url)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (telegram_id, book_id) DO NOTHING
-            RETURNING *
-        """, (data['telegram_id'], data['book_id'], data.get('title'), data.get('cover_url')))
+        execute_prepared(cur, FAVORITE_ADD, (data['telegram_id'], data['book_id'], data.get('title'), data.get('cover_url')))
         conn.commit()
+        note_write(data['telegram_id'])
         return jsonify({"status": "ok"})
     except Exception as e:
         conn.rollback()
@@ -279,7 +632,7 @@ def add_favorite():
 
 @app.route('/api/favorites/<int:telegram_id>')
 def get_favorites(telegram_id):
-    conn = get_db()
+    conn = get_read_db(telegram_id)
     cur = conn.cursor()
     try:
         cur.execute("SELECT * FROM favorites WHERE telegram_id = %s ORDER BY created_at DESC", (telegram_id,))
@@ -297,6 +650,7 @@ def remove_favorite():
         cur.execute("DELETE FROM favorites WHERE telegram_id = %s AND book_id = %s",
                      (data['telegram_id'], data['book_id']))
         conn.commit()
+        note_write(data['telegram_id'])
         return jsonify({"status": "ok"})
     except Exception as e:
         conn.rollback()
@@ -311,15 +665,11 @@ def add_history():
     conn = get_db()
     cur = conn.cursor()
     try:
-        cur.execute("""
-            INSERT INTO watch_history (telegram_id, book_id, title, cover_url, episode_number)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (telegram_id, book_id) DO UPDATE SET
-                episode_number = EXCLUDED.episode_number,
-                watched_at = CURRENT_TIMESTAMP
-            RETURNING *
-        """, (data['telegram_id'], data['book_id'], data.get('title'), data.get('cover_url'), data.get('episode_number', 1)))
+        view = local_trending.record_view(cur, data['telegram_id'], data['book_id'], data.get('title'),
+                                          data.get('cover_url'), data.get('episode_number', 1))
         conn.commit()
+        local_trending.count_view(view)
+        note_write(data['telegram_id'])
         return jsonify({"status": "ok"})
     except Exception as e:
         conn.rollback()
@@ -328,9 +678,30 @@ def add_history():
         cur.close()
         conn.close()
 
+@app.route('/api/trending/local')
+def local_trending_list():
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(50, max(1, request.args.get('limit', 20, type=int)))
+    try:
+        return jsonify({"data": local_trending.top(page, per_page)})
+    except Exception as e:
+        logger.error(f"Local trending error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/viewers')
+def book_viewers():
+    book_ids = [b for b in request.args.get('book_ids', '').split(',') if b][:100]
+    if not book_ids:
+        return jsonify({})
+    try:
+        return jsonify(local_trending.viewers(book_ids))
+    except Exception as e:
+        logger.error(f"Viewer count error: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/history/<int:telegram_id>')
 def get_history(telegram_id):
-    conn = get_db()
+    conn = get_read_db(telegram_id)
     cur = conn.cursor()
     try:
         cur.execute("SELECT * FROM watch_history WHERE telegram_id = %s ORDER BY watched_at DESC", (telegram_id,))
@@ -344,8 +715,9 @@ def clear_history(telegram_id):
     conn = get_db()
     cur = conn.cursor()
     try:
-        cur.execute("DELETE FROM watch_history WHERE telegram_id = %s", (telegram_id,))
+        cur.execute("DELETE FROM watch_history_log WHERE telegram_id = %s", (telegram_id,))
         conn.commit()
+        note_write(telegram_id)
         return jsonify({"status": "ok"})
     except Exception as e:
         conn.rollback()
@@ -367,13 +739,10 @@ def submit_report():
         """, (data['telegram_id'], data['issue_type'], data['description']))
         conn.commit()
 
-        bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
         admin_id = os.environ.get('TELEGRAM_ADMIN_ID')
-        if bot_token and admin_id:
-            import requests as req
+        if admin_id:
             msg = f"📩 New Report\nFrom: {data['telegram_id']}\nType: {data['issue_type']}\n\n{data['description']}"
-            req.post(f"https://api.telegram.org/bot{bot_token}/sendMessage",
-                     json={"chat_id": admin_id, "text": msg})
+            telegram_api('sendMessage', {"chat_id": admin_id, "text": msg})
 
         return jsonify({"status": "ok"})
     except Exception as e:
@@ -385,22 +754,27 @@ def submit_report():
 
 @app.route('/api/bot/info')
 def get_bot_info():
-    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    if not bot_token:
-        return jsonify({"username": ""})
+    return jsonify({"username": services.bot_username()})
+
+@app.route('/api/avatar/<int:telegram_id>')
+def avatar_proxy(telegram_id):
     try:
-        import requests as req
-        resp = req.get(f"https://api.telegram.org/bot{bot_token}/getMe", timeout=10)
-        data = resp.json()
-        if data.get('ok'):
-            return jsonify({"username": data['result'].get('username', '')})
-        return jsonify({"username": ""})
-    except:
-        return jsonify({"username": ""})
+        avatar = services.avatar_image(telegram_id)
+    except Exception as e:
+        logger.warning(f"Avatar lookup for {telegram_id} failed: {e}")
+        return '', 502
+    if not avatar:
+        return '', 404
+    unique_id, content, content_type = avatar
+    etag = f'"{unique_id}"'
+    headers = {'Cache-Control': 'public, max-age=3600', 'ETag': etag}
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers=headers)
+    return Response(content, content_type=content_type, headers=headers)
 
 @app.route('/api/user/photo/<int:telegram_id>')
 def get_user_photo(telegram_id):
-    conn = get_db()
+    conn = get_read_db(telegram_id)
     cur = conn.cursor()
     try:
         cur.execute("SELECT avatar_url FROM users WHERE telegram_id = %s", (telegram_id,))
@@ -432,132 +806,22 @@ def handle_referral():
         return jsonify({"error": "missing params"}), 400
 
     try:
-        referrer_id = int(ref_code.replace('ref_', ''))
-    except:
-        return jsonify({"error": "invalid ref code"}), 400
-
-    if referrer_id == int(telegram_id):
-        return jsonify({"error": "cannot refer yourself"}), 400
-
-    conn = get_db()
-    cur = conn.cursor()
-    try:
-        cur.execute("SELECT referred_by FROM users WHERE telegram_id = %s", (telegram_id,))
-        user = cur.fetchone()
-        if user and user['referred_by']:
-            return jsonify({"status": "already_referred"})
-
-        cur.execute("SELECT telegram_id, first_name FROM users WHERE telegram_id = %s", (referrer_id,))
-        referrer = cur.fetchone()
-        if not referrer:
-            return jsonify({"error": "referrer not found"}), 404
-
-        cur.execute("UPDATE users SET referred_by = %s WHERE telegram_id = %s", (referrer_id, telegram_id))
-
-        try:
-            cur.execute("""
-                INSERT INTO referral_logs (referrer_id, referred_id)
-                VALUES (%s, %s)
-                ON CONFLICT (referrer_id, referred_id) DO NOTHING
-            """, (referrer_id, telegram_id))
-        except:
-            pass
-
-        cur.execute("""
-            UPDATE users SET referral_count = referral_count + 1, points = points + 100
-            WHERE telegram_id = %s
-            RETURNING referral_count
-        """, (referrer_id,))
-        updated = cur.fetchone()
-        new_count = updated['referral_count'] if updated else 0
-
-        cur.execute("SELECT first_name, username FROM users WHERE telegram_id = %s", (telegram_id,))
-        referred_user = cur.fetchone()
-        referred_name = ''
-        if referred_user:
-            referred_name = referred_user.get('first_name') or referred_user.get('username') or str(telegram_id)
-
-        bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-
-        if bot_token:
-            try:
-                import requests as req
-                msg = (
-                    "🎉 <b>Referral Berhasil!</b>\n\n"
-                    f"👤 <b>{referred_name}</b> bergabung melalui link referralmu!\n"
-                    f"🏆 Total referral: <b>{new_count}</b>\n"
-                    f"💰 +100 poin (Total: +{new_count * 100} poin)\n"
-                )
-                if new_count >= 10:
-                    msg += "\n🔓 <b>Selamat! Akses penuh 2 MINGGU telah diaktifkan!</b>"
-                elif new_count % 3 == 0:
-                    msg += "\n🔓 <b>Akses penuh 24 jam telah diaktifkan!</b>"
-                else:
-                    remaining_3 = 3 - (new_count % 3)
-                    remaining_10 = 10 - new_count
-                    msg += f"\n📊 {remaining_3} referral lagi untuk akses 24 jam gratis!"
-                    if remaining_10 > 0:
-                        msg += f"\n🎯 {remaining_10} referral lagi untuk akses 2 MINGGU!"
-
-                req.post(
-                    f"https://api.telegram.org/bot{bot_token}/sendMessage",
-                    json={"chat_id": referrer_id, "text": msg, "parse_mode": "HTML"}
-                )
-            except Exception as e:
-                logger.error(f"Failed to send referral notification: {e}")
-
-        if new_count >= 10:
-            expires = datetime.now() + timedelta(days=14)
-            cur.execute("""
-                UPDATE users SET referral_access_expires_at = %s
-                WHERE telegram_id = %s
-            """, (expires, referrer_id))
-        elif new_count > 0 and new_count % 3 == 0:
-            expires = datetime.now() + timedelta(hours=24)
-            cur.execute("""
-                UPDATE users SET referral_access_expires_at = %s
-                WHERE telegram_id = %s
-            """, (expires, referrer_id))
-
-        conn.commit()
-        return jsonify({"status": "ok", "referral_count": new_count})
+        return jsonify(services.credit_referral(telegram_id, ref_code))
+    except ReferralError as e:
+        return jsonify({"error": str(e)}), e.status_code
     except Exception as e:
-        conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        cur.close()
-        conn.close()
 
 @app.route('/api/referral/status/<int:telegram_id>')
 def referral_status(telegram_id):
-    conn = get_db()
+    conn = get_read_db(telegram_id)
     cur = conn.cursor()
     try:
         cur.execute("SELECT referral_count, referral_access_expires_at, points FROM users WHERE telegram_id = %s", (telegram_id,))
         user = cur.fetchone()
         if not user:
             return jsonify({"error": "User not found"}), 404
-
-        now = datetime.now()
-        has_access = False
-        expires_at = user.get('referral_access_expires_at')
-        if expires_at and expires_at > now:
-            has_access = True
-
-        count = user['referral_count']
-        next_reward_3 = 3 - (count % 3) if count % 3 != 0 else 3
-        next_reward_10 = max(0, 10 - count)
-        reached_10 = count >= 10
-
-        return jsonify({
-            "referral_count": count,
-            "points": user['points'],
-            "has_referral_access": has_access,
-            "referral_access_expires_at": expires_at.isoformat() if expires_at else None,
-            "referrals_until_next_reward": next_reward_3,
-            "referrals_until_2weeks": next_reward_10,
-            "reached_10_referrals": reached_10
-        })
+        return jsonify(services.referral_summary(user))
     finally:
         cur.close()
         conn.close()
@@ -569,36 +833,36 @@ def check_episode_access():
     episode_index = data.get('episode_index', 0)
 
     if not telegram_id:
-        return jsonify({"allowed": episode_index < 10, "reason": "login_required"})
+        return jsonify({"allowed": episode_index < services.FREE_EPISODE_LIMIT, "reason": "login_required"})
+
+    # A valid entitlement token that allows the episode answers without touching the database. Denials
+    # are re-checked: the user may have paid or earned referral access since the token was issued.
+    claims = services.verify_entitlement_token(data.get('token'), telegram_id)
+    if claims:
+        allowed, reason = services.access_decision(claims['tier'], episode_index, claims['free'])
+        if allowed:
+            metrics.ENTITLEMENT_CHECKS.inc('token')
+            return jsonify({"allowed": allowed, "reason": reason})
 
     admin_id = get_admin_id()
     if admin_id and int(telegram_id) == admin_id:
         return jsonify({"allowed": True, "reason": "admin"})
 
+    metrics.ENTITLEMENT_CHECKS.inc('database')
     conn = get_db()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT membership, membership_expires_at, referral_access_expires_at FROM users WHERE telegram_id = %s", (telegram_id,))
+        execute_prepared(cur, USER_ACCESS, (telegram_id,))
         user = cur.fetchone()
         if not user:
-            return jsonify({"allowed": episode_index < 10, "reason": "user_not_found"})
-
-        now = datetime.now()
-
-        if user['membership'] == 'VIP':
-            if user['membership_expires_at'] is None or user['membership_expires_at'] > now:
-                return jsonify({"allowed": True, "reason": "vip"})
-            else:
-                cur.execute("UPDATE users SET membership = 'Free', membership_expires_at = NULL WHERE telegram_id = %s", (telegram_id,))
-                conn.commit()
-
-        if user.get('referral_access_expires_at') and user['referral_access_expires_at'] > now:
-            return jsonify({"allowed": True, "reason": "referral_access"})
-
-        if episode_index < 10:
-            return jsonify({"allowed": True, "reason": "free_episode"})
-
-        return jsonify({"allowed": False, "reason": "premium_required"})
+            return jsonify({"allowed": episode_index < services.FREE_EPISODE_LIMIT, "reason": "user_not_found"})
+
+        if claims and claims['v'] == user['entitlement_version']:
+            # Nothing changed since the token was issued, so its denial stands
+            return jsonify({"allowed": False, "reason": "premium_required"})
+        token = services.entitlement_token(user)
+        allowed, reason = services.access_decision(token['tier'], episode_index)
+        return jsonify({"allowed": allowed, "reason": reason, "entitlement": token})
     finally:
         cur.close()
         conn.close()
@@ -608,54 +872,19 @@ def check_subscription(telegram_id):
     conn = get_db()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT membership, membership_expires_at, referral_access_expires_at FROM users WHERE telegram_id = %s", (telegram_id,))
+        execute_prepared(cur, USER_ACCESS, (telegram_id,))
         user = cur.fetchone()
         if not user:
             return jsonify({"error": "User not found"}), 404
-
-        membership = user['membership'] or 'Free'
-        expires_at = user['membership_expires_at']
-        is_active = False
         now = datetime.now()
-
-        admin_id = get_admin_id()
-        if admin_id and telegram_id == admin_id:
-            is_active = True
-            membership = 'Admin'
-
-        elif membership == 'VIP':
-            if expires_at is None:
-                is_active = True
-            elif expires_at > now:
-                is_active = True
-            else:
-                cur.execute("UPDATE users SET membership = 'Free', membership_expires_at = NULL WHERE telegram_id = %s", (telegram_id,))
-                conn.commit()
-                membership = 'Free'
-                expires_at = None
-
-        has_referral_access = False
-        ref_expires = user.get('referral_access_expires_at')
-        if ref_expires and ref_expires > now:
-            has_referral_access = True
-            if not is_active:
-                is_active = True
-
-        return jsonify({
-            "telegram_id": telegram_id,
-            "membership": membership,
-            "is_active": is_active,
-            "has_referral_access": has_referral_access,
-            "expires_at": expires_at.isoformat() if expires_at else None,
-            "referral_access_expires_at": ref_expires.isoformat() if ref_expires else None
-        })
+        return jsonify({**services.entitlement(user, now), "entitlement": services.entitlement_token(user, now)})
     finally:
         cur.close()
         conn.close()
 
 @app.route('/api/settings/<int:telegram_id>', methods=['GET'])
 def get_settings(telegram_id):
-    conn = get_db()
+    conn = get_read_db(telegram_id)
     cur = conn.cursor()
     try:
         cur.execute("SELECT language, notifications_enabled, membership FROM users WHERE telegram_id = %s", (telegram_id,))
@@ -691,6 +920,7 @@ def update_settings(telegram_id):
         if not user:
             return jsonify({"error": "User not found"}), 404
         conn.commit()
+        note_write(telegram_id)
         return jsonify(dict(user))
     except Exception as e:
         conn.rollback()
@@ -701,7 +931,7 @@ def update_settings(telegram_id):
 
 @app.route('/api/stats/monthly')
 def monthly_stats():
-    conn = get_db()
+    conn = get_read_db()
     cur = conn.cursor()
     try:
         now = datetime.now()
@@ -719,6 +949,7 @@ def monthly_stats():
         cur.execute("SELECT COUNT(*) as vip_users FROM users WHERE membership = 'VIP' AND (membership_expires_at IS NULL OR membership_expires_at > %s)", (now,))
         vip_users = cur.fetchone()['vip_users']
 
+        # Latest play per user/book, as watch_history counted before it became a log
         cur.execute("SELECT COUNT(*) as total_watches FROM watch_history WHERE watched_at >= %s", (month_start,))
         total_watches = cur.fetchone()['total_watches']
 
@@ -786,28 +1017,16 @@ def test_saweria_webhook():
     conn = get_db()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT id FROM subscriptions WHERE saweria_transaction_id = %s", (transaction_id,))
-        if cur.fetchone():
+        activation = activate_subscription(cur, telegram_id, transaction_id, plan_type, duration, amount, 'Test User', 'test@test.com')
+        conn.commit()
+        if not activation:
             return jsonify({"status": "already_processed"})
 
-        now = datetime.now()
-        expires_at = (now + duration) if duration else None
-
-        cur.execute("""
-            INSERT INTO subscriptions (telegram_id, saweria_transaction_id, plan_type, amount, donator_name, donator_email, status, activated_at, expires_at)
-            VALUES (%s, %s, %s, %s, %s, %s, 'active', %s, %s)
-            RETURNING *
-        """, (telegram_id, transaction_id, plan_type, amount, 'Test User', 'test@test.com', now, expires_at))
-        sub = dict(cur.fetchone())
-
-        cur.execute("""
-            UPDATE users SET membership = 'VIP', membership_expires_at = %s, updated_at = CURRENT_TIMESTAMP
-            WHERE telegram_id = %s
-            RETURNING membership, membership_expires_at
-        """, (expires_at, telegram_id))
-        user_update = cur.fetchone()
-
-        conn.commit()
+        sub = dict(activation)
+        user_membership = sub.pop('user_membership')
+        user_expires_at = sub.pop('user_membership_expires_at')
+        user_update = {"membership": user_membership, "membership_expires_at": user_expires_at} if user_membership else None
+        expires_at = sub['expires_at']
 
         expires_text = expires_at.strftime('%d %B %Y %H:%M') if expires_at else 'Lifetime'
         notification = (
@@ -828,7 +1047,7 @@ def test_saweria_webhook():
             "expires_at": expires_at.isoformat() if expires_at else None,
             "transaction_id": transaction_id,
             "subscription": sub,
-            "user_membership": dict(user_update) if user_update else None
+            "user_membership": user_update
         })
     except Exception as e:
         conn.rollback()
@@ -838,6 +1057,143 @@ def test_saweria_webhook():
         cur.close()
         conn.close()
 
+@app.route('/api/stats/slow-traces')
+def slow_traces():
+    if not is_admin(request.args.get('admin_telegram_id')):
+        return jsonify({"error": "Admin only"}), 403
+    return jsonify({"threshold_ms": SLOW_REQUEST_MS, "traces": tracing.slow_traces.snapshot()})
+
+@app.route('/api/admin/broadcasts', methods=['GET'])
+def list_broadcasts():
+    if not is_admin(request.args.get('admin_telegram_id')):
+        return jsonify({"error": "Admin only"}), 403
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT id, LEFT(text, 120) AS preview, language, status, total, sent, failed, blocked,
+                   created_at, started_at, finished_at,
+                   EXTRACT(EPOCH FROM (COALESCE(finished_at, updated_at) - started_at)) AS elapsed_seconds
+            FROM broadcasts ORDER BY id DESC LIMIT 20
+        """)
+        broadcasts = []
+        for row in cur.fetchall():
+            item = dict(row)
+            elapsed = float(item.pop('elapsed_seconds') or 0)
+            processed = item['sent'] + item['failed'] + item['blocked']
+            item['processed'] = processed
+            item['messages_per_second'] = round(processed / elapsed, 2) if elapsed > 0 else 0
+            broadcasts.append(item)
+        return jsonify({"broadcasts": broadcasts})
+    finally:
+        cur.close()
+        conn.close()
+
+@app.route('/api/admin/broadcasts', methods=['POST'])
+def create_broadcast():
+    data = request.json or {}
+    if not is_admin(data.get('admin_telegram_id')):
+        return jsonify({"error": "Admin only"}), 403
+    text = (data.get('text') or '').strip()
+    if not text:
+        return jsonify({"error": "text required"}), 400
+    language = data.get('language') or None
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            INSERT INTO broadcasts (text, language, created_by, total)
+            SELECT %(text)s, %(language)s, %(created_by)s, COUNT(*) FROM users
+            WHERE notifications_enabled AND (%(language)s::text IS NULL OR language = %(language)s)
+            RETURNING *
+        """, {"text": text, "language": language, "created_by": int(data['admin_telegram_id'])})
+        broadcast = dict(cur.fetchone())
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Broadcast create error: {e}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        cur.close()
+        conn.close()
+    broadcast_worker.kick()
+    return jsonify(broadcast)
+
+@app.route('/api/admin/broadcasts/<int:broadcast_id>/cancel', methods=['POST'])
+def cancel_broadcast(broadcast_id):
+    data = request.json or {}
+    if not is_admin(data.get('admin_telegram_id')):
+        return jsonify({"error": "Admin only"}), 403
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            UPDATE broadcasts SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND status IN ('pending', 'running')
+            RETURNING id, status
+        """, (broadcast_id,))
+        row = cur.fetchone()
+        conn.commit()
+        if not row:
+            return jsonify({"error": "Broadcast not active"}), 404
+        return jsonify(dict(row))
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        cur.close()
+        conn.close()
+
+def resume_broadcasts():
+    if DATABASE_URL and os.environ.get('TELEGRAM_BOT_TOKEN'):
+        broadcast_worker.kick()
+
+PAYMENT_ACTIVATION_SQL = """
+    WITH current_membership AS (
+        SELECT membership, membership_expires_at FROM users
+        WHERE telegram_id = %(telegram_id)s
+        FOR UPDATE
+    ), new_expiry AS (
+        SELECT CASE
+            WHEN c.membership = 'VIP' AND c.membership_expires_at IS NULL THEN NULL
+            WHEN c.membership = 'VIP' AND c.membership_expires_at > %(now)s THEN c.membership_expires_at + %(duration)s::interval
+            ELSE %(now)s + %(duration)s::interval
+        END AS expires_at
+        FROM (SELECT 1) AS one LEFT JOIN current_membership c ON TRUE
+    ), inserted AS (
+        INSERT INTO subscriptions (telegram_id, saweria_transaction_id, plan_type, amount, donator_name, donator_email, status, activated_at, expires_at)
+        SELECT %(telegram_id)s, %(transaction_id)s, %(plan_type)s, %(amount)s, %(donator_name)s, %(donator_email)s, 'active', %(now)s, expires_at
+        FROM new_expiry
+        ON CONFLICT (saweria_transaction_id) DO NOTHING
+        RETURNING *
+    ), activated AS (
+        UPDATE users SET
+            membership = 'VIP',
+            membership_expires_at = (SELECT expires_at FROM inserted),
+            entitlement_version = entitlement_version + 1,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE telegram_id = %(telegram_id)s
+          AND EXISTS (SELECT 1 FROM inserted)
+        RETURNING membership, membership_expires_at
+    )
+    SELECT i.*, a.membership AS user_membership, a.membership_expires_at AS user_membership_expires_at
+    FROM inserted i LEFT JOIN activated a ON TRUE
+"""
+
+def activate_subscription(cur, telegram_id, transaction_id, plan_type, duration, amount, donator_name, donator_email):
+    cur.execute(PAYMENT_ACTIVATION_SQL, {
+        "telegram_id": telegram_id,
+        "transaction_id": transaction_id,
+        "plan_type": plan_type,
+        "duration": duration,
+        "amount": amount,
+        "donator_name": donator_name,
+        "donator_email": donator_email,
+        "now": datetime.now(),
+    })
+    note_write(telegram_id)
+    return cur.fetchone()
+
 def determine_plan(amount):
     if amount >= 250000:
         return "1 Year VIP", timedelta(days=365)
@@ -849,18 +1205,120 @@ def determine_plan(amount):
         return "3 Days VIP", timedelta(days=3)
     return None, None
 
-def send_telegram_notification(telegram_id, text):
-    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    if not bot_token:
-        return
+EXPIRE_VIP_SQL = """
+    UPDATE users SET membership = 'Free', membership_expires_at = NULL
+    WHERE telegram_id IN (
+        SELECT telegram_id FROM users
+        WHERE membership = 'VIP' AND membership_expires_at <= %(now)s
+        LIMIT %(batch)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING telegram_id
+"""
+
+EXPIRE_REFERRAL_ACCESS_SQL = """
+    UPDATE users SET referral_access_expires_at = NULL
+    WHERE telegram_id IN (
+        SELECT telegram_id FROM users
+        WHERE referral_access_expires_at <= %(now)s
+        LIMIT %(batch)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING telegram_id
+"""
+
+CLAIM_EXPIRY_REMINDERS_SQL = """
+    UPDATE users SET expiry_reminded_for = membership_expires_at
+    WHERE telegram_id IN (
+        SELECT telegram_id FROM users
+        WHERE membership = 'VIP'
+          AND membership_expires_at > %(now)s
+          AND membership_expires_at <= %(remind_before)s
+          AND expiry_reminded_for IS DISTINCT FROM membership_expires_at
+          AND notifications_enabled
+        LIMIT %(batch)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING telegram_id, membership_expires_at
+"""
+
+def _sweep_batches(cur, conn, sql, params):
+    total = []
+    while True:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        conn.commit()
+        total.extend(rows)
+        if len(rows) < params['batch']:
+            return total
+
+def sweep_memberships(batch=500):
+    now = datetime.now()
+    params = {"now": now, "batch": batch, "remind_before": now + timedelta(hours=EXPIRY_REMINDER_HOURS)}
+    conn = get_db()
+    cur = conn.cursor()
     try:
-        import requests as req
-        req.post(
-            f"https://api.telegram.org/bot{bot_token}/sendMessage",
-            json={"chat_id": telegram_id, "text": text, "parse_mode": "HTML"}
-        )
+        expired_vip = _sweep_batches(cur, conn, EXPIRE_VIP_SQL, params)
+        expired_referral = _sweep_batches(cur, conn, EXPIRE_REFERRAL_ACCESS_SQL, params)
+        reminders = _sweep_batches(cur, conn, CLAIM_EXPIRY_REMINDERS_SQL, params) if EXPIRY_REMINDER_HOURS > 0 else []
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    metrics.MEMBERSHIPS_EXPIRED.inc('vip', amount=len(expired_vip))
+    metrics.MEMBERSHIPS_EXPIRED.inc('referral', amount=len(expired_referral))
+    if expired_vip or expired_referral:
+        logger.info(f"Membership sweep: {len(expired_vip)} VIP and {len(expired_referral)} referral access expired")
+
+    for row in reminders:
+        expires_text = row['membership_expires_at'].strftime('%d %B %Y %H:%M')
+        send_telegram_notification(row['telegram_id'], (
+            "⏰ <b>VIP kamu akan segera berakhir</b>\n\n"
+            f"📅 Berlaku sampai: <b>{expires_text}</b>\n\n"
+            "Perpanjang sekarang agar tetap bisa menonton semua episode tanpa batas! 👑"
+        ))
+    return {"expired_vip": len(expired_vip), "expired_referral": len(expired_referral), "reminders": len(reminders)}
+
+def _membership_sweeper_loop():
+    while True:
+        try:
+            sweep_memberships()
+        except Exception as e:
+            logger.error(f"Membership sweep error: {e}")
+        time.sleep(EXPIRY_SWEEP_INTERVAL)
+
+def start_history_maintenance():
+    if not DATABASE_URL:
+        return None
+    return history_archive.start_maintenance(WATCH_HISTORY_RETENTION_MONTHS, WATCH_HISTORY_ARCHIVE_DIR)
+
+def start_recommendation_builder():
+    if not DATABASE_URL or RECOMMENDATION_INTERVAL <= 0:
+        return None
+    return recommend.start_builder(RECOMMENDATION_INTERVAL)
+
+def _flush_trending():
+    try:
+        local_trending.flush()
     except Exception as e:
-        logger.error(f"Failed to send Telegram notification: {e}")
+        logger.error(f"Trending flush at exit failed, buffered views are lost: {e}")
+
+def start_trending_flusher():
+    if not DATABASE_URL:
+        return None
+    atexit.register(_flush_trending)
+    return local_trending.start_flusher(TRENDING_FLUSH_SECONDS)
+
+def start_membership_sweeper():
+    if not DATABASE_URL:
+        return None
+    thread = threading.Thread(target=_membership_sweeper_loop, name='membership-sweeper', daemon=True)
+    thread.start()
+    logger.info(f"Membership sweeper started (every {EXPIRY_SWEEP_INTERVAL}s)")
+    return thread
 
 @app.route('/webhook/saweria', methods=['POST'])
 def saweria_webhook():
@@ -877,7 +1335,7 @@ def saweria_webhook():
             raw_body,
             hashlib.sha256
         ).hexdigest()
-        logger.info(f"Saweria signature check - received: {signature[:16]}..., expected: {expected_sig[:16]}...")
+        payment_logger.info("Saweria signature check - received: %.16s..., expected: %.16s...", signature, expected_sig)
         if not hmac.compare_digest(signature, expected_sig):
             logger.warning("Saweria webhook signature mismatch")
             return jsonify({"error": "Invalid signature"}), 403
@@ -901,55 +1359,14 @@ def saweria_webhook():
 
     plan_type, duration = determine_plan(amount)
     if not plan_type:
-        logger.info(f"Saweria payment amount {amount} too low for any plan")
+        payment_logger.info("Saweria payment amount %s too low for any plan", amount)
         return jsonify({"error": "Amount too low for any plan"}), 400
 
     conn = get_db()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT id FROM subscriptions WHERE saweria_transaction_id = %s", (transaction_id,))
-        if cur.fetchone():
-            return jsonify({"status": "already_processed"})
-
-        now = datetime.now()
-        expires_at = (now + duration) if duration else None
-
-        cur.execute("""
-            INSERT INTO subscriptions (telegram_id, saweria_transaction_id, plan_type, amount, donator_name, donator_email, status, activated_at, expires_at)
-            VALUES (%s, %s, %s, %s, %s, %s, 'active', %s, %s)
-            RETURNING *
-        """, (telegram_id, transaction_id, plan_type, amount, donator_name, donator_email, now, expires_at))
-
-        cur.execute("""
-            UPDATE users SET membership = 'VIP', membership_expires_at = %s, updated_at = CURRENT_TIMESTAMP
-            WHERE telegram_id = %s
-        """, (expires_at, telegram_id))
-
+        activation = activate_subscription(cur, telegram_id, transaction_id, plan_type, duration, amount, donator_name, donator_email)
         conn.commit()
-
-        expires_text = expires_at.strftime('%d %B %Y') if expires_at else 'Selamanya (Lifetime)'
-        notification = (
-            "✅ <b>Pembayaran Berhasil!</b>\n\n"
-            f"💎 Plan: <b>{plan_type}</b>\n"
-            f"💰 Jumlah: Rp {amount:,}\n"
-            f"📅 Berlaku sampai: <b>{expires_text}</b>\n\n"
-            "Terima kasih telah berlangganan Drama China VIP! 🎬"
-        )
-        send_telegram_notification(telegram_id, notification)
-
-        admin_id = os.environ.get('TELEGRAM_ADMIN_ID')
-        if admin_id:
-            admin_msg = (
-                f"💰 <b>New Payment</b>\n"
-                f"User: {telegram_id}\n"
-                f"Plan: {plan_type}\n"
-                f"Amount: Rp {amount:,}\n"
-                f"Donator: {donator_name}"
-            )
-            send_telegram_notification(int(admin_id), admin_msg)
-
-        return jsonify({"status": "ok", "plan": plan_type})
-
     except Exception as e:
         conn.rollback()
         logger.error(f"Saweria webhook error: {e}")
@@ -958,9 +1375,52 @@ def saweria_webhook():
         cur.close()
         conn.close()
 
+    if not activation:
+        return jsonify({"status": "already_processed"})
+    if not activation['user_membership']:
+        logger.warning(f"Saweria payment {transaction_id} recorded but user {telegram_id} not found")
+    expires_at = activation['expires_at']
+
+    expires_text = expires_at.strftime('%d %B %Y') if expires_at else 'Selamanya (Lifetime)'
+    notification = (
+        "✅ <b>Pembayaran Berhasil!</b>\n\n"
+        f"💎 Plan: <b>{plan_type}</b>\n"
+        f"💰 Jumlah: Rp {amount:,}\n"
+        f"📅 Berlaku sampai: <b>{expires_text}</b>\n\n"
+        "Terima kasih telah berlangganan Drama China VIP! 🎬"
+    )
+    send_telegram_notification(telegram_id, notification)
+
+    admin_id = os.environ.get('TELEGRAM_ADMIN_ID')
+    if admin_id:
+        admin_msg = (
+            f"💰 <b>New Payment</b>\n"
+            f"User: {telegram_id}\n"
+            f"Plan: {plan_type}\n"
+            f"Amount: Rp {amount:,}\n"
+            f"Donator: {donator_name}"
+        )
+        send_telegram_notification(int(admin_id), admin_msg)
+
+    return jsonify({"status": "ok", "plan": plan_type})
+
 _bot_instance = None
 _dp_instance = None
 _bot_loop = None
+_update_dispatcher = None
+
+# Updates are acknowledged once queued, so anything still queued at exit would never be redelivered.
+# atexit runs before the daemon bot-loop thread is stopped, so queued updates keep being processed while we wait.
+def _drain_updates():
+    if _update_dispatcher is None:
+        return
+    left = _update_dispatcher.drain(UPDATE_DRAIN_SECONDS)
+    if left:
+        logger.warning(f"Shutting down with {left} acknowledged updates unprocessed; they are lost")
+    else:
+        logger.info("Update queue drained")
+
+atexit.register(_drain_updates)
 
 def _get_bot_webapp_url():
     webapp_env = os.environ.get('WEBAPP_URL', '')
@@ -986,6 +1446,37 @@ def _get_webhook_base_url():
         return f"https://{dev_domain}"
     return ''
 
+async def _telegram_metrics_middleware(make_request, bot, method):
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        response = await make_request(bot, method)
+        status = 'ok'
+        return response
+    finally:
+        api_method = getattr(method, '__api_method__', type(method).__name__)
+        metrics.TELEGRAM_LATENCY.observe(time.perf_counter() - start, api_method, status)
+
+async def _monitor_loop_lag(interval=1.0):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        metrics.BOT_LOOP_LAG.set(max(0.0, loop.time() - start - interval))
+
+def _create_bot_session():
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    return AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE))
+
+def _create_bot(token=None):
+    from aiogram import Bot
+    bot = Bot(token=token or os.environ.get('TELEGRAM_BOT_TOKEN'), session=_create_bot_session())
+    bot.session.middleware(_telegram_metrics_middleware)
+    return bot
+
+broadcast_worker = BroadcastWorker(get_db, _create_bot, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY)
+
 def _setup_bot_and_dispatcher():
     global _bot_instance, _dp_instance
     BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
@@ -993,45 +1484,26 @@ def _setup_bot_and_dispatcher():
         logger.warning("TELEGRAM_BOT_TOKEN not set. Bot will not start.")
         return None, None
 
-    from aiogram import Bot, Dispatcher, types as aitypes
+    from aiogram import Dispatcher, types as aitypes
     from aiogram.filters import CommandStart
     from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo, FSInputFile
     from aiogram.enums import ParseMode
 
     WEBAPP_URL = _get_bot_webapp_url()
 
-    bot = Bot(token=BOT_TOKEN)
+    bot = _create_bot(BOT_TOKEN)
     dp = Dispatcher()
 
+    banner_path = os.path.join(os.path.dirname(__file__), 'static', 'images', 'welcome_banner.png')
+    banner_file_id = None
+
     @dp.message(CommandStart())
     async def start_handler(message: aitypes.Message):
+        nonlocal banner_file_id
         args = message.text.split()
         ref_code = args[1] if len(args) > 1 else None
 
         user = message.from_user
-        avatar_url = ''
-        try:
-            photos = await bot.get_user_profile_photos(user.id, limit=1)
-            if photos.total_count > 0:
-                file_info = await bot.get_file(photos.photos[0][-1].file_id)
-                avatar_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-        except Exception as e:
-            logger.error(f"Failed to get profile photo: {e}")
-
-        if WEBAPP_URL:
-            try:
-                import aiohttp as aio
-                async with aio.ClientSession() as session:
-                    await session.post(f"{WEBAPP_URL}/api/user", json={
-                        "telegram_id": user.id,
-                        "username": user.username or '',
-                        "first_name": user.first_name or '',
-                        "last_name": user.last_name or '',
-                        "avatar_url": avatar_url
-                    })
-            except Exception as e:
-                logger.error(f"User register error: {e}")
-
         welcome_text = (
             "🎬 <b>Selamat datang di Drama China!</b>\n\n"
             "Nikmati ribuan drama China, Korea & Asia lainnya "
@@ -1054,21 +1526,27 @@ def _setup_bot_and_dispatcher():
             rows.append([InlineKeyboardButton(text="🎬 Buka Aplikasi", web_app=WebAppInfo(url=webapp_url))])
         keyboard = InlineKeyboardMarkup(inline_keyboard=rows)
 
-        banner_path = os.path.join(os.path.dirname(__file__), 'static', 'images', 'welcome_banner.png')
-        if os.path.exists(banner_path):
-            photo = FSInputFile(banner_path)
-            await message.answer_photo(photo=photo, caption=welcome_text, parse_mode=ParseMode.HTML, reply_markup=keyboard)
+        if banner_file_id or os.path.exists(banner_path):
+            photo = banner_file_id or FSInputFile(banner_path)
+            sent = await message.answer_photo(photo=photo, caption=welcome_text, parse_mode=ParseMode.HTML, reply_markup=keyboard)
+            if not banner_file_id and sent.photo:
+                banner_file_id = sent.photo[-1].file_id
         else:
             await message.answer(welcome_text, parse_mode=ParseMode.HTML, reply_markup=keyboard)
 
-        if ref_code and ref_code.startswith('ref_') and WEBAPP_URL:
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, services.upsert_user, user.id, user.username or '',
+                                       user.first_name or '', user.last_name or '', services.avatar_path(user.id))
+        except Exception as e:
+            logger.error(f"User register error: {e}")
+        loop.run_in_executor(None, services.warm_avatar, user.id)
+
+        if ref_code and ref_code.startswith('ref_'):
             try:
-                import aiohttp as aio
-                async with aio.ClientSession() as session:
-                    await session.post(f"{WEBAPP_URL}/api/referral", json={
-                        "telegram_id": user.id,
-                        "ref_code": ref_code
-                    })
+                await loop.run_in_executor(None, services.credit_referral, user.id, ref_code)
+            except services.ReferralError as e:
+                logger.info(f"Referral {ref_code} for {user.id} not credited: {e}")
             except Exception as e:
                 logger.error(f"Referral error: {e}")
 
@@ -1076,63 +1554,99 @@ def _setup_bot_and_dispatcher():
     _dp_instance = dp
     return bot, dp
 
+BOT_DESCRIPTION = (
+    "🎬 Drama China Bot - Streaming drama China, Korea & Asia langsung di Telegram!\n\n"
+    "✨ Fitur:\n"
+    "• Ribuan drama dengan subtitle Indonesia\n"
+    "• Streaming gratis 10 episode pertama\n"
+    "• Simpan favorit & riwayat tontonan\n"
+    "• Sistem referral berhadiah akses premium\n"
+    "• VIP untuk akses semua episode tanpa batas\n\n"
+    "Klik Start untuk mulai menonton!"
+)
+BOT_SHORT_DESCRIPTION = "🎬 Streaming drama China, Korea & Asia gratis di Telegram! Nonton ribuan drama dengan subtitle Indonesia."
+BOT_COMMANDS = (("start", "Mulai bot & buka aplikasi"),)
+WEBHOOK_ALLOWED_UPDATES = ["message", "callback_query", "inline_query"]
+
+async def _push_if_changed(key, config, push):
+    loop = asyncio.get_running_loop()
+    digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+    try:
+        current = await loop.run_in_executor(None, services.get_app_state, key)
+    except Exception as e:
+        logger.warning(f"Could not read {key} state, pushing anyway: {e}")
+        current = None
+    if current == digest:
+        logger.info(f"{key} unchanged ({digest}), skipping Bot API calls")
+        return False
+    await push()
+    try:
+        await loop.run_in_executor(None, services.set_app_state, key, digest)
+    except Exception as e:
+        logger.warning(f"Could not save {key} state: {e}")
+    return True
+
 async def _set_bot_descriptions(bot):
+    from aiogram.types import BotCommand
+
+    async def push():
+        await bot.set_my_description(description=BOT_DESCRIPTION)
+        await bot.set_my_short_description(short_description=BOT_SHORT_DESCRIPTION)
+        await bot.set_my_commands([BotCommand(command=c, description=d) for c, d in BOT_COMMANDS])
+        logger.info("Bot description, short description and commands updated")
+
     try:
-        BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
-        bot_description = (
-            "🎬 Drama China Bot - Streaming drama China, Korea & Asia langsung di Telegram!\n\n"
-            "✨ Fitur:\n"
-            "• Ribuan drama dengan subtitle Indonesia\n"
-            "• Streaming gratis 10 episode pertama\n"
-            "• Simpan favorit & riwayat tontonan\n"
-            "• Sistem referral berhadiah akses premium\n"
-            "• VIP untuk akses semua episode tanpa batas\n\n"
-            "Klik Start untuk mulai menonton!"
-        )
-        await bot.set_my_description(description=bot_description)
-        logger.info("Bot description set successfully")
-
-        short_description = "🎬 Streaming drama China, Korea & Asia gratis di Telegram! Nonton ribuan drama dengan subtitle Indonesia."
-        await bot.set_my_short_description(short_description=short_description)
-        logger.info("Bot short description set successfully")
-
-        from aiogram.types import BotCommand
-        commands = [
-            BotCommand(command="start", description="Mulai bot & buka aplikasi"),
-        ]
-        await bot.set_my_commands(commands)
-        logger.info("Bot commands set successfully")
+        await _push_if_changed('bot_profile', {
+            "bot": bot.id,
+            "description": BOT_DESCRIPTION,
+            "short_description": BOT_SHORT_DESCRIPTION,
+            "commands": BOT_COMMANDS,
+        }, push)
     except Exception as e:
         logger.error(f"Failed to set bot descriptions: {e}")
 
+async def _verify_webhook(bot, webhook_url):
+    try:
+        info = await bot.get_webhook_info()
+        if info.url != webhook_url:
+            logger.warning(f"Webhook is '{info.url}', expected {webhook_url}; re-registering")
+            await bot.set_webhook(url=webhook_url, drop_pending_updates=False, allowed_updates=WEBHOOK_ALLOWED_UPDATES,
+                                  max_connections=WEBHOOK_MAX_CONNECTIONS)
+        elif info.max_connections != WEBHOOK_MAX_CONNECTIONS:
+            logger.warning(f"Webhook max_connections is {info.max_connections}, expected {WEBHOOK_MAX_CONNECTIONS}; re-registering")
+            await bot.set_webhook(url=webhook_url, drop_pending_updates=False, allowed_updates=WEBHOOK_ALLOWED_UPDATES,
+                                  max_connections=WEBHOOK_MAX_CONNECTIONS)
+        elif info.last_error_message:
+            logger.warning(f"Webhook last error: {info.last_error_message} (pending={info.pending_update_count})")
+    except Exception as e:
+        logger.error(f"Webhook verification failed: {e}")
+
 WEBHOOK_PATH = "/webhook"
 
 @app.route(WEBHOOK_PATH, methods=['POST'])
 def telegram_webhook():
-    global _bot_instance, _dp_instance, _bot_loop
-    if not _bot_instance or not _dp_instance or not _bot_loop:
-        logger.warning("Webhook received but bot not yet initialized, returning ok")
-        return jsonify({"ok": True})
+    if not _bot_instance or not _update_dispatcher:
+        logger.warning("Webhook received before bot is ready, asking Telegram to retry")
+        return jsonify({"ok": False}), 503
     try:
         from aiogram.types import Update
         update_data = request.get_json(force=True)
-        logger.info(f"Webhook received update: {update_data.get('update_id', 'unknown')}")
+        webhook_logger.info("Webhook received update: %s", update_data.get('update_id', 'unknown'))
         update = Update.model_validate(update_data, context={"bot": _bot_instance})
-        future = asyncio.run_coroutine_threadsafe(
-            _dp_instance.feed_update(bot=_bot_instance, update=update),
-            _bot_loop
-        )
-        future.result(timeout=30)
-        return jsonify({"ok": True})
     except Exception as e:
-        logger.error(f"Webhook processing error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"Webhook received an invalid update: {e}")
         return jsonify({"ok": True})
-
-def _start_webhook_bot(delay=3):
-    global _bot_instance, _dp_instance, _bot_loop
-    time.sleep(delay)
+    # Acknowledge as soon as the update is queued; handlers run on the bot loop
+    result = _update_dispatcher.submit(update.update_id, updates.chat_key(update_data), update)
+    if result == 'busy':
+        logger.warning(f"Update queue full, asking Telegram to retry update {update.update_id}")
+        return jsonify({"ok": False}), 503
+    if result == 'duplicate':
+        webhook_logger.info("Dropped redelivered update %s", update.update_id)
+    return jsonify({"ok": True})
+
+def _start_webhook_bot():
+    global _bot_instance, _dp_instance, _bot_loop, _update_dispatcher
 
     BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
     if not BOT_TOKEN:
@@ -1149,11 +1663,6 @@ def _start_webhook_bot(delay=3):
     _bot_loop = loop
 
     async def _init_webhook():
-        try:
-            await _set_bot_descriptions(bot)
-        except Exception as e:
-            logger.error(f"Failed to set bot descriptions: {e}")
-
         webhook_base = _get_webhook_base_url()
         logger.info(f"Webhook base URL: {webhook_base}")
         if not webhook_base:
@@ -1162,28 +1671,38 @@ def _start_webhook_bot(delay=3):
             logger.error(f"Cannot determine webhook URL. WEBAPP_URL='{webapp_url}', REPLIT_DOMAINS='{domains}'")
             return False
         webhook_url = f"{webhook_base}{WEBHOOK_PATH}"
-        logger.info(f"Setting webhook to: {webhook_url}")
+
+        async def push():
+            await bot.set_webhook(url=webhook_url, drop_pending_updates=False, allowed_updates=WEBHOOK_ALLOWED_UPDATES,
+                                  max_connections=WEBHOOK_MAX_CONNECTIONS)
+            logger.info(f"Webhook set successfully to: {webhook_url} (max_connections={WEBHOOK_MAX_CONNECTIONS})")
+
         try:
-            await bot.delete_webhook(drop_pending_updates=False)
-            await bot.set_webhook(
-                url=webhook_url,
-                drop_pending_updates=False,
-                allowed_updates=["message", "callback_query", "inline_query"]
-            )
-            webhook_info = await bot.get_webhook_info()
-            logger.info(f"Webhook info: url={webhook_info.url}, pending={webhook_info.pending_update_count}, last_error={webhook_info.last_error_message}")
-            logger.info(f"Webhook set successfully to: {webhook_url}")
-            return True
+            pushed = await _push_if_changed('bot_webhook', {
+                "bot": bot.id,
+                "url": webhook_url,
+                "allowed_updates": WEBHOOK_ALLOWED_UPDATES,
+                "max_connections": WEBHOOK_MAX_CONNECTIONS,
+            }, push)
         except Exception as e:
             logger.error(f"Failed to set webhook: {e}")
             import traceback
             traceback.print_exc()
             return False
+        if not pushed:
+            loop.create_task(_verify_webhook(bot, webhook_url))
+        loop.create_task(_set_bot_descriptions(bot))
+        return True
 
     try:
         success = loop.run_until_complete(_init_webhook())
         if success:
+            _update_dispatcher = updates.UpdateDispatcher(
+                loop, lambda update: dp.feed_update(bot=bot, update=update),
+                concurrency=UPDATE_CONCURRENCY, max_pending=UPDATE_MAX_PENDING)
             logger.info("Bot webhook mode initialized! Bot is ready to receive updates.")
+            _mark_ready('bot')
+            loop.create_task(_monitor_loop_lag())
             loop.run_forever()
         else:
             logger.error("Webhook initialization failed!")
@@ -1209,11 +1728,15 @@ def run_bot():
             await bot.session.close()
             raise WebhookActiveError("Production webhook is active, skipping polling mode.")
         await bot.delete_webhook(drop_pending_updates=True)
-        await _set_bot_descriptions(bot)
+        profile_task = asyncio.create_task(_set_bot_descriptions(bot))
         logger.info("Bot started successfully (polling mode)!")
+        _mark_ready('bot')
+        lag_task = asyncio.create_task(_monitor_loop_lag())
         try:
             await dp.start_polling(bot, handle_signals=False, polling_timeout=30)
         finally:
+            lag_task.cancel()
+            profile_task.cancel()
             await bot.session.close()
 
     loop = asyncio.new_event_loop()
@@ -1228,8 +1751,24 @@ def run_bot():
 def health_check():
     return jsonify({"status": "ok"}), 200
 
-def _start_bot_with_retry(delay=3, use_webhook=False):
-    time.sleep(delay)
+@app.route('/ready')
+def readiness_check():
+    ready = ((_ready['db'] or not DATABASE_URL) and
+             (_ready['bot'] or not os.environ.get('TELEGRAM_BOT_TOKEN')))
+    body = {"status": "ready" if ready else "starting", **_ready}
+    replicas = replica_status()
+    if replicas:
+        body["replicas"] = replicas
+    body["admission"] = admission.status()
+    return jsonify(body), 200 if ready else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get('Authorization', '') != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def _start_bot_with_retry(use_webhook=False):
     retry_count = 0
     while True:
         retry_count += 1
@@ -1241,12 +1780,13 @@ def _start_bot_with_retry(delay=3, use_webhook=False):
         try:
             if use_webhook:
                 logger.info(f"Starting bot in WEBHOOK mode (attempt #{retry_count})...")
-                _start_webhook_bot(0)
+                _start_webhook_bot()
             else:
                 logger.info(f"Starting bot in POLLING mode (attempt #{retry_count})...")
                 run_bot()
         except WebhookActiveError:
             logger.info("Production webhook is active. Dev polling will not start. Stopping retry loop.")
+            _mark_ready('bot')
             return
         except Exception as e:
             logger.error(f"Bot crashed: {e}")
@@ -1258,6 +1798,12 @@ def _start_bot_with_retry(delay=3, use_webhook=False):
 
 if __name__ == '__main__':
     init_db()
+    start_membership_sweeper()
+    start_history_maintenance()
+    start_recommendation_builder()
+    start_trending_flusher()
+    resume_broadcasts()
+    home_snapshot()
 
     is_deployment = os.environ.get('REPLIT_DEPLOYMENT') == '1'
 
@@ -1275,10 +1821,10 @@ if __name__ == '__main__':
 
     if is_deployment:
         logger.info("Running in DEPLOYMENT mode - using webhook for bot")
-        bot_thread = threading.Thread(target=_start_bot_with_retry, args=(3, True), daemon=True)
+        bot_thread = threading.Thread(target=_start_bot_with_retry, args=(True,), daemon=True)
     else:
         logger.info("Running in DEVELOPMENT mode - using polling for bot")
-        bot_thread = threading.Thread(target=_start_bot_with_retry, args=(3, False), daemon=True)
+        bot_thread = threading.Thread(target=_start_bot_with_retry, args=(False,), daemon=True)
 
     bot_thread.start()
     logger.info(f"Bot thread started ({'webhook' if is_deployment else 'polling'} mode)")
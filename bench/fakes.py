@@ -0,0 +1,167 @@
+import json
+import os
+import re
+from datetime import datetime, timedelta
+
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictRow
+
+from bench.mock_servers import FIXTURES_DIR
+
+_ALIAS_RE = re.compile(r'\bas\s+(\w+)', re.IGNORECASE)
+_PREPARE_RE = re.compile(r'^PREPARE (\w+) \([^)]*\) AS (.*)$', re.DOTALL)
+_EXECUTE_RE = re.compile(r'^EXECUTE (\w+)')
+
+
+def _user_row(telegram_id=7000000001):
+    now = datetime.now()
+    return {
+        "id": 1,
+        "telegram_id": telegram_id,
+        "username": "bench",
+        "first_name": "Bench",
+        "last_name": "User",
+        "avatar_url": "",
+        "membership": "Free",
+        "membership_expires_at": None,
+        "points": 300,
+        "commission": 0,
+        "referral_count": 3,
+        "referred_by": None,
+        "language": "id",
+        "notifications_enabled": True,
+        "referral_access_expires_at": now - timedelta(hours=2),
+        "entitlement_version": 0,
+        "created_at": now - timedelta(days=30),
+        "updated_at": now,
+    }
+
+
+def _library_rows(count, with_episode=False):
+    now = datetime.now()
+    rows = []
+    for i in range(count):
+        row = {
+            "id": i + 1,
+            "telegram_id": 7000000001,
+            "book_id": f"4100{i:04d}",
+            "title": f"Drama Bench {i}",
+            "cover_url": f"https://cover.example/{i}.jpg",
+            "created_at": now - timedelta(minutes=i),
+        }
+        if with_episode:
+            row["episode_number"] = f"EP {i + 1}"
+            row["watched_at"] = row.pop("created_at")
+        rows.append(row)
+    return rows
+
+
+DEFAULT_RULES = [
+    (r'^\s*SELECT \* FROM users', lambda q: [_user_row()]),
+    (r'^\s*SELECT telegram_id, membership, membership_expires_at, referral_access_expires_at, entitlement_version\s+FROM users',
+     lambda q: [{k: _user_row()[k] for k in ("telegram_id", "membership", "membership_expires_at", "referral_access_expires_at",
+                                             "entitlement_version")}]),
+    (r'FROM favorites WHERE telegram_id', lambda q: _library_rows(20)),
+    (r'FROM watch_history WHERE telegram_id', lambda q: _library_rows(20, with_episode=True)),
+    (r'AS first_view', lambda q: [{"first_view": False}]),
+    (r'INSERT INTO watch_history', lambda q: _library_rows(1, with_episode=True)),
+    (r'GROUP BY DATE', lambda q: [{"date": datetime.now().date() - timedelta(days=i), "count": 10 + i} for i in range(18)]),
+    (r'\bas\s+\w+', lambda q: [{alias: 42 for alias in _ALIAS_RE.findall(q)}]),
+]
+
+
+class FakeCursor:
+    def __init__(self, db, connection):
+        self.db = db
+        self.connection = connection
+        self._rows = []
+        self.rowcount = 0
+
+    def execute(self, query, vars=None):
+        self.db.queries += 1
+        prepare = _PREPARE_RE.match(query)
+        if prepare:
+            self.db.prepared[prepare.group(1)] = prepare.group(2)
+            self._rows = []
+            return
+        execute = _EXECUTE_RE.match(query)
+        if execute:
+            query = self.db.prepared[execute.group(1)]
+        for pattern, factory in self.db.rules:
+            if pattern.search(query):
+                self._rows = [RealDictRow(row) for row in factory(query)]
+                break
+        else:
+            self._rows = []
+        self.rowcount = len(self._rows)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.closed = 0
+        self.prepared = set()
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self.db, self)
+
+    def get_transaction_status(self):
+        return TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeDatabase:
+    def __init__(self, rules=DEFAULT_RULES):
+        self.rules = [(re.compile(p, re.IGNORECASE), f) for p, f in rules]
+        self.queries = 0
+        self.prepared = {}
+
+    def connect(self, *args, **kwargs):
+        return FakeConnection(self)
+
+
+class FakeResponse:
+    def __init__(self, content, status_code=200, content_type='application/json'):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {'Content-Type': content_type, 'Content-Length': str(len(content))}
+        self.ok = status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=65536):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+def load_fixture(name, book_id='41000', page='1', media_origin='https://media.example'):
+    with open(os.path.join(FIXTURES_DIR, f"{name}.json"), encoding='utf-8') as f:
+        text = f.read()
+    return (text.replace('{BOOK_ID}', book_id)
+                .replace('{PAGE}', page)
+                .replace('{MEDIA_ORIGIN}', media_origin)).encode('utf-8')
@@ -0,0 +1,384 @@
+import argparse
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import aiohttp
+
+from bench.mock_servers import DramaBoxMock, MediaOriginMock, TelegramMock
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = '100000001:BENCHMARK-TOKEN'
+SAWERIA_KEY = 'bench-saweria-key'
+ADMIN_ID = 999000001
+USER_ID_BASE = 7_000_000_000
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+class LocalPostgres:
+    def __init__(self):
+        self.tmpdir = None
+        self.port = None
+
+    @staticmethod
+    def available(replica=False):
+        return shutil.which('initdb') and shutil.which('pg_ctl') and (not replica or shutil.which('pg_basebackup'))
+
+    def start(self, primary=None):
+        self.tmpdir = tempfile.mkdtemp(prefix='drama-bench-pg-')
+        self.port = _free_port()
+        datadir = os.path.join(self.tmpdir, 'data')
+        if primary is None:
+            subprocess.run(['initdb', '-D', datadir, '-U', 'bench', '--auth=trust', '-E', 'UTF8'],
+                           check=True, stdout=subprocess.DEVNULL)
+        else:
+            # Streaming standby of the primary cluster, for exercising DATABASE_REPLICA_URL routing
+            subprocess.run(['pg_basebackup', '-h', '127.0.0.1', '-p', str(primary.port), '-U', 'bench',
+                            '-D', datadir, '-X', 'stream', '-R'], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(['pg_ctl', '-D', datadir, '-l', os.path.join(self.tmpdir, 'pg.log'), '-w', 'start',
+                        '-o', f"-p {self.port} -k {self.tmpdir} -c listen_addresses=127.0.0.1 -c fsync=off"],
+                       check=True, stdout=subprocess.DEVNULL)
+        return f"postgresql://bench@127.0.0.1:{self.port}/postgres"
+
+    def stop(self):
+        if self.tmpdir:
+            subprocess.run(['pg_ctl', '-D', os.path.join(self.tmpdir, 'data'), '-m', 'fast', 'stop'],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class AppProcess:
+    def __init__(self, env, threads, log_path):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = dict(os.environ, WEBAPP_URL=self.url, **env)
+        self.threads = threads
+        self.log_path = log_path
+        self.proc = None
+
+    def start(self):
+        self.log = open(self.log_path, 'w')
+        self.proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', f"--bind=127.0.0.1:{self.port}", '--workers=1',
+             f"--threads={self.threads}", '--timeout=120', 'wsgi:app'],
+            cwd=REPO_ROOT, env=self.env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        if self.proc:
+            self.log.close()
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def add(self, route, elapsed, status):
+        self.samples[route].append(elapsed)
+        self.statuses[route][status] += 1
+
+    def report(self):
+        duration = (self.finished or time.perf_counter()) - self.started
+        routes = {}
+        for route in sorted(self.samples):
+            values = sorted(self.samples[route])
+            statuses = self.statuses[route]
+            errors = sum(n for s, n in statuses.items() if s == 'error' or s >= 500)
+            routes[route] = {
+                "count": len(values),
+                "errors": errors,
+                "rps": round(len(values) / duration, 2),
+                "p50_ms": round(_percentile(values, 50) * 1000, 1),
+                "p95_ms": round(_percentile(values, 95) * 1000, 1),
+                "p99_ms": round(_percentile(values, 99) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1),
+                "statuses": {str(k): v for k, v in statuses.items()},
+            }
+        total = sum(r["count"] for r in routes.values())
+        return {"duration_s": round(duration, 2), "total_requests": total,
+                "total_rps": round(total / duration, 2), "routes": routes}
+
+
+async def _call(session, recorder, route, method, url, **kwargs):
+    start = time.perf_counter()
+    body = None
+    try:
+        async with session.request(method, url, **kwargs) as resp:
+            body = await resp.read()
+            status = resp.status
+    except Exception:
+        status = 'error'
+    recorder.add(route, time.perf_counter() - start, status)
+    return status, body
+
+
+def _json(body):
+    try:
+        return json.loads(body)
+    except (TypeError, ValueError):
+        return None
+
+
+async def browse_worker(session, base, recorder, deadline, args, user_ids):
+    while time.monotonic() < deadline:
+        telegram_id = random.choice(user_ids)
+        _, body = await _call(session, recorder, 'POST /api/bootstrap', 'POST', f"{base}/api/bootstrap", json={
+            "telegram_id": telegram_id, "username": f"bench{telegram_id}", "first_name": "Bench", "last_name": "", "avatar_url": ""})
+        entitlement = (_json(body) or {}).get("entitlement") or {}
+
+        page = random.randint(1, 5)
+        _, body = await _call(session, recorder, 'GET /api/proxy/foryou', 'GET', f"{base}/api/proxy/foryou?page={page}")
+        items = _json(body) or []
+        if not isinstance(items, list) or not items:
+            continue
+        await asyncio.gather(*[
+            _call(session, recorder, 'GET /api/imgproxy', 'GET', f"{base}/api/imgproxy", params={"url": item["coverWap"]})
+            for item in items[:args.covers_per_page]
+        ])
+
+        book = random.choice(items)
+        book_id = book["bookId"]
+        await asyncio.gather(
+            _call(session, recorder, 'GET /api/proxy/detail', 'GET', f"{base}/api/proxy/detail?bookId={book_id}"),
+            _call(session, recorder, 'GET /api/proxy/allepisode', 'GET', f"{base}/api/proxy/allepisode?bookId={book_id}"),
+            _call(session, recorder, 'GET /api/favorites', 'GET', f"{base}/api/favorites/{telegram_id}"),
+        )
+
+        for episode in range(random.randint(1, args.max_autoplay)):
+            if time.monotonic() >= deadline:
+                break
+            # Like the WebApp: free episodes and unlocked tiers are decided locally from the token
+            if episode >= entitlement.get("free", 10) and entitlement.get("tier", "free") == "free":
+                await _call(session, recorder, 'POST /api/episode/access', 'POST', f"{base}/api/episode/access",
+                            json={"telegram_id": telegram_id, "episode_index": episode, "token": entitlement.get("token")})
+            await _call(session, recorder, 'POST /api/history', 'POST', f"{base}/api/history", json={
+                "telegram_id": telegram_id, "book_id": book_id, "title": book.get("bookName"),
+                "cover_url": book.get("coverWap"), "episode_number": f"EP {episode + 1}"})
+            await asyncio.sleep(args.think_ms / 1000)
+
+
+async def start_worker(session, base, recorder, deadline, args, update_ids, new_user_ids, registered):
+    while time.monotonic() < deadline:
+        update_id = next(update_ids)
+        telegram_id = next(new_user_ids)
+        text = '/start'
+        if registered and random.random() < args.referral_ratio:
+            text = f"/start ref_{random.choice(registered)}"
+        update = {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": telegram_id, "type": "private", "first_name": "Bench"},
+                "from": {"id": telegram_id, "is_bot": False, "first_name": "Bench", "username": f"bench{telegram_id}"},
+                "text": text,
+                "entities": [{"offset": 0, "length": 6, "type": "bot_command"}],
+            },
+        }
+        status, _ = await _call(session, recorder, 'POST /webhook', 'POST', f"{base}/webhook", json=update)
+        if status == 200:
+            registered.append(telegram_id)
+
+
+async def saweria_worker(session, base, recorder, deadline, args, registered, user_ids):
+    while time.monotonic() < deadline:
+        telegram_id = random.choice(registered or user_ids)
+        payload = json.dumps({
+            "id": str(uuid.uuid4()),
+            "amount_raw": random.choice((3000, 10000, 35000, 250000)),
+            "donator_name": "Bench Donor",
+            "donator_email": "bench@example.com",
+            "message": str(telegram_id),
+            "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }).encode('utf-8')
+        signature = hmac.new(SAWERIA_KEY.encode('utf-8'), payload, hashlib.sha256).hexdigest()
+        await _call(session, recorder, 'POST /webhook/saweria', 'POST', f"{base}/webhook/saweria", data=payload,
+                    headers={"Content-Type": "application/json", "Saweria-Callback-Signature": signature})
+        await asyncio.sleep(args.saweria_interval_ms / 1000)
+
+
+async def run_scenarios(base, args):
+    recorder = Recorder()
+    deadline = time.monotonic() + args.duration
+    user_ids = [USER_ID_BASE + i for i in range(args.user_pool)]
+    update_ids = itertools.count(1)
+    new_user_ids = itertools.count(USER_ID_BASE + 1_000_000)
+    registered = []
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        workers = []
+        if 'browse' in args.scenarios:
+            workers += [browse_worker(session, base, recorder, deadline, args, user_ids)
+                        for _ in range(args.browse_users)]
+        if 'start' in args.scenarios:
+            workers += [start_worker(session, base, recorder, deadline, args, update_ids, new_user_ids, registered)
+                        for _ in range(args.start_workers)]
+        if 'saweria' in args.scenarios:
+            workers += [saweria_worker(session, base, recorder, deadline, args, registered, user_ids)
+                        for _ in range(args.saweria_workers)]
+        await asyncio.gather(*workers)
+    recorder.finished = time.perf_counter()
+    return recorder.report()
+
+
+def _wait_for_app(url, proc, telegram, timeout):
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.proc.poll() is not None:
+            raise RuntimeError(f"App exited early, see {proc.log_path}")
+        try:
+            if requests.get(f"{url}/health", timeout=1).status_code == 200:
+                break
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    else:
+        raise RuntimeError(f"App did not become healthy within {timeout}s")
+    if telegram and not telegram.webhook_set.wait(max(0.0, deadline - time.monotonic())):
+        raise RuntimeError(f"Bot did not register its webhook within {timeout}s")
+
+
+def print_report(report, baseline=None):
+    header = f"{'route':34} {'count':>7} {'err':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}"
+    print(header)
+    print('-' * len(header))
+    for route, r in report["routes"].items():
+        line = f"{route:34} {r['count']:>7} {r['errors']:>5} {r['rps']:>8.1f} {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f}"
+        base = (baseline or {}).get("routes", {}).get(route)
+        if base and base["p95_ms"]:
+            line += f"  p95 {100 * (r['p95_ms'] - base['p95_ms']) / base['p95_ms']:+.0f}%"
+            if base["rps"]:
+                line += f" rps {100 * (r['rps'] - base['rps']) / base['rps']:+.0f}%"
+        print(line)
+    print(f"\n{report['total_requests']} requests in {report['duration_s']}s ({report['total_rps']} rps)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load test against local DramaBox/Telegram/Postgres stand-ins.')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to drive load')
+    parser.add_argument('--scenarios', default='browse,start,saweria', help='Comma-separated: browse,start,saweria')
+    parser.add_argument('--browse-users', type=int, default=16, help='Concurrent browse/autoplay users')
+    parser.add_argument('--start-workers', type=int, default=4, help='Concurrent /start webhook senders')
+    parser.add_argument('--saweria-workers', type=int, default=2, help='Concurrent Saweria webhook senders')
+    parser.add_argument('--saweria-interval-ms', type=int, default=50)
+    parser.add_argument('--user-pool', type=int, default=500, help='Distinct WebApp users for browse')
+    parser.add_argument('--referral-ratio', type=float, default=0.3, help='Fraction of /start carrying a ref code')
+    parser.add_argument('--covers-per-page', type=int, default=6)
+    parser.add_argument('--max-autoplay', type=int, default=5, help='Max episodes auto-played per drama')
+    parser.add_argument('--think-ms', type=int, default=200, help='Pause between auto-played episodes')
+    parser.add_argument('--upstream-latency-ms', type=int, default=80)
+    parser.add_argument('--upstream-error-rate', type=float, default=0.0)
+    parser.add_argument('--media-latency-ms', type=int, default=30)
+    parser.add_argument('--telegram-latency-ms', type=int, default=40)
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn --threads for the app under test')
+    parser.add_argument('--database-url', default=os.environ.get('BENCH_DATABASE_URL'),
+                        help='Postgres to use; a throwaway cluster is created with initdb when omitted')
+    parser.add_argument('--replica', action='store_true',
+                        help='Also start a streaming standby of the throwaway cluster and route reads to it')
+    parser.add_argument('--replica-url', default=os.environ.get('BENCH_DATABASE_REPLICA_URL'),
+                        help='Read replica to pass as DATABASE_REPLICA_URL')
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    parser.add_argument('--output', help='Write the JSON report here')
+    parser.add_argument('--compare', help='Baseline JSON report to diff p95/RPS against')
+    args = parser.parse_args()
+    args.scenarios = set(args.scenarios.split(','))
+
+    media = MediaOriginMock(latency_ms=args.media_latency_ms).start()
+    dramabox = DramaBoxMock(media.url, latency_ms=args.upstream_latency_ms, error_rate=args.upstream_error_rate).start()
+    telegram = TelegramMock(latency_ms=args.telegram_latency_ms).start()
+
+    postgres = None
+    standby = None
+    database_url = args.database_url
+    replica_url = args.replica_url
+    if args.replica and (database_url or replica_url):
+        parser.error('--replica starts its own primary and standby; use --replica-url with --database-url')
+    if not database_url:
+        if not LocalPostgres.available(args.replica):
+            parser.error('no --database-url given and initdb/pg_ctl (and pg_basebackup for --replica) are not on PATH')
+        postgres = LocalPostgres()
+        database_url = postgres.start()
+        if args.replica:
+            standby = LocalPostgres()
+            replica_url = standby.start(primary=postgres)
+
+    workdir = tempfile.mkdtemp(prefix='drama-bench-')
+    app = AppProcess({
+        "DATABASE_URL": database_url,
+        "DRAMABOX_API_BASE": dramabox.url,
+        "TELEGRAM_API_BASE": telegram.url,
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_ADMIN_ID": str(ADMIN_ID),
+        "SAWERIA_STREAM_KEY": SAWERIA_KEY,
+        "DATABASE_REPLICA_URL": replica_url or '',
+        "WEB_THREADS": str(args.threads),
+    }, args.threads, os.path.join(workdir, 'app.log'))
+    try:
+        app.start()
+        _wait_for_app(app.url, app, telegram, args.startup_timeout)
+        report = asyncio.run(run_scenarios(app.url, args))
+    finally:
+        app.stop()
+        if standby:
+            standby.stop()
+        if postgres:
+            postgres.stop()
+        for server in (dramabox, media, telegram):
+            server.stop()
+
+    report["config"] = {k: (sorted(v) if isinstance(v, set) else v) for k, v in vars(args).items()
+                        if k not in ('database_url', 'replica_url', 'output', 'compare')}
+    report["upstream_calls"] = dict(dramabox.requests)
+    report["telegram_calls"] = dict(telegram.requests)
+    report["media_calls"] = dict(media.requests)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"App log: {app.log_path}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
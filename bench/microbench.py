@@ -0,0 +1,187 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+from bench.fakes import FakeDatabase, FakeResponse, load_fixture
+
+TELEGRAM_ID = 7000000001
+
+
+def _stats(samples):
+    samples = sorted(samples)
+    q1, _, q3 = statistics.quantiles(samples, n=4) if len(samples) > 1 else (samples[0],) * 3
+    mean = statistics.fmean(samples)
+    return {
+        "min": samples[0],
+        "max": samples[-1],
+        "mean": mean,
+        "stddev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "median": statistics.median(samples),
+        "iqr": q3 - q1,
+        "rounds": len(samples),
+        "ops": 1.0 / mean if mean else 0.0,
+    }
+
+
+def _run_case(fn, min_time, max_rounds, warmup):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < max_rounds and (time.perf_counter() < deadline or len(samples) < 5):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+class _StubDispatcher:
+    def __init__(self):
+        self.updates = 0
+
+    async def feed_update(self, bot, update):
+        self.updates += 1
+
+
+def build_cases(app_module, client, real_db):
+    import requests
+
+    import updates
+
+    if not real_db:
+        import services
+        fake_db = FakeDatabase()
+        app_module.get_db = fake_db.connect
+        app_module.get_read_db = fake_db.connect
+        services.get_db = fake_db.connect
+
+    allepisode = load_fixture('allepisode')
+    foryou = load_fixture('foryou')
+    upstream = {'allepisode': allepisode, 'foryou': foryou}
+
+    def fake_get(url, *args, **kwargs):
+        return FakeResponse(upstream.get(url.rsplit('/', 1)[-1], foryou))
+
+    requests.get = fake_get
+
+    from aiogram import Bot
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    app_module._bot_instance = Bot(token='100000001:MICROBENCH')
+    app_module._dp_instance = _StubDispatcher()
+    app_module._bot_loop = loop
+    app_module._update_dispatcher = updates.UpdateDispatcher(
+        loop, lambda update: app_module._dp_instance.feed_update(app_module._bot_instance, update))
+    update_ids = itertools.count(1)
+    start_update = {
+        "update_id": 1,
+        "message": {
+            "message_id": 1, "date": int(time.time()),
+            "chat": {"id": TELEGRAM_ID, "type": "private", "first_name": "Bench"},
+            "from": {"id": TELEGRAM_ID, "is_bot": False, "first_name": "Bench"},
+            "text": "/start", "entities": [{"offset": 0, "length": 6, "type": "bot_command"}],
+        },
+    }
+
+    def check(resp):
+        # Read and close the body like a WSGI server would; streamed responses release their admission slot on close
+        body = resp.get_data(as_text=True)
+        resp.close()
+        if resp.status_code >= 500:
+            raise RuntimeError(f"{resp.request.path} -> {resp.status_code}: {body[:200]}")
+        return resp
+
+    import services
+    # A VIP token: the path where /api/episode/access answers from the token alone
+    token = services.entitlement_token({"telegram_id": TELEGRAM_ID, "membership": "VIP", "membership_expires_at": None,
+                                        "referral_access_expires_at": None, "entitlement_version": 0})['token']
+
+    return {
+        'check_episode_access': lambda: check(client.post(
+            '/api/episode/access', json={"telegram_id": TELEGRAM_ID, "episode_index": 12})),
+        'check_episode_access_token': lambda: check(client.post(
+            '/api/episode/access', json={"telegram_id": TELEGRAM_ID, "episode_index": 12, "token": token})),
+        'get_user': lambda: check(client.get(f"/api/user/{TELEGRAM_ID}")),
+        'add_history': lambda: check(client.post('/api/history', json={
+            "telegram_id": TELEGRAM_ID, "book_id": "41000", "title": "Drama Bench",
+            "cover_url": "https://cover.example/1.jpg", "episode_number": "EP 3"})),
+        'get_favorites': lambda: check(client.get(f"/api/favorites/{TELEGRAM_ID}")),
+        'monthly_stats': lambda: check(client.get('/api/stats/monthly')),
+        'proxy_api_allepisode': lambda: check(client.get('/api/proxy/allepisode?bookId=41000')),
+        'proxy_api_foryou': lambda: check(client.get('/api/proxy/foryou?page=1')),
+        'telegram_webhook': lambda: check(client.post('/webhook', json={**start_update, "update_id": next(update_ids)})),
+    }
+
+
+def _commit_info():
+    try:
+        sha = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain'], capture_output=True, text=True).stdout.strip())
+        return {"id": sha, "dirty": dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='In-process microbenchmarks of hot Flask handlers.')
+    parser.add_argument('-k', dest='select', help='Only run cases whose name contains this string')
+    parser.add_argument('--min-time', type=float, default=1.0, help='Seconds to sample each case')
+    parser.add_argument('--max-rounds', type=int, default=100000)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--real-db', action='store_true', help='Use DATABASE_URL instead of the fake database')
+    parser.add_argument('--json', dest='output', help='Write pytest-benchmark compatible JSON here')
+    parser.add_argument('--compare', help='Earlier JSON output to diff medians against')
+    args = parser.parse_args()
+
+    import logging
+    import app as app_module
+    devnull = open(os.devnull, 'w')
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.setStream(devnull)
+    client = app_module.app.test_client()
+    cases = build_cases(app_module, client, args.real_db)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {b["name"]: b["stats"] for b in json.load(f)["benchmarks"]}
+
+    results = []
+    print(f"{'name':26} {'median us':>10} {'mean us':>10} {'stddev':>9} {'ops/s':>10} {'rounds':>8}")
+    for name, fn in cases.items():
+        if args.select and args.select not in name:
+            continue
+        stats = _stats(_run_case(fn, args.min_time, args.max_rounds, args.warmup))
+        results.append({"group": "handlers", "name": name, "fullname": f"bench/microbench.py::{name}", "stats": stats})
+        line = (f"{name:26} {stats['median'] * 1e6:>10.1f} {stats['mean'] * 1e6:>10.1f} "
+                f"{stats['stddev'] * 1e6:>9.1f} {stats['ops']:>10.0f} {stats['rounds']:>8}")
+        if name in baseline:
+            line += f"  median {100 * (stats['median'] - baseline[name]['median']) / baseline[name]['median']:+.1f}%"
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                "machine_info": {"node": platform.node(), "machine": platform.machine(),
+                                 "python_version": platform.python_version(), "system": platform.system()},
+                "commit_info": _commit_info(),
+                "datetime": datetime.utcnow().isoformat(),
+                "version": "microbench-1",
+                "options": {"min_time": args.min_time, "warmup": args.warmup, "real_db": args.real_db},
+                "benchmarks": results,
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
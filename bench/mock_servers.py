@@ -0,0 +1,245 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+ENDPOINT_FIXTURES = {
+    'foryou': 'foryou',
+    'latest': 'foryou',
+    'trending': 'foryou',
+    'dubindo': 'foryou',
+    'randomdrama': 'foryou',
+    'vip': 'foryou',
+    'search': 'search',
+    'populersearch': 'search',
+    'detail': 'detail',
+    'allepisode': 'allepisode',
+}
+
+
+class _QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+
+class MockServer:
+    handler_class = _Handler
+
+    def __init__(self, host='127.0.0.1', port=0):
+        server = self
+        handler = type(self.handler_class.__name__, (self.handler_class,), {'mock': server})
+        self.httpd = _QuietServer((host, port), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _DramaBoxHandler(_Handler):
+    def do_GET(self):
+        mock = self.mock
+        parts = urlsplit(self.path)
+        endpoint = parts.path.rstrip('/').rsplit('/', 1)[-1]
+        mock.requests[endpoint] += 1
+        mock.sleep()
+        if random.random() < mock.error_rate:
+            return self._send(random.choice((500, 502, 503)), b'{"error": "injected"}')
+        fixture = mock.fixtures.get(ENDPOINT_FIXTURES.get(endpoint))
+        if fixture is None:
+            return self._send(404, b'{"error": "not found"}')
+        query = parse_qs(parts.query)
+        body = (fixture
+                .replace('{BOOK_ID}', query.get('bookId', ['41000'])[0])
+                .replace('{PAGE}', query.get('page', ['1'])[0][:3])
+                .replace('{MEDIA_ORIGIN}', mock.media_origin))
+        self._send(200, body.encode('utf-8'))
+
+
+class DramaBoxMock(MockServer):
+    handler_class = _DramaBoxHandler
+
+    def __init__(self, media_origin, latency_ms=80, jitter_ms=40, error_rate=0.0, fixtures_dir=FIXTURES_DIR, **kwargs):
+        super().__init__(**kwargs)
+        self.media_origin = media_origin
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.requests = Counter()
+        self.fixtures = {}
+        for name in set(ENDPOINT_FIXTURES.values()):
+            with open(os.path.join(fixtures_dir, f"{name}.json"), encoding='utf-8') as f:
+                self.fixtures[name] = f.read()
+
+    def sleep(self):
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+
+class _MediaHandler(_Handler):
+    def do_GET(self):
+        mock = self.mock
+        path = urlsplit(self.path).path
+        mock.requests['video' if path.endswith('.mp4') else 'image'] += 1
+        if mock.latency_ms:
+            time.sleep(mock.latency_ms / 1000)
+        if path.endswith('.mp4'):
+            return self._send_video()
+        seed = hashlib.sha256(path.encode()).digest()
+        body = b'\xff\xd8\xff\xe0' + seed * (mock.image_bytes // len(seed)) + b'\xff\xd9'
+        self._send(200, body, 'image/jpeg')
+
+    do_HEAD = do_GET
+
+    def _send_video(self):
+        size = self.mock.video_bytes
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if not match:
+            return self._send(200, b'\0' * size, 'video/mp4', {'Accept-Ranges': 'bytes'})
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        self._send(206, b'\0' * (end - start + 1), 'video/mp4', {
+            'Accept-Ranges': 'bytes',
+            'Content-Range': f"bytes {start}-{end}/{size}",
+        })
+
+
+class MediaOriginMock(MockServer):
+    handler_class = _MediaHandler
+
+    def __init__(self, latency_ms=30, image_bytes=32 * 1024, video_bytes=2 * 1024 * 1024, **kwargs):
+        super().__init__(**kwargs)
+        self.latency_ms = latency_ms
+        self.image_bytes = image_bytes
+        self.video_bytes = video_bytes
+        self.requests = Counter()
+
+
+class _TelegramHandler(_Handler):
+    def do_POST(self):
+        self._handle(self._read_body())
+
+    def do_GET(self):
+        self._handle(b'')
+
+    def _handle(self, body):
+        mock = self.mock
+        match = re.match(r'/bot[^/]+/(\w+)', urlsplit(self.path).path)
+        if not match:
+            return self._send(404, b'{"ok": false, "error_code": 404, "description": "Not Found"}')
+        method = match.group(1)
+        with mock.lock:
+            mock.requests[method] += 1
+            if method == 'setWebhook':
+                mock.webhook_set.set()
+        if mock.latency_ms:
+            time.sleep(mock.latency_ms / 1000)
+        result = mock.result_for(method, self._chat_id(body))
+        self._send(200, json.dumps({"ok": True, "result": result}).encode('utf-8'))
+
+    def _chat_id(self, body):
+        if not body:
+            return 1
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            try:
+                return int(json.loads(body).get('chat_id', 1))
+            except (ValueError, TypeError, AttributeError):
+                return 1
+        match = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+        return int(match.group(1)) if match else 1
+
+
+class TelegramMock(MockServer):
+    handler_class = _TelegramHandler
+
+    def __init__(self, latency_ms=40, bot_username='bench_drama_bot', **kwargs):
+        super().__init__(**kwargs)
+        self.latency_ms = latency_ms
+        self.bot_username = bot_username
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.webhook_set = threading.Event()
+        self._message_id = 0
+
+    def result_for(self, method, chat_id):
+        now = int(time.time())
+        if method == 'getMe':
+            return {"id": 100000001, "is_bot": True, "first_name": "Bench", "username": self.bot_username}
+        if method == 'getWebhookInfo':
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == 'getUserProfilePhotos':
+            return {"total_count": 0, "photos": []}
+        if method == 'getFile':
+            return {"file_id": "bench", "file_unique_id": "bench", "file_path": "photos/bench.jpg"}
+        if method.startswith('send'):
+            with self.lock:
+                self._message_id += 1
+                message_id = self._message_id
+            return {"message_id": message_id, "date": now, "chat": {"id": chat_id, "type": "private"}}
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the DramaBox, media and Telegram stand-ins.')
+    parser.add_argument('--latency-ms', type=int, default=80, help='DramaBox API latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of DramaBox calls answered with 5xx')
+    parser.add_argument('--dramabox-port', type=int, default=18081)
+    parser.add_argument('--media-port', type=int, default=18082)
+    parser.add_argument('--telegram-port', type=int, default=18083)
+    args = parser.parse_args()
+
+    media = MediaOriginMock(port=args.media_port).start()
+    dramabox = DramaBoxMock(media.url, latency_ms=args.latency_ms, error_rate=args.error_rate, port=args.dramabox_port).start()
+    telegram = TelegramMock(port=args.telegram_port).start()
+    print(f"DRAMABOX_API_BASE={dramabox.url}")
+    print(f"TELEGRAM_API_BASE={telegram.url}")
+    print(f"media origin: {media.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import json
+import os
+import re
+
+import requests
+
+from bench.mock_servers import FIXTURES_DIR
+
+DEFAULT_API_BASE = 'https://api.sansekai.my.id/api/dramabox'
+URL_RE = re.compile(r'https?://([^/"\s]+)')
+
+
+def _templatize(text, book_id=None):
+    text = URL_RE.sub(lambda m: '{MEDIA_ORIGIN}/' + m.group(1), text)
+    if book_id:
+        text = text.replace(book_id, '{BOOK_ID}')
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record DramaBox API responses as load-test fixtures.')
+    parser.add_argument('--api-base', default=os.environ.get('DRAMABOX_API_BASE', DEFAULT_API_BASE))
+    parser.add_argument('--book-id', help='Book to record detail/allepisode for (defaults to the first foryou item)')
+    parser.add_argument('--query', default='cinta', help='Search query to record')
+    parser.add_argument('--out', default=FIXTURES_DIR)
+    args = parser.parse_args()
+
+    session = requests.Session()
+
+    def fetch(endpoint, **params):
+        resp = session.get(f"{args.api_base.rstrip('/')}/{endpoint}", params=params, timeout=30)
+        resp.raise_for_status()
+        return resp.json()
+
+    foryou = fetch('foryou', page=1)
+    book_id = args.book_id
+    if not book_id:
+        items = foryou if isinstance(foryou, list) else (foryou.get('data') or foryou.get('result') or [])
+        book_id = str(items[0].get('bookId'))
+
+    recordings = {
+        'foryou': (foryou, None),
+        'search': (fetch('search', query=args.query, page=1), None),
+        'detail': (fetch('detail', bookId=book_id), book_id),
+        'allepisode': (fetch('allepisode', bookId=book_id), book_id),
+    }
+    os.makedirs(args.out, exist_ok=True)
+    for name, (data, templated_id) in recordings.items():
+        text = _templatize(json.dumps(data, ensure_ascii=False, indent=1), templated_id)
+        with open(os.path.join(args.out, f"{name}.json"), 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        print(f"{name}: {len(text)} bytes")
+
+
+if __name__ == '__main__':
+    main()
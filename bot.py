@@ -6,7 +6,10 @@ from aiogram.filters import CommandStart
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
 from aiogram.enums import ParseMode
 
-logging.basicConfig(level=logging.INFO)
+import logs
+import services
+
+logs.configure()
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
@@ -24,30 +27,6 @@ async def start_handler(message: types.Message):
     ref_code = args[1] if len(args) > 1 else None
 
     user = message.from_user
-    avatar_url = ''
-    try:
-        if bot:
-            photos = await bot.get_user_profile_photos(user.id, limit=1)
-            if photos.total_count > 0:
-                file_info = await bot.get_file(photos.photos[0][-1].file_id)
-                avatar_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-    except Exception as e:
-        logger.error(f"Failed to get profile photo: {e}")
-
-    if WEBAPP_URL:
-        try:
-            import aiohttp
-            async with aiohttp.ClientSession() as session:
-                await session.post(f"{WEBAPP_URL}/api/user", json={
-                    "telegram_id": user.id,
-                    "username": user.username or '',
-                    "first_name": user.first_name or '',
-                    "last_name": user.last_name or '',
-                    "avatar_url": avatar_url
-                })
-        except Exception as e:
-            logger.error(f"User register error: {e}")
-
     welcome_text = (
         "🎬 <b>Selamat datang di Drama China!</b>\n\n"
         "Nikmati ribuan drama China, Korea & Asia lainnya "
@@ -63,37 +42,20 @@ async def start_handler(message: types.Message):
 
     await message.answer(welcome_text, parse_mode=ParseMode.HTML, reply_markup=keyboard)
 
-    # Automatically register user if WEBAPP_URL is set
-    if WEBAPP_URL:
-        try:
-            import aiohttp
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f"{WEBAPP_URL}/api/user", json={
-                    "telegram_id": user.id,
-                    "username": user.username or '',
-                    "first_name": user.first_name or '',
-                    "last_name": user.last_name or '',
-                    "avatar_url": avatar_url
-                }) as resp:
-                    if resp.status == 200:
-                        logger.info(f"User {user.id} registered successfully via bot")
-                    else:
-                        logger.error(f"User register error: {resp.status}")
-        except Exception as e:
-            logger.error(f"User register error: {e}")
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, services.upsert_user, user.id, user.username or '',
+                                   user.first_name or '', user.last_name or '', services.avatar_path(user.id))
+        logger.info(f"User {user.id} registered via bot")
+    except Exception as e:
+        logger.error(f"User register error: {e}")
 
-    if ref_code and ref_code.startswith('ref_') and WEBAPP_URL:
+    if ref_code and ref_code.startswith('ref_'):
         try:
-            import aiohttp
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f"{WEBAPP_URL}/api/referral", json={
-                    "telegram_id": user.id,
-                    "ref_code": ref_code
-                }) as resp:
-                    if resp.status == 200:
-                        logger.info(f"Referral for {user.id} processed successfully")
-                    else:
-                        logger.error(f"Referral error: {resp.status}")
+            result = await loop.run_in_executor(None, services.credit_referral, user.id, ref_code)
+            logger.info(f"Referral for {user.id}: {result['status']}")
+        except services.ReferralError as e:
+            logger.info(f"Referral {ref_code} for {user.id} not credited: {e}")
         except Exception as e:
             logger.error(f"Referral error: {e}")
 
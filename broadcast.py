@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import threading
+from collections import Counter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RECIPIENTS_SQL = """
+    SELECT telegram_id FROM users
+    WHERE notifications_enabled
+      AND telegram_id > %(after)s
+      AND (%(language)s::text IS NULL OR language = %(language)s)
+    ORDER BY telegram_id
+"""
+
+CLAIM_NEXT_SQL = """
+    UPDATE broadcasts SET
+        status = 'running',
+        started_at = COALESCE(started_at, CURRENT_TIMESTAMP),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = (
+        SELECT id FROM broadcasts
+        WHERE status IN ('pending', 'running')
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *
+"""
+
+CHECKPOINT_SQL = """
+    UPDATE broadcasts SET
+        last_telegram_id = %(last_telegram_id)s,
+        sent = sent + %(sent)s,
+        failed = failed + %(failed)s,
+        blocked = blocked + %(blocked)s,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = %(id)s
+    RETURNING status
+"""
+
+FINISH_SQL = """
+    UPDATE broadcasts SET status = %(status)s, finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+    WHERE id = %(id)s AND status = 'running'
+"""
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            slot = max(now, self._next, self._paused_until)
+            self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds):
+        until = asyncio.get_running_loop().time() + seconds
+        self._paused_until = max(self._paused_until, until)
+
+
+class BroadcastWorker:
+    def __init__(self, get_db, make_bot, rate=25, concurrency=8, chunk_size=100, max_attempts=3):
+        self.get_db = get_db
+        self.make_bot = make_bot
+        self.rate = rate
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def kick(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return False
+            self._thread = threading.Thread(target=self._run, name='broadcast-worker', daemon=True)
+            self._thread.start()
+            return True
+
+    def _run(self):
+        while True:
+            try:
+                broadcast = self._claim_next()
+            except Exception as e:
+                logger.error(f"Broadcast claim error: {e}")
+                return
+            if not broadcast:
+                return
+            logger.info(f"Broadcast #{broadcast['id']} running from telegram_id > {broadcast['last_telegram_id']}")
+            try:
+                status = asyncio.run(self._run_broadcast(broadcast))
+            except Exception as e:
+                logger.error(f"Broadcast #{broadcast['id']} failed: {e}")
+                status = 'failed'
+            self._execute(FINISH_SQL, {"id": broadcast['id'], "status": status})
+            logger.info(f"Broadcast #{broadcast['id']} finished with status {status}")
+
+    def _claim_next(self):
+        conn = self.get_db()
+        cur = conn.cursor()
+        try:
+            cur.execute(CLAIM_NEXT_SQL)
+            row = cur.fetchone()
+            conn.commit()
+            return row
+        finally:
+            cur.close()
+            conn.close()
+
+    def _execute(self, sql, params):
+        conn = self.get_db()
+        cur = conn.cursor()
+        try:
+            cur.execute(sql, params)
+            row = cur.fetchone() if cur.description else None
+            conn.commit()
+            return row
+        finally:
+            cur.close()
+            conn.close()
+
+    async def _send_one(self, bot, limiter, semaphore, chat_id, text):
+        from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+        async with semaphore:
+            for attempt in range(1, self.max_attempts + 1):
+                await limiter.wait()
+                try:
+                    await bot.send_message(chat_id, text, parse_mode='HTML', disable_web_page_preview=True)
+                    return 'sent'
+                except TelegramRetryAfter as e:
+                    logger.warning(f"Broadcast rate limited by Telegram, pausing {e.retry_after}s")
+                    limiter.pause(e.retry_after)
+                except TelegramForbiddenError:
+                    return 'blocked'
+                except TelegramBadRequest:
+                    return 'failed'
+                except Exception as e:
+                    logger.warning(f"Broadcast send to {chat_id} failed (attempt {attempt}): {e}")
+                    await asyncio.sleep(attempt)
+            return 'failed'
+
+    async def _run_broadcast(self, broadcast):
+        bot = self.make_bot()
+        limiter = RateLimiter(self.rate)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        reader = self.get_db()
+        cur = reader.cursor(name=f"broadcast_{broadcast['id']}")
+        cur.itersize = 1000
+        try:
+            cur.execute(RECIPIENTS_SQL, {"after": broadcast['last_telegram_id'], "language": broadcast['language']})
+            while True:
+                rows = cur.fetchmany(self.chunk_size)
+                if not rows:
+                    return 'done'
+                results = await asyncio.gather(*[
+                    self._send_one(bot, limiter, semaphore, row['telegram_id'], broadcast['text'])
+                    for row in rows
+                ])
+                counts = Counter(results)
+                for result, n in counts.items():
+                    metrics.BROADCAST_MESSAGES.inc(result, amount=n)
+                checkpoint = self._execute(CHECKPOINT_SQL, {
+                    "id": broadcast['id'],
+                    "last_telegram_id": rows[-1]['telegram_id'],
+                    "sent": counts['sent'],
+                    "failed": counts['failed'],
+                    "blocked": counts['blocked'],
+                })
+                if not checkpoint or checkpoint['status'] != 'running':
+                    return checkpoint['status'] if checkpoint else 'cancelled'
+        finally:
+            cur.close()
+            reader.close()
+            await bot.session.close()
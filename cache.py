@@ -0,0 +1,44 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_bytes, ttl=None, max_item_bytes=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_item_bytes = max_item_bytes or max_bytes // 8
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            value, size, stored_at = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._items[key]
+                self._bytes -= size
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, size):
+        if size > self.max_item_bytes:
+            return False
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._items[key] = (value, size, time.monotonic())
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._items:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= evicted[1]
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._items), "bytes": self._bytes, "max_bytes": self.max_bytes}
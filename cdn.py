@@ -0,0 +1,197 @@
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Rough bitrate each quality needs to play without stalling, in kbit/s
+QUALITY_KBPS = ((1080, 4000), (720, 2000), (540, 1200), (360, 700))
+REFERENCE_BYTES = 1024 * 1024
+FAILURE_PENALTY = 5.0
+MAX_HOSTS = 32
+
+
+def episode_list(data):
+    if isinstance(data, list):
+        return data
+    if not isinstance(data, dict):
+        return []
+    for key in ('data', 'result'):
+        inner = data.get(key)
+        if isinstance(inner, list):
+            return inner
+        if isinstance(inner, dict):
+            for list_key in ('episodeList', 'list', 'episodes', 'chapterList'):
+                if isinstance(inner.get(list_key), list):
+                    return inner[list_key]
+    return []
+
+
+def _cdn_host(cdn):
+    host = cdn.get('cdnDomain')
+    if host:
+        return host
+    for path in cdn.get('videoPathList') or []:
+        if path.get('videoPath'):
+            return urlparse(path['videoPath']).netloc
+    return None
+
+
+def _required_kbps(quality):
+    for q, kbps in QUALITY_KBPS:
+        if quality >= q:
+            return kbps
+    return QUALITY_KBPS[-1][1]
+
+
+def pick_video(paths, bandwidth_kbps=None):
+    paths = [p for p in paths or [] if p.get('videoPath')]
+    if not paths:
+        return None
+    if not bandwidth_kbps:
+        return (next((p for p in paths if p.get('isDefault') == 1), None) or
+                next((p for p in paths if p.get('quality') == 720), None) or
+                next((p for p in paths if p.get('quality') == 540), None) or
+                paths[0])
+    by_quality = sorted(paths, key=lambda p: p.get('quality') or 0, reverse=True)
+    budget = bandwidth_kbps * 0.75
+    for path in by_quality:
+        if _required_kbps(path.get('quality') or 0) <= budget:
+            return path
+    return by_quality[-1]
+
+
+class CdnRanker:
+    def __init__(self, probe_interval=300, probe_bytes=64 * 1024, timeout=5, alpha=0.3):
+        self.probe_interval = probe_interval
+        self.probe_bytes = probe_bytes
+        self.timeout = timeout
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._wake = threading.Event()
+        self._thread = None
+
+    def observe(self, episodes):
+        added = False
+        with self._lock:
+            for ep in episodes:
+                for cdn in ep.get('cdnList') or []:
+                    host = _cdn_host(cdn)
+                    sample = pick_video(cdn.get('videoPathList'))
+                    if not host or not sample:
+                        continue
+                    state = self._hosts.get(host)
+                    if state is None:
+                        if len(self._hosts) >= MAX_HOSTS:
+                            continue
+                        state = self._hosts[host] = {"ttfb": None, "throughput": None, "failures": 0, "probed_at": 0.0}
+                        added = True
+                    state["sample"] = sample['videoPath']
+        if added:
+            self._ensure_thread()
+            self._wake.set()
+
+    def score(self, host):
+        with self._lock:
+            state = self._hosts.get(host)
+            if not state or state["ttfb"] is None:
+                return None
+            return (state["ttfb"] + REFERENCE_BYTES / max(state["throughput"], 1.0) +
+                    FAILURE_PENALTY * state["failures"])
+
+    def host_kbps(self, host):
+        with self._lock:
+            state = self._hosts.get(host)
+            if not state or not state["throughput"] or state["failures"]:
+                return None
+            return state["throughput"] * 8 / 1000
+
+    def rank(self, data, bandwidth_kbps=None):
+        episodes = episode_list(data)
+        self.observe(episodes)
+        for ep in episodes:
+            cdns = ep.get('cdnList')
+            if not isinstance(cdns, list) or not cdns:
+                continue
+            scored = []
+            for position, cdn in enumerate(cdns):
+                score = self.score(_cdn_host(cdn))
+                default_rank = 0 if cdn.get('isDefault') == 1 else 1
+                scored.append(((score is None, score or 0.0, default_rank, position), cdn))
+            scored.sort(key=lambda item: item[0])
+            ep['cdnList'] = [cdn for _, cdn in scored]
+            urls = []
+            for cdn in ep['cdnList']:
+                kbps = bandwidth_kbps
+                host_kbps = self.host_kbps(_cdn_host(cdn))
+                if kbps and host_kbps:
+                    kbps = min(kbps, host_kbps)
+                video = pick_video(cdn.get('videoPathList'), kbps)
+                if video and video['videoPath'] not in urls:
+                    urls.append(video['videoPath'])
+            if urls and not (ep.get('videoUrl') or ep.get('url') or ep.get('video') or ep.get('playUrl')):
+                ep['videoUrl'] = urls[0]
+                ep['videoUrls'] = urls
+        return data
+
+    def snapshot(self):
+        with self._lock:
+            return {host: {k: v for k, v in state.items() if k != 'sample'} for host, state in self._hosts.items()}
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='cdn-prober', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                due = [(host, state["sample"]) for host, state in self._hosts.items()
+                       if now - state["probed_at"] >= self.probe_interval]
+            for host, url in due:
+                self._probe(host, url)
+            self._wake.wait(self.probe_interval)
+            self._wake.clear()
+
+    def _probe(self, host, url):
+        start = time.perf_counter()
+        try:
+            with requests.get(url, headers={'Range': f"bytes=0-{self.probe_bytes - 1}"},
+                              stream=True, timeout=self.timeout) as resp:
+                ttfb = time.perf_counter() - start
+                if resp.status_code not in (200, 206):
+                    raise ValueError(f"HTTP {resp.status_code}")
+                received = 0
+                body_start = time.perf_counter()
+                for chunk in resp.iter_content(16384):
+                    received += len(chunk)
+                    if received >= self.probe_bytes:
+                        break
+                throughput = received / max(time.perf_counter() - body_start, 1e-3)
+        except Exception as e:
+            logger.warning(f"CDN probe {host} failed: {e}")
+            with self._lock:
+                state = self._hosts[host]
+                state["failures"] += 1
+                state["probed_at"] = time.monotonic()
+            return
+        with self._lock:
+            state = self._hosts[host]
+            if state["ttfb"] is None:
+                state["ttfb"], state["throughput"] = ttfb, throughput
+            else:
+                state["ttfb"] += self.alpha * (ttfb - state["ttfb"])
+                state["throughput"] += self.alpha * (throughput - state["throughput"])
+            state["failures"] = 0
+            state["probed_at"] = time.monotonic()
+        metrics.CDN_TTFB.set(state["ttfb"], host)
+        metrics.CDN_THROUGHPUT.set(state["throughput"], host)
@@ -0,0 +1,314 @@
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor
+
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+REPLICA_URLS = [u.strip() for u in os.environ.get('DATABASE_REPLICA_URL', '').split(',') if u.strip()]
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 5))
+REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', 5))
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 10))
+MAX_STICKY_USERS = 50000
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_POOL_IDLE_SECONDS = 300
+# Connections idle longer than this are pinged on checkout; the server may have dropped them
+# (Neon autosuspend, idle timeouts, a restart) without the client noticing
+DB_POOL_PING_SECONDS = 5
+# Transaction-mode poolers (PgBouncer, Neon's -pooler endpoints) hand each transaction a different
+# server session, so a PREPAREd statement may not exist when it is EXECUTEd. 0 runs the plain SQL.
+DB_PREPARED_STATEMENTS = os.environ.get('DB_PREPARED_STATEMENTS', '1') != '0'
+
+# 0 when the server is not a standby (a plain second instance) or has replayed everything it received
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END AS lag
+"""
+
+class _InstrumentedCursor(RealDictCursor):
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.DB_QUERY_LATENCY.observe(elapsed)
+            tracing.record('db.query', start, elapsed)
+
+class _InstrumentedConnection(psycopg2.extensions.connection):
+    pool = None
+    generation = 0
+
+    def close(self):
+        # Pooled connections go back to their pool; close() only disconnects when the pool is full
+        if self.pool is not None and self.pool.put(self):
+            return
+        self.disconnect()
+
+    def disconnect(self):
+        # closed is already set when psycopg2 noticed a dropped connection, so track the gauge separately
+        if getattr(self, 'counted', False):
+            self.counted = False
+            metrics.DB_CONNECTIONS_OPEN.dec()
+        super().close()
+
+def _connect(url, **kwargs):
+    start = time.perf_counter()
+    conn = psycopg2.connect(url, connection_factory=_InstrumentedConnection, cursor_factory=_InstrumentedCursor, **kwargs)
+    elapsed = time.perf_counter() - start
+    metrics.DB_CONNECT_LATENCY.observe(elapsed)
+    tracing.record('db.connect', start, elapsed)
+    metrics.DB_CONNECTIONS_OPENED.inc()
+    metrics.DB_CONNECTIONS_OPEN.inc()
+    conn.counted = True
+    conn.prepared = set()
+    return conn
+
+def _alive(conn):
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+class _Pool:
+    def __init__(self, url, size, **connect_kwargs):
+        self.url = url
+        self.size = size
+        self.connect_kwargs = connect_kwargs
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def get(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                candidate, idle_since = self._idle.pop()
+            idle = time.monotonic() - idle_since
+            if candidate.closed or idle > DB_POOL_IDLE_SECONDS:
+                candidate.disconnect()
+                continue
+            if idle > DB_POOL_PING_SECONDS and not _alive(candidate):
+                metrics.DB_POOL_CHECKOUTS.inc('dead')
+                candidate.disconnect()
+                continue
+            metrics.DB_POOL_CHECKOUTS.inc('reused')
+            return candidate
+        metrics.DB_POOL_CHECKOUTS.inc('new')
+        conn = _connect(self.url, **self.connect_kwargs)
+        conn.pool = self
+        conn.generation = self.generation
+        return conn
+
+    def put(self, conn):
+        if conn.closed or conn.generation != self.generation:
+            return False
+        try:
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            return False
+        with self._lock:
+            if len(self._idle) >= self.size:
+                return False
+            self._idle.append((conn, time.monotonic()))
+        return True
+
+    def reset(self):
+        with self._lock:
+            self.generation += 1
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.disconnect()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _pool(url, **connect_kwargs):
+    with _pools_lock:
+        pool = _pools.get(url)
+        if pool is None:
+            pool = _pools[url] = _Pool(url, DB_POOL_SIZE, **connect_kwargs)
+        return pool
+
+def reset_pools():
+    # Called after DDL so no pooled session keeps plans or prepared statements for the old schema
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.reset()
+
+def get_db():
+    return _pool(DATABASE_URL).get()
+
+# name -> (parameter types, SQL using $1..$n, the same SQL with psycopg2 placeholders);
+# prepared lazily once per pooled connection
+PREPARED = {}
+
+def _plain_sql(types, sql):
+    # $n -> %(pn)s::type, so parameters keep the types PREPARE would have given them
+    return re.sub(r'\$(\d+)', lambda m: f"%(p{m.group(1)})s::{types[int(m.group(1)) - 1]}", sql.replace('%', '%%'))
+
+def prepare(name, types, sql):
+    PREPARED[name] = (tuple(types), sql, _plain_sql(types, sql))
+    return name
+
+def _execute(cur, name, types, sql, params):
+    conn = cur.connection
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} ({', '.join(types)}) AS {sql}")
+        conn.prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f"EXECUTE {name}", params)
+
+def execute_prepared(cur, name, params=()):
+    types, sql, plain = PREPARED[name]
+    conn = cur.connection
+    start = time.perf_counter()
+    if not DB_PREPARED_STATEMENTS:
+        cur.execute(plain, {f"p{i}": value for i, value in enumerate(params, 1)})
+    else:
+        # Nothing has run in this transaction yet, so it can be rolled back and retried safely
+        fresh = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        try:
+            _execute(cur, name, types, sql, params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # The server session lost our statements (a pooler switched sessions, or it was reset)
+            logger.warning(f"Prepared statement {name} missing on the server, preparing again")
+            conn.prepared.clear()
+            if not fresh:
+                raise
+            conn.rollback()
+            _execute(cur, name, types, sql, params)
+        except psycopg2.errors.DuplicatePreparedStatement:
+            # Another client of the pooler already prepared it in this server session
+            conn.prepared.add(name)
+            if not fresh:
+                raise
+            conn.rollback()
+            _execute(cur, name, types, sql, params)
+    metrics.DB_STATEMENT_LATENCY.observe(time.perf_counter() - start, name)
+
+_lock = threading.Lock()
+_sticky_until = {}
+_replica_state = {url: {"healthy": True, "lag": 0.0, "checked_at": 0.0} for url in REPLICA_URLS}
+_replica_cycle = itertools.cycle(REPLICA_URLS)
+
+def _replica_label(url):
+    parsed = urlparse(url)
+    return f"{parsed.hostname}:{parsed.port or 5432}"
+
+def _user_key(telegram_id):
+    try:
+        return int(telegram_id)
+    except (TypeError, ValueError):
+        return None
+
+def note_write(telegram_id):
+    # Reads for this user go to the primary for a while so they see their own write
+    telegram_id = _user_key(telegram_id)
+    if not REPLICA_URLS or telegram_id is None:
+        return
+    now = time.monotonic()
+    with _lock:
+        if len(_sticky_until) >= MAX_STICKY_USERS:
+            for key in [k for k, until in _sticky_until.items() if until <= now]:
+                del _sticky_until[key]
+            if len(_sticky_until) >= MAX_STICKY_USERS:
+                _sticky_until.clear()
+        _sticky_until[telegram_id] = now + READ_YOUR_WRITES_SECONDS
+
+def _is_sticky(telegram_id):
+    telegram_id = _user_key(telegram_id)
+    if telegram_id is None:
+        return False
+    with _lock:
+        until = _sticky_until.get(telegram_id)
+    return until is not None and until > time.monotonic()
+
+def _pick_replica():
+    now = time.monotonic()
+    with _lock:
+        for _ in range(len(REPLICA_URLS)):
+            url = next(_replica_cycle)
+            state = _replica_state[url]
+            due = now - state["checked_at"] >= REPLICA_CHECK_SECONDS
+            if state["healthy"] or due:
+                return url, due
+    return None, False
+
+def _mark_replica(url, healthy, lag=None):
+    with _lock:
+        state = _replica_state[url]
+        if state["healthy"] != healthy:
+            logger.warning(f"Replica {_replica_label(url)} {'back in rotation' if healthy else 'taken out of rotation'}"
+                           + (f" (lag {lag:.1f}s)" if lag is not None else ""))
+        state["healthy"] = healthy
+        state["checked_at"] = time.monotonic()
+        if lag is not None:
+            state["lag"] = lag
+    if lag is not None:
+        metrics.DB_REPLICA_LAG.set(lag, _replica_label(url))
+
+def get_read_db(telegram_id=None):
+    if not REPLICA_URLS:
+        return get_db()
+    if _is_sticky(telegram_id):
+        metrics.DB_READS.inc('primary_sticky')
+        return get_db()
+    url, check = _pick_replica()
+    if url is None:
+        metrics.DB_READS.inc('primary_fallback')
+        return get_db()
+    try:
+        conn = _pool(url, connect_timeout=2).get()
+    except psycopg2.OperationalError as e:
+        logger.warning(f"Replica {_replica_label(url)} unavailable: {e}")
+        _mark_replica(url, False)
+        metrics.DB_READS.inc('primary_fallback')
+        return get_db()
+    if check:
+        try:
+            cur = conn.cursor()
+            cur.execute(REPLICA_LAG_SQL)
+            lag = float(cur.fetchone()['lag'])
+            cur.close()
+            conn.rollback()
+        except psycopg2.Error as e:
+            logger.warning(f"Replica {_replica_label(url)} lag check failed: {e}")
+            conn.close()
+            _mark_replica(url, False)
+            metrics.DB_READS.inc('primary_fallback')
+            return get_db()
+        _mark_replica(url, lag <= REPLICA_MAX_LAG_SECONDS, lag)
+        if lag > REPLICA_MAX_LAG_SECONDS:
+            conn.close()
+            metrics.DB_READS.inc('primary_fallback')
+            return get_db()
+    metrics.DB_READS.inc('replica')
+    return conn
+
+def replica_status():
+    now = time.monotonic()
+    with _lock:
+        return {_replica_label(url): {"healthy": state["healthy"], "lag": round(state["lag"], 3),
+                                      "checked_seconds_ago": round(now - state["checked_at"], 1) if state["checked_at"] else None}
+                for url, state in _replica_state.items()}
@@ -0,0 +1,157 @@
+import gzip
+import logging
+import os
+import re
+import threading
+import time
+from datetime import date
+
+from db import get_db
+
+logger = logging.getLogger(__name__)
+
+PARENT = 'watch_history_log'
+PARTITION_RE = re.compile(rf'^{PARENT}_(\d{{4}})(\d{{2}})$')
+
+# watch_history used to be one upserted row per (user, book). It is now an append-only log
+# range-partitioned by month; the watch_history view keeps the latest row per (user, book) so
+# readers are unchanged. Existing rows land in the default partition and are moved into monthly
+# partitions by ensure_partitions() on the next maintenance run.
+SCHEMA_SQL = f"""
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'watch_history' AND relkind = 'r') THEN
+            ALTER TABLE watch_history RENAME TO watch_history_legacy;
+        END IF;
+    END $$;
+    CREATE TABLE IF NOT EXISTS {PARENT} (
+        id BIGSERIAL,
+        telegram_id BIGINT NOT NULL,
+        book_id VARCHAR(255) NOT NULL,
+        title VARCHAR(500),
+        cover_url TEXT,
+        episode_number VARCHAR(100),
+        watched_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    ) PARTITION BY RANGE (watched_at);
+    CREATE TABLE IF NOT EXISTS {PARENT}_default PARTITION OF {PARENT} DEFAULT;
+    CREATE INDEX IF NOT EXISTS idx_{PARENT}_user ON {PARENT} (telegram_id, book_id, watched_at DESC);
+    DO $$
+    BEGIN
+        IF to_regclass('watch_history_legacy') IS NOT NULL THEN
+            INSERT INTO {PARENT} (telegram_id, book_id, title, cover_url, episode_number, watched_at)
+            SELECT telegram_id, book_id, title, cover_url, episode_number, COALESCE(watched_at, CURRENT_TIMESTAMP)
+            FROM watch_history_legacy;
+            DROP TABLE watch_history_legacy;
+        END IF;
+    END $$;
+    CREATE OR REPLACE VIEW watch_history AS
+        SELECT DISTINCT ON (telegram_id, book_id) id, telegram_id, book_id, title, cover_url, episode_number, watched_at
+        FROM {PARENT}
+        ORDER BY telegram_id, book_id, watched_at DESC;
+"""
+
+LIST_PARTITIONS_SQL = f"""
+    SELECT c.relname FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = '{PARENT}'::regclass
+"""
+
+DEFAULT_MONTHS_SQL = f"SELECT DISTINCT date_trunc('month', watched_at)::date AS month FROM {PARENT}_default"
+
+
+def _month_add(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _partition_name(month):
+    return f"{PARENT}_{month.year:04d}{month.month:02d}"
+
+
+def _create_partition(cur, month):
+    name = _partition_name(month)
+    start, end = month, _month_add(month, 1)
+    # Rows for this month may already sit in the default partition; move them before attaching,
+    # otherwise ATTACH fails on the default partition's constraint check.
+    cur.execute(f"CREATE TABLE {name} (LIKE {PARENT} INCLUDING DEFAULTS)")
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM {PARENT}_default WHERE watched_at >= %s AND watched_at < %s RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """, (start, end))
+    moved = cur.rowcount
+    cur.execute(f"ALTER TABLE {PARENT} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (start, end))
+    logger.info(f"Created partition {name} ({moved} rows moved from default)")
+
+
+def ensure_partitions(months_ahead=2):
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute(LIST_PARTITIONS_SQL)
+        existing = {row['relname'] for row in cur.fetchall()}
+        cur.execute(DEFAULT_MONTHS_SQL)
+        months = {row['month'] for row in cur.fetchall()}
+        this_month = date.today().replace(day=1)
+        months.update(_month_add(this_month, n) for n in range(months_ahead + 1))
+        for month in sorted(months):
+            if _partition_name(month) not in existing:
+                _create_partition(cur, month)
+                conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def archive_partitions(retention_months, archive_dir):
+    cutoff = _month_add(date.today().replace(day=1), -retention_months)
+    os.makedirs(archive_dir, exist_ok=True)
+    conn = get_db()
+    cur = conn.cursor()
+    archived = []
+    try:
+        cur.execute(LIST_PARTITIONS_SQL)
+        for name in sorted(row['relname'] for row in cur.fetchall()):
+            match = PARTITION_RE.match(name)
+            if not match or date(int(match.group(1)), int(match.group(2)), 1) >= cutoff:
+                continue
+            path = os.path.join(archive_dir, f"{name}.csv.gz")
+            # Detach, dump and drop in one transaction so a failed dump leaves the partition attached
+            cur.execute(f"ALTER TABLE {PARENT} DETACH PARTITION {name}")
+            with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+                cur.copy_expert(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+            os.replace(path + '.tmp', path)
+            cur.execute(f"DROP TABLE {name}")
+            conn.commit()
+            archived.append(name)
+            logger.info(f"Archived partition {name} to {path}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    return archived
+
+
+def _maintenance_loop(interval, retention_months, archive_dir):
+    while True:
+        try:
+            ensure_partitions()
+            if retention_months > 0:
+                archive_partitions(retention_months, archive_dir)
+        except Exception as e:
+            logger.error(f"Watch history maintenance error: {e}")
+        time.sleep(interval)
+
+
+def start_maintenance(retention_months, archive_dir, interval=86400):
+    thread = threading.Thread(target=_maintenance_loop, args=(interval, retention_months, archive_dir),
+                              name='history-maintenance', daemon=True)
+    thread.start()
+    logger.info(f"Watch history maintenance started (retention {retention_months} months, archive {archive_dir})")
+    return thread
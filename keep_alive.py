@@ -20,7 +20,7 @@ def ping_self():
     while True:
         try:
             resp = requests.get(url, timeout=30)
-            logger.debug(f"Keep-alive ping: {resp.status_code}")
+            logger.debug("Keep-alive ping: %s", resp.status_code)
         except Exception as e:
             logger.warning(f"Keep-alive ping failed: {e}")
         time.sleep(PING_INTERVAL)
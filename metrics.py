@@ -0,0 +1,220 @@
+import threading
+import time
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labels}")
+        return tuple(str(v) for v in labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in sorted(items):
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][idx] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def _render_sample(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            le = f'le="{_format_value(float(bound))}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = [(k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()]
+        for key, state in sorted(items):
+            lines.extend(self._render_sample(key, state))
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+HTTP_REQUESTS = registry.counter(
+    'http_requests_total', 'HTTP requests handled, by route.', ('method', 'route', 'status'))
+HTTP_LATENCY = registry.histogram(
+    'http_request_duration_seconds', 'HTTP request latency, by route.', ('method', 'route'))
+UPSTREAM_REQUESTS = registry.counter(
+    'upstream_requests_total', 'DramaBox API calls, by endpoint and status.', ('endpoint', 'status'))
+UPSTREAM_LATENCY = registry.histogram(
+    'upstream_request_duration_seconds', 'DramaBox API latency, by endpoint.', ('endpoint',))
+IMGPROXY_BYTES = registry.counter(
+    'imgproxy_bytes_total', 'Bytes served by the image proxy.', ('source',))
+CACHE_LOOKUPS = registry.counter(
+    'cache_lookups_total', 'In-process cache lookups, by cache and result.', ('cache', 'result'))
+DB_QUERY_LATENCY = registry.histogram(
+    'db_query_duration_seconds', 'Time spent in cursor.execute.', ())
+DB_CONNECT_LATENCY = registry.histogram(
+    'db_connect_duration_seconds', 'Time spent opening a database connection.', ())
+DB_CONNECTIONS_OPENED = registry.counter(
+    'db_connections_opened_total', 'Database connections opened.', ())
+DB_CONNECTIONS_OPEN = registry.gauge(
+    'db_connections_open', 'Database connections currently open.', ())
+DB_POOL_CHECKOUTS = registry.counter(
+    'db_pool_checkouts_total', 'Pool checkouts: reused, newly opened, or idle connections found dead and discarded.', ('result',))
+DB_STATEMENT_LATENCY = registry.histogram(
+    'db_prepared_statement_duration_seconds', 'Prepared statement execution time, by statement.', ('statement',))
+DB_READS = registry.counter(
+    'db_read_connections_total', 'Read-only handler connections, by where they were routed.', ('target',))
+DB_REPLICA_LAG = registry.gauge(
+    'db_replica_lag_seconds', 'Replication lag last measured on each read replica.', ('replica',))
+TELEGRAM_LATENCY = registry.histogram(
+    'telegram_api_duration_seconds', 'Telegram Bot API call latency, by method.', ('method', 'status'))
+WEBHOOK_QUEUE_DEPTH = registry.gauge(
+    'telegram_webhook_inflight', 'Telegram updates submitted to the bot loop and not yet finished.', ())
+TELEGRAM_UPDATES = registry.counter(
+    'telegram_updates_total', 'Webhook updates, by outcome (accepted, duplicate, rejected, error).', ('result',))
+BOT_LOOP_LAG = registry.gauge(
+    'bot_loop_lag_seconds', 'Scheduling delay last measured on the bot event loop.', ())
+ENTITLEMENT_CHECKS = registry.counter(
+    'entitlement_checks_total', 'Episode access checks, by whether a signed token or the database answered.', ('source',))
+LOG_RECORDS_DROPPED = registry.counter(
+    'log_records_dropped_total', 'Log records not written, by reason (sampled, queue_full).', ('reason',))
+ADMISSION_REQUESTS = registry.counter(
+    'http_admission_total', 'Requests by route class and admission result (admitted, queued, rejected).', ('route_class', 'result'))
+ADMISSION_INFLIGHT = registry.gauge(
+    'http_admission_inflight', 'Admitted requests not yet finished, by route class.', ('route_class',))
+MEMBERSHIPS_EXPIRED = registry.counter(
+    'memberships_expired_total', 'Memberships expired by the background sweeper.', ('kind',))
+BROADCAST_MESSAGES = registry.counter(
+    'broadcast_messages_total', 'Admin broadcast deliveries, by result.', ('result',))
+CDN_TTFB = registry.gauge(
+    'cdn_probe_ttfb_seconds', 'Smoothed time to first byte of video CDN probes, by host.', ('host',))
+CDN_THROUGHPUT = registry.gauge(
+    'cdn_probe_throughput_bytes', 'Smoothed video CDN probe throughput in bytes/s, by host.', ('host',))
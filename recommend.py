@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+from db import get_db, get_read_db
+
+logger = logging.getLogger(__name__)
+
+# Item-item cosine similarity from co-occurrence in users' libraries (favorites weigh double),
+# scored against each user's own library and kept as a top-K JSON list per user.
+REBUILD_SQL = """
+    WITH events AS (
+        SELECT telegram_id, book_id, 1.0 AS weight, watched_at AS at, title, cover_url FROM watch_history
+        UNION ALL
+        SELECT telegram_id, book_id, 2.0, created_at, title, cover_url FROM favorites
+    ), interactions AS (
+        SELECT telegram_id, book_id, MAX(weight) AS weight, MAX(at) AS at
+        FROM events GROUP BY telegram_id, book_id
+    ), recent AS (
+        SELECT telegram_id, book_id, weight FROM (
+            SELECT *, row_number() OVER (PARTITION BY telegram_id ORDER BY at DESC) AS rn FROM interactions
+        ) r WHERE rn <= %(history_limit)s
+    ), item_users AS (
+        SELECT book_id, COUNT(*) AS users FROM recent GROUP BY book_id
+    ), similarity AS (
+        SELECT a.book_id AS src, b.book_id AS dst,
+               SUM(a.weight * b.weight) / sqrt(MAX(s.users) * MAX(d.users)) AS sim
+        FROM recent a
+        JOIN recent b ON b.telegram_id = a.telegram_id AND b.book_id <> a.book_id
+        JOIN item_users s ON s.book_id = a.book_id
+        JOIN item_users d ON d.book_id = b.book_id
+        GROUP BY a.book_id, b.book_id
+    ), scored AS (
+        SELECT r.telegram_id, sim.dst AS book_id, SUM(r.weight * sim.sim) AS score
+        FROM recent r
+        JOIN similarity sim ON sim.src = r.book_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM interactions seen WHERE seen.telegram_id = r.telegram_id AND seen.book_id = sim.dst
+        )
+        GROUP BY r.telegram_id, sim.dst
+    ), ranked AS (
+        SELECT *, row_number() OVER (PARTITION BY telegram_id ORDER BY score DESC, book_id) AS rn FROM scored
+    ), meta AS (
+        SELECT DISTINCT ON (book_id) book_id, title, cover_url FROM events ORDER BY book_id, at DESC
+    )
+    INSERT INTO user_recommendations (telegram_id, items, computed_at)
+    SELECT r.telegram_id,
+           jsonb_agg(jsonb_build_object(
+               'bookId', r.book_id, 'bookName', m.title, 'coverWap', m.cover_url,
+               'score', round(r.score::numeric, 4)) ORDER BY r.rn),
+           %(now)s
+    FROM ranked r JOIN meta m ON m.book_id = r.book_id
+    WHERE r.rn <= %(top_k)s
+    GROUP BY r.telegram_id
+    ON CONFLICT (telegram_id) DO UPDATE SET items = EXCLUDED.items, computed_at = EXCLUDED.computed_at
+"""
+
+PRUNE_SQL = "DELETE FROM user_recommendations WHERE computed_at < %(now)s"
+
+
+def rebuild(top_k=30, history_limit=50):
+    start = time.perf_counter()
+    now = datetime.now()
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute(REBUILD_SQL, {"top_k": top_k, "history_limit": history_limit, "now": now})
+        users = cur.rowcount
+        cur.execute(PRUNE_SQL, {"now": now})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    logger.info(f"Rebuilt recommendations for {users} users in {time.perf_counter() - start:.2f}s")
+    return users
+
+
+def get_recommendations(telegram_id):
+    conn = get_read_db(telegram_id)
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT items FROM user_recommendations WHERE telegram_id = %s", (telegram_id,))
+        row = cur.fetchone()
+        return row['items'] if row else []
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _builder_loop(interval, top_k):
+    while True:
+        try:
+            rebuild(top_k)
+        except Exception as e:
+            logger.error(f"Recommendation rebuild error: {e}")
+        time.sleep(interval)
+
+
+def start_builder(interval, top_k=30):
+    thread = threading.Thread(target=_builder_loop, args=(interval, top_k), name='recommendations', daemon=True)
+    thread.start()
+    logger.info(f"Recommendation builder started (every {interval}s, top {top_k})")
+    return thread
@@ -0,0 +1,403 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+from datetime import datetime
+
+import requests
+
+import metrics
+import tracing
+from cache import LRUCache
+from db import execute_prepared, get_db, note_write, prepare
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org').rstrip('/')
+AVATAR_REFRESH_SECONDS = int(os.environ.get('AVATAR_REFRESH_SECONDS', 6 * 3600))
+AVATAR_CACHE_BYTES = int(os.environ.get('AVATAR_CACHE_BYTES', 16 * 1024 * 1024))
+# Without a configured key, sign with a random per-process one: tokens stop verifying on restart
+# (the client just falls back to a database check) but can never be forged from a known default
+ENTITLEMENT_SECRET = (os.environ.get('ENTITLEMENT_SECRET') or os.environ.get('SECRET_KEY') or '').encode('utf-8')
+if not ENTITLEMENT_SECRET:
+    ENTITLEMENT_SECRET = secrets.token_bytes(32)
+ENTITLEMENT_TOKEN_SECONDS = int(os.environ.get('ENTITLEMENT_TOKEN_SECONDS', 900))
+FREE_EPISODE_LIMIT = 10
+
+# telegram_id -> (file_id, file_unique_id) of the current profile photo, () when the user has none
+_avatar_photos = LRUCache(200000, ttl=AVATAR_REFRESH_SECONDS)
+# file_unique_id -> (content, content_type); the id changes whenever the photo does
+_avatar_images = LRUCache(AVATAR_CACHE_BYTES, max_item_bytes=512 * 1024)
+
+
+class ReferralError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def get_admin_id():
+    admin_id = os.environ.get('TELEGRAM_ADMIN_ID', '')
+    try:
+        return int(admin_id) if admin_id else None
+    except:
+        return None
+
+def is_admin(telegram_id):
+    admin_id = get_admin_id()
+    try:
+        return admin_id is not None and int(telegram_id) == admin_id
+    except (TypeError, ValueError):
+        return False
+
+def telegram_api(method, payload=None, timeout=10):
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token:
+        return None
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        resp = requests.post(f"{TELEGRAM_API_BASE}/bot{bot_token}/{method}", json=payload or {}, timeout=timeout)
+        status = 'ok' if resp.status_code == 200 else 'error'
+        return resp
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.TELEGRAM_LATENCY.observe(elapsed, method, status)
+        tracing.record(f"telegram.{method}", start, elapsed)
+
+_bot_username = {"value": None, "checked_at": 0.0}
+
+def bot_username(retry_after=60):
+    # getMe never changes for a running token; failures are retried at most once a minute
+    if _bot_username["value"] is None and time.monotonic() - _bot_username["checked_at"] >= retry_after:
+        _bot_username["checked_at"] = time.monotonic()
+        try:
+            resp = telegram_api('getMe')
+            data = resp.json() if resp is not None else {}
+            if data.get('ok'):
+                _bot_username["value"] = data['result'].get('username', '')
+        except Exception as e:
+            logger.warning(f"getMe failed: {e}")
+    return _bot_username["value"] or ''
+
+def send_telegram_notification(telegram_id, text):
+    try:
+        telegram_api('sendMessage', {"chat_id": telegram_id, "text": text, "parse_mode": "HTML"})
+    except Exception as e:
+        logger.error(f"Failed to send Telegram notification: {e}")
+
+
+def _with_cursor(fn, *args):
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        result = fn(*args, cur)
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+def get_app_state(key, cur=None):
+    if cur is None:
+        return _with_cursor(get_app_state, key)
+    cur.execute("SELECT to_regclass('app_state') IS NOT NULL AS present")
+    if not cur.fetchone()['present']:
+        return None
+    cur.execute("SELECT value FROM app_state WHERE key = %s", (key,))
+    row = cur.fetchone()
+    return row['value'] if row else None
+
+def set_app_state(key, value, cur=None):
+    if cur is None:
+        return _with_cursor(set_app_state, key, value)
+    cur.execute("""
+        INSERT INTO app_state (key, value) VALUES (%s, %s)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP
+    """, (key, value))
+
+
+def avatar_path(telegram_id):
+    return f"/api/avatar/{telegram_id}"
+
+def current_avatar(telegram_id):
+    photo = _avatar_photos.get(telegram_id)
+    if photo is not None:
+        metrics.CACHE_LOOKUPS.inc('avatar_photo', 'hit')
+        return photo or None
+    metrics.CACHE_LOOKUPS.inc('avatar_photo', 'miss')
+    resp = telegram_api('getUserProfilePhotos', {"user_id": telegram_id, "limit": 1})
+    if resp is None or resp.status_code != 200:
+        return None
+    photos = resp.json().get('result', {}).get('photos') or []
+    photo = (photos[0][-1]['file_id'], photos[0][-1]['file_unique_id']) if photos else ()
+    _avatar_photos.set(telegram_id, photo, 1)
+    return photo or None
+
+def avatar_image(telegram_id):
+    photo = current_avatar(telegram_id)
+    if not photo:
+        return None
+    file_id, unique_id = photo
+    cached = _avatar_images.get(unique_id)
+    if cached is not None:
+        metrics.CACHE_LOOKUPS.inc('avatar_image', 'hit')
+        return (unique_id,) + cached
+    metrics.CACHE_LOOKUPS.inc('avatar_image', 'miss')
+    resp = telegram_api('getFile', {"file_id": file_id})
+    if resp is None or resp.status_code != 200:
+        return None
+    file_path = resp.json()['result']['file_path']
+    with tracing.span('telegram.file'):
+        download = requests.get(f"{TELEGRAM_API_BASE}/file/bot{os.environ.get('TELEGRAM_BOT_TOKEN')}/{file_path}", timeout=10)
+    if download.status_code != 200:
+        return None
+    content_type = download.headers.get('Content-Type', '')
+    if not content_type.startswith('image/'):
+        content_type = 'image/jpeg'
+    _avatar_images.set(unique_id, (download.content, content_type), len(download.content))
+    return unique_id, download.content, content_type
+
+def warm_avatar(telegram_id):
+    try:
+        avatar_image(telegram_id)
+    except Exception as e:
+        logger.warning(f"Avatar refresh for {telegram_id} failed: {e}")
+
+
+UPSERT_USER = prepare('upsert_user', ('bigint', 'varchar', 'varchar', 'varchar', 'text'), """
+    INSERT INTO users (telegram_id, username, first_name, last_name, avatar_url)
+    VALUES ($1, $2, $3, $4, $5)
+    ON CONFLICT (telegram_id) DO UPDATE SET
+        username = EXCLUDED.username,
+        first_name = EXCLUDED.first_name,
+        last_name = EXCLUDED.last_name,
+        avatar_url = EXCLUDED.avatar_url
+    RETURNING *
+""")
+
+def upsert_user(telegram_id, username=None, first_name=None, last_name=None, avatar_url=None):
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        execute_prepared(cur, UPSERT_USER, (telegram_id, username, first_name, last_name, avatar_url))
+        user = dict(cur.fetchone())
+        conn.commit()
+        note_write(telegram_id)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    user['is_admin'] = is_admin(telegram_id)
+    return user
+
+
+def entitlement(user, now=None):
+    now = now or datetime.now()
+    membership = user['membership'] or 'Free'
+    expires_at = user['membership_expires_at']
+    is_active = False
+
+    if is_admin(user['telegram_id']):
+        is_active = True
+        membership = 'Admin'
+    elif membership == 'VIP':
+        if expires_at is None or expires_at > now:
+            is_active = True
+        else:
+            membership = 'Free'
+            expires_at = None
+
+    ref_expires = user.get('referral_access_expires_at')
+    has_referral_access = bool(ref_expires and ref_expires > now)
+    return {
+        "telegram_id": user['telegram_id'],
+        "membership": membership,
+        "is_active": is_active or has_referral_access,
+        "has_referral_access": has_referral_access,
+        "expires_at": expires_at.isoformat() if expires_at else None,
+        "referral_access_expires_at": ref_expires.isoformat() if ref_expires else None
+    }
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def _sign(payload):
+    return _b64(hmac.new(ENTITLEMENT_SECRET, payload.encode('ascii'), hashlib.sha256).digest())
+
+def entitlement_token(user, now=None):
+    # Short-lived signed copy of entitlement() the client can decide episode access from locally
+    now = now or datetime.now()
+    access = entitlement(user, now)
+    if access['membership'] == 'Admin':
+        tier, until = 'admin', None
+    elif access['membership'] == 'VIP':
+        tier, until = 'vip', user['membership_expires_at']
+    elif access['has_referral_access']:
+        tier, until = 'referral', user['referral_access_expires_at']
+    else:
+        tier, until = 'free', None
+    ttl = ENTITLEMENT_TOKEN_SECONDS
+    if until is not None:
+        ttl = max(0, min(ttl, int((until - now).total_seconds())))
+    claims = {
+        "sub": int(user['telegram_id']),
+        "tier": tier,
+        "exp": int(time.time()) + ttl,
+        "free": FREE_EPISODE_LIMIT,
+        "v": user.get('entitlement_version') or 0,
+    }
+    payload = _b64(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+    return {**claims, "token": f"{payload}.{_sign(payload)}"}
+
+def verify_entitlement_token(token, telegram_id):
+    # Claims when the token is genuine, unexpired and for this user. A token can only be out of date in
+    # the user's favour (payments and referral rewards upgrade; expiry is capped by exp), so callers
+    # trust it to allow and re-check the database, via entitlement_version, before denying.
+    if not token or not isinstance(token, str) or token.count('.') != 1:
+        return None
+    payload, signature = token.split('.')
+    try:
+        if not hmac.compare_digest(signature.encode('ascii'), _sign(payload).encode('ascii')):
+            return None
+        claims = json.loads(_unb64(payload))
+        if claims['sub'] != int(telegram_id) or claims['exp'] <= time.time():
+            return None
+    except (ValueError, KeyError, TypeError):
+        return None
+    return claims
+
+def access_decision(tier, episode_index, free_limit=FREE_EPISODE_LIMIT):
+    if tier == 'admin':
+        return True, 'admin'
+    if tier == 'vip':
+        return True, 'vip'
+    if tier == 'referral':
+        return True, 'referral_access'
+    if episode_index < free_limit:
+        return True, 'free_episode'
+    return False, 'premium_required'
+
+def referral_summary(user, now=None):
+    now = now or datetime.now()
+    count = user['referral_count']
+    expires_at = user.get('referral_access_expires_at')
+    return {
+        "referral_count": count,
+        "points": user['points'],
+        "has_referral_access": bool(expires_at and expires_at > now),
+        "referral_access_expires_at": expires_at.isoformat() if expires_at else None,
+        "referrals_until_next_reward": 3 - (count % 3) if count % 3 != 0 else 3,
+        "referrals_until_2weeks": max(0, 10 - count),
+        "reached_10_referrals": count >= 10
+    }
+
+
+REFERRAL_CREDIT_SQL = """
+    WITH referrer AS (
+        SELECT telegram_id FROM users WHERE telegram_id = %(referrer_id)s
+    ), referred AS (
+        UPDATE users SET referred_by = %(referrer_id)s
+        WHERE telegram_id = %(telegram_id)s
+          AND referred_by IS NULL
+          AND EXISTS (SELECT 1 FROM referrer)
+        RETURNING telegram_id, first_name, username
+    ), logged AS (
+        INSERT INTO referral_logs (referrer_id, referred_id)
+        SELECT %(referrer_id)s, telegram_id FROM referred
+        ON CONFLICT (referrer_id, referred_id) DO NOTHING
+    ), credited AS (
+        UPDATE users SET
+            referral_count = referral_count + 1,
+            points = points + 100,
+            referral_access_expires_at = CASE
+                WHEN referral_count + 1 >= 10 THEN %(now)s + INTERVAL '14 days'
+                WHEN (referral_count + 1) %% 3 = 0 THEN %(now)s + INTERVAL '24 hours'
+                ELSE referral_access_expires_at
+            END,
+            entitlement_version = entitlement_version
+                + CASE WHEN referral_count + 1 >= 10 OR (referral_count + 1) %% 3 = 0 THEN 1 ELSE 0 END
+        WHERE telegram_id = %(referrer_id)s
+          AND EXISTS (SELECT 1 FROM referred)
+        RETURNING referral_count, referral_access_expires_at, entitlement_version
+    )
+    SELECT
+        (SELECT referral_count FROM credited) AS referral_count,
+        (SELECT referral_access_expires_at FROM credited) AS referral_access_expires_at,
+        (SELECT COALESCE(NULLIF(first_name, ''), NULLIF(username, ''), telegram_id::text) FROM referred) AS referred_name,
+        EXISTS (SELECT 1 FROM referrer) AS referrer_exists,
+        (SELECT referred_by FROM users WHERE telegram_id = %(telegram_id)s) AS existing_referrer,
+        EXISTS (SELECT 1 FROM users WHERE telegram_id = %(telegram_id)s) AS user_exists
+"""
+
+def credit_referral(telegram_id, ref_code):
+    try:
+        referrer_id = int(str(ref_code).replace('ref_', ''))
+    except ValueError:
+        raise ReferralError("invalid ref code")
+
+    if referrer_id == int(telegram_id):
+        raise ReferralError("cannot refer yourself")
+
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute(REFERRAL_CREDIT_SQL, {
+            "referrer_id": referrer_id,
+            "telegram_id": int(telegram_id),
+            "now": datetime.now(),
+        })
+        result = cur.fetchone()
+        conn.commit()
+        note_write(telegram_id)
+        note_write(referrer_id)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    new_count = result['referral_count']
+    if new_count is None:
+        if result['existing_referrer']:
+            return {"status": "already_referred"}
+        if not result['referrer_exists']:
+            raise ReferralError("referrer not found", 404)
+        if not result['user_exists']:
+            raise ReferralError("user not found", 404)
+        return {"status": "already_referred"}
+
+    send_telegram_notification(referrer_id, _referral_message(result['referred_name'], new_count))
+    return {"status": "ok", "referral_count": new_count}
+
+def _referral_message(referred_name, new_count):
+    msg = (
+        "🎉 <b>Referral Berhasil!</b>\n\n"
+        f"👤 <b>{referred_name}</b> bergabung melalui link referralmu!\n"
+        f"🏆 Total referral: <b>{new_count}</b>\n"
+        f"💰 +100 poin (Total: +{new_count * 100} poin)\n"
+    )
+    if new_count >= 10:
+        msg += "\n🔓 <b>Selamat! Akses penuh 2 MINGGU telah diaktifkan!</b>"
+    elif new_count % 3 == 0:
+        msg += "\n🔓 <b>Akses penuh 24 jam telah diaktifkan!</b>"
+    else:
+        remaining_3 = 3 - (new_count % 3)
+        remaining_10 = 10 - new_count
+        msg += f"\n📊 {remaining_3} referral lagi untuk akses 24 jam gratis!"
+        if remaining_10 > 0:
+            msg += f"\n🎯 {remaining_10} referral lagi untuk akses 2 MINGGU!"
+    return msg
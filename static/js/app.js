@@ -3,6 +3,9 @@ function imgProxy(url) {
     if (!url) return '';
     return '/api/imgproxy?url=' + encodeURIComponent(url);
 }
+function escapeHtml(text) {
+    return String(text).replace(/[&<>"']/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c]));
+}
 let currentUser = null;
 let currentDrama = null;
 let currentEpisodes = [];
@@ -21,6 +24,13 @@ let lastSearchQuery = '';
 let userIsAdmin = false;
 let userHasFullAccess = false;
 let currentEpisodeIndex = -1;
+// Signed entitlement from the server ({tier, exp, free, token}); episode access is decided from it locally
+let entitlement = null;
+let entitlementTimer = null;
+const FREE_EPISODE_LIMIT = 10;
+let botUsername = '';
+// Profile/referral/settings from /api/bootstrap, each used once for the first render of its screen
+let bootData = {};
 
 const tg = window.Telegram?.WebApp;
 const BOT_USERNAME = 'tgdrama_bot';
@@ -117,59 +127,98 @@ function showTelegramBanner() {
 }
 
 async function registerUser() {
+    let refCode = tg?.initDataUnsafe?.start_param;
+    if (!refCode) {
+        const urlRef = getUrlParam('ref');
+        if (urlRef && urlRef.startsWith('ref_')) {
+            refCode = urlRef;
+        }
+    }
+
     try {
-        const resp = await fetch('/api/user', {
+        const resp = await fetch('/api/bootstrap', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(currentUser)
+            body: JSON.stringify({
+                ...currentUser,
+                ref_code: refCode && refCode.startsWith('ref_') ? refCode : undefined
+            })
         });
         const data = await resp.json();
-        if (data.telegram_id) {
-            currentUser = { ...currentUser, ...data };
-            userIsAdmin = data.is_admin || false;
+        if (!data.user) return;
+
+        currentUser = { ...currentUser, ...data.user };
+        userIsAdmin = data.user.is_admin || false;
+        applyAccess(data.subscription);
+        applyEntitlement(data.entitlement);
+        botUsername = data.bot_username || '';
+        bootData = { user: data.user, referral: data.referral, settings: data.settings };
+
+        const refData = data.referral_result;
+        if (refData?.status === 'ok') {
+            showToast('Referral berhasil! Selamat bergabung!', 'success');
+        } else if (refData?.status === 'already_referred') {
+            showToast('Kamu sudah terdaftar melalui referral', 'info');
         }
+    } catch (e) {
+        console.error('Register error:', e);
+    }
+}
 
-        await checkUserAccess();
+function applyAccess(data) {
+    userHasFullAccess = userIsAdmin || data.is_active || false;
+    currentUser.membership = data.membership || 'Free';
+    currentUser.has_referral_access = data.has_referral_access || false;
+}
 
-        let refCode = tg?.initDataUnsafe?.start_param;
-        if (!refCode) {
-            const urlRef = getUrlParam('ref');
-            if (urlRef && urlRef.startsWith('ref_')) {
-                refCode = urlRef;
-            }
-        }
+function applyEntitlement(ent) {
+    if (!ent) return;
+    entitlement = ent;
+    userHasFullAccess = userIsAdmin || ent.tier !== 'free';
+    clearTimeout(entitlementTimer);
+    // Renew a minute before it runs out so an expiring VIP or referral window is picked up mid-session
+    const refreshIn = Math.max(5, ent.exp - Date.now() / 1000 - 60);
+    entitlementTimer = setTimeout(refreshEntitlement, refreshIn * 1000);
+}
 
-        if (refCode && refCode.startsWith('ref_')) {
-            const refResp = await fetch('/api/referral', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    telegram_id: currentUser.telegram_id,
-                    ref_code: refCode
-                })
-            });
-            const refData = await refResp.json();
-            if (refData.status === 'ok') {
-                showToast('Referral berhasil! Selamat bergabung!', 'success');
-            } else if (refData.status === 'already_referred') {
-                showToast('Kamu sudah terdaftar melalui referral', 'info');
-            }
-        }
+function entitlementValid() {
+    return !!entitlement && entitlement.exp > Date.now() / 1000;
+}
+
+async function refreshEntitlement() {
+    if (!currentUser?.telegram_id) return;
+    try {
+        const resp = await fetch(`/api/subscription/check/${currentUser.telegram_id}`);
+        if (!resp.ok) return;
+        const data = await resp.json();
+        applyAccess(data);
+        applyEntitlement(data.entitlement);
     } catch (e) {
-        console.error('Register error:', e);
+        console.error('Entitlement refresh error:', e);
     }
 }
 
-async function checkUserAccess() {
-    if (!currentUser.telegram_id) return;
+function freeEpisodeLimit() {
+    return entitlement?.free ?? FREE_EPISODE_LIMIT;
+}
+
+async function canPlayEpisode(index) {
+    if (userIsAdmin || index < freeEpisodeLimit()) return true;
+    if (!entitlementValid()) await refreshEntitlement();
+    if (entitlementValid() && entitlement.tier !== 'free') return true;
+    // Locked by the token we hold. The server answers from the token alone unless a payment or
+    // referral reward has superseded it, in which case it reads the database and sends a new one.
     try {
-        const resp = await fetch(`/api/subscription/check/${currentUser.telegram_id}`);
+        const resp = await fetch('/api/episode/access', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ telegram_id: currentUser.telegram_id, episode_index: index, token: entitlement?.token })
+        });
         const data = await resp.json();
-        userHasFullAccess = userIsAdmin || data.is_active || false;
-        currentUser.membership = data.membership || 'Free';
-        currentUser.has_referral_access = data.has_referral_access || false;
+        if (data.entitlement) applyEntitlement(data.entitlement);
+        return !!data.allowed;
     } catch (e) {
-        console.error('Access check error:', e);
+        return false;
     }
 }
 
@@ -250,6 +299,19 @@ async function loadHomeContent(tab, append) {
     homeLoading = true;
 
     const container = document.getElementById('home-content');
+    const embedded = !append && tab === 'foryou' ? takeInitialHome() : null;
+    if (embedded) {
+        // Server-embedded first page: render without a round trip, then check for personal picks
+        container.innerHTML = '<div class="content-grid">' +
+            embedded.map((item, i) => renderDramaCard(item, i)).join('') +
+            '</div>';
+        homePage = 2;
+        homeLoading = false;
+        decorateViewerBadges(embedded);
+        appendLoadMoreButton(container, 'home');
+        if (currentUser.telegram_id) swapInPersonalForYou();
+        return;
+    }
     if (!append) {
         container.innerHTML = renderSkeletonGrid(9);
     } else {
@@ -266,8 +328,15 @@ async function loadHomeContent(tab, append) {
         params = `?page=${homePage}`;
     }
 
+    let url = `${API_BASE}/${endpoint}${params}`;
+    if (tab === 'foryou' && currentUser.telegram_id) {
+        url = `/api/foryou/${currentUser.telegram_id}${params}`;
+    } else if (tab === 'local') {
+        url = `/api/trending/local${params}`;
+    }
+
     try {
-        const resp = await fetch(`${API_BASE}/${endpoint}${params}`);
+        const resp = await fetch(url);
         const text = await resp.text();
         let data;
         try {
@@ -309,6 +378,7 @@ async function loadHomeContent(tab, append) {
         }
 
         homePage++;
+        if (tab !== 'local') decorateViewerBadges(items);
 
         if (homeHasMore) {
             appendLoadMoreButton(container, 'home');
@@ -321,6 +391,31 @@ async function loadHomeContent(tab, append) {
     homeLoading = false;
 }
 
+function takeInitialHome() {
+    const el = document.getElementById('initial-home');
+    if (!el) return null;
+    el.remove();
+    try {
+        const items = JSON.parse(el.textContent);
+        return Array.isArray(items) && items.length ? items : null;
+    } catch {
+        return null;
+    }
+}
+
+async function swapInPersonalForYou() {
+    try {
+        const resp = await fetch(`/api/foryou/${currentUser.telegram_id}?page=1&personal_only=1`);
+        const data = await resp.json();
+        // Only replace the embedded page if the user hasn't moved on or loaded more since
+        if (data.source !== 'personal' || currentTab !== 'foryou' || homePage !== 2 || homeLoading) return;
+        const grid = document.querySelector('#home-content .content-grid');
+        if (!grid) return;
+        grid.innerHTML = data.data.map((item, i) => renderDramaCard(item, i)).join('');
+        decorateViewerBadges(data.data);
+    } catch {}
+}
+
 function renderSkeletonGrid(count) {
     let html = '<div class="content-grid">';
     for (let i = 0; i < count; i++) {
@@ -377,17 +472,37 @@ function renderDramaCard(item, index) {
     const title = item.bookName || item.name || item.title || 'Tidak diketahui';
     const cover = item.coverWap || item.cover || item.coverUrl || item.image || '';
 
-    return `<div class="drama-card" style="animation-delay:${index * 0.04}s" onclick="openDrama('${id}', '${encodeURIComponent(title)}', '${encodeURIComponent(cover)}')">
+    return `<div class="drama-card" data-book-id="${id}" style="animation-delay:${index * 0.04}s" onclick="openDrama('${id}', '${encodeURIComponent(title)}', '${encodeURIComponent(cover)}')">
         <div class="card-img-wrapper">
             <img src="${imgProxy(cover)}" alt="${title}" loading="lazy" onerror="this.src='data:image/svg+xml,<svg xmlns=%22http://www.w3.org/2000/svg%22 viewBox=%220 0 300 400%22><rect fill=%22%23141414%22 width=%22300%22 height=%22400%22/><text fill=%22%23444%22 x=%22150%22 y=%22200%22 text-anchor=%22middle%22 font-size=%2214%22>No Image</text></svg>'">
             <div class="card-overlay">
                 <i class="fas fa-play"></i>
             </div>
+            ${item.viewers ? viewerBadge(item.viewers) : ''}
         </div>
         <div class="card-title">${title}</div>
     </div>`;
 }
 
+function viewerBadge(count) {
+    return `<span class="viewer-badge"><i class="fas fa-eye"></i> ${count} penonton</span>`;
+}
+
+async function decorateViewerBadges(items) {
+    const ids = items.map(item => item.bookId || item.id || item.book_id).filter(Boolean);
+    if (!ids.length) return;
+    try {
+        const resp = await fetch(`/api/viewers?book_ids=${ids.map(encodeURIComponent).join(',')}`);
+        const counts = await resp.json();
+        Object.entries(counts).forEach(([id, count]) => {
+            if (!count) return;
+            document.querySelectorAll(`.drama-card[data-book-id="${CSS.escape(id)}"] .card-img-wrapper`).forEach(wrapper => {
+                if (!wrapper.querySelector('.viewer-badge')) wrapper.insertAdjacentHTML('beforeend', viewerBadge(count));
+            });
+        });
+    } catch {}
+}
+
 function switchHomeTab(el, tab) {
     document.querySelectorAll('#home-tabs .tab').forEach(t => t.classList.remove('active'));
     el.classList.add('active');
@@ -528,7 +643,7 @@ async function openDrama(bookId, encodedTitle, encodedCover) {
     try {
         const [detailResp, episodesResp] = await Promise.all([
             fetch(`${API_BASE}/detail?bookId=${bookId}`),
-            fetch(`${API_BASE}/allepisode?bookId=${bookId}`)
+            fetch(`${API_BASE}/allepisode?bookId=${bookId}${bandwidthHint()}`)
         ]);
 
         const detailData = await detailResp.json();
@@ -586,7 +701,7 @@ async function openDrama(bookId, encodedTitle, encodedCover) {
         }
 
         const canPlayAll = userIsAdmin || userHasFullAccess;
-        const freeLimit = 10;
+        const freeLimit = freeEpisodeLimit();
 
         container.innerHTML = `
             <div class="detail-hero">
@@ -630,6 +745,12 @@ function toggleSynopsis() {
     }
 }
 
+function bandwidthHint() {
+    const conn = navigator.connection;
+    if (!conn || !conn.downlink) return '';
+    return `&bw=${Math.round(conn.downlink * 1000)}`;
+}
+
 function extractVideoUrl(ep) {
     if (ep.videoUrl || ep.url || ep.video || ep.playUrl) {
         return ep.videoUrl || ep.url || ep.video || ep.playUrl;
@@ -660,11 +781,11 @@ async function playEpisode(index) {
     const ep = currentEpisodes[index];
     if (!ep) return;
 
-    const freeLimit = 10;
-    if (!userIsAdmin && !userHasFullAccess && index >= freeLimit) {
+    if (!(await canPlayEpisode(index))) {
         showLockedModal();
         return;
     }
+    const freeLimit = freeEpisodeLimit();
 
     const videoUrl = extractVideoUrl(ep);
     const epNum = getEpNum(ep, index);
@@ -681,6 +802,15 @@ async function playEpisode(index) {
 
     const player = document.getElementById('video-player');
     player.removeEventListener('ended', handleEpisodeEnded);
+    const fallbacks = (ep.videoUrls || []).filter(u => u !== videoUrl);
+    player.onerror = () => {
+        const next = fallbacks.shift();
+        if (!next) return;
+        const resumeAt = player.currentTime;
+        player.src = next;
+        player.currentTime = resumeAt;
+        player.play().catch(() => {});
+    };
     player.src = videoUrl;
     player.play().catch(() => {});
     player.addEventListener('ended', handleEpisodeEnded);
@@ -717,15 +847,14 @@ async function playEpisode(index) {
 let autoPlayTimer = null;
 let autoPlayCountdown = 5;
 
-function handleEpisodeEnded() {
+async function handleEpisodeEnded() {
     const nextIndex = currentEpisodeIndex + 1;
     if (nextIndex >= currentEpisodes.length) {
         showToast('Episode terakhir selesai', 'info');
         return;
     }
 
-    const freeLimit = 10;
-    if (!userIsAdmin && !userHasFullAccess && nextIndex >= freeLimit) {
+    if (!(await canPlayEpisode(nextIndex))) {
         showToast('Episode berikutnya memerlukan VIP', 'warning');
         return;
     }
@@ -897,33 +1026,35 @@ async function loadProfile() {
     const container = document.getElementById('profile-content');
 
     let userData = currentUser;
-    if (currentUser.telegram_id) {
-        try {
-            const resp = await fetch(`/api/user/${currentUser.telegram_id}`);
-            const data = await resp.json();
-            if (data.telegram_id) {
-                userData = { ...currentUser, ...data };
-                userIsAdmin = data.is_admin || false;
-            }
-        } catch {}
-    }
-
     let referralData = { referral_count: 0, referrals_until_next_reward: 3, has_referral_access: false };
-    if (currentUser.telegram_id) {
-        try {
-            const refResp = await fetch(`/api/referral/status/${currentUser.telegram_id}`);
-            referralData = await refResp.json();
-        } catch {}
+    if (bootData.user && bootData.referral) {
+        userData = { ...currentUser, ...bootData.user };
+        referralData = bootData.referral;
+        delete bootData.user;
+        delete bootData.referral;
+    } else if (currentUser.telegram_id) {
+        const [userResp, refResp] = await Promise.allSettled([
+            fetch(`/api/user/${currentUser.telegram_id}`).then(r => r.json()),
+            fetch(`/api/referral/status/${currentUser.telegram_id}`).then(r => r.json())
+        ]);
+        if (userResp.status === 'fulfilled' && userResp.value.telegram_id) {
+            userData = { ...currentUser, ...userResp.value };
+            userIsAdmin = userResp.value.is_admin || false;
+        }
+        if (refResp.status === 'fulfilled' && !refResp.value.error) {
+            referralData = refResp.value;
+        }
     }
 
     const initial = (userData.first_name || 'G')[0].toUpperCase();
     const avatarUrl = userData.avatar_url || '';
-    let botUsername = '';
-    try {
-        const botResp = await fetch('/api/bot/info');
-        const botData = await botResp.json();
-        botUsername = botData.username || '';
-    } catch {}
+    if (!botUsername) {
+        try {
+            const botResp = await fetch('/api/bot/info');
+            const botData = await botResp.json();
+            botUsername = botData.username || '';
+        } catch {}
+    }
     const refLink = botUsername ? `https://t.me/${botUsername}?start=ref_${userData.telegram_id}` : 'Bot belum dikonfigurasi';
 
     const avatarHtml = avatarUrl
@@ -1125,12 +1256,125 @@ async function loadMonthlyStats() {
                     `).join('')}
                 </div>
             </div>` : ''}
+            <div class="daily-signups-section">
+                <h3><i class="fas fa-bullhorn"></i> Broadcast</h3>
+                <div class="form-group">
+                    <textarea id="broadcast-text" class="form-input" rows="4" placeholder="Pesan untuk semua user (HTML Telegram didukung)..."></textarea>
+                </div>
+                <div class="form-group">
+                    <select id="broadcast-language" class="form-input">
+                        <option value="">Semua bahasa</option>
+                        <option value="id">Indonesia</option>
+                        <option value="en">English</option>
+                    </select>
+                </div>
+                <button class="btn-primary btn-full" onclick="sendBroadcast()">
+                    <i class="fas fa-paper-plane"></i> Kirim Broadcast
+                </button>
+                <div id="broadcast-list" class="broadcast-list"></div>
+            </div>
         `;
+        refreshBroadcasts();
+        loadSlowTraces(container);
     } catch (e) {
         container.innerHTML = '<div class="empty-state"><i class="fas fa-exclamation-circle"></i><p>Gagal memuat statistik</p></div>';
     }
 }
 
+async function refreshBroadcasts() {
+    const list = document.getElementById('broadcast-list');
+    if (!list || !currentUser) return;
+    try {
+        const resp = await fetch(`/api/admin/broadcasts?admin_telegram_id=${currentUser.telegram_id}`);
+        if (!resp.ok) return;
+        const data = await resp.json();
+        list.innerHTML = data.broadcasts.length === 0 ? '<div class="slow-trace-empty">Belum ada broadcast</div>' : data.broadcasts.map(b => `
+            <div class="slow-trace-item">
+                <div class="slow-trace-head">
+                    <span class="slow-trace-path">#${b.id} ${escapeHtml(b.preview)}</span>
+                    <span class="slow-trace-total">${escapeHtml(b.status)}</span>
+                </div>
+                <div class="slow-trace-breakdown">
+                    <span>Terkirim: ${b.sent}/${b.total}</span>
+                    <span>Gagal: ${b.failed}</span>
+                    <span>Diblokir: ${b.blocked}</span>
+                    <span>${b.messages_per_second} pesan/dtk</span>
+                </div>
+                ${b.status === 'running' || b.status === 'pending' ? `<div class="broadcast-actions">
+                    <button class="btn-ghost" onclick="refreshBroadcasts()"><i class="fas fa-sync"></i> Refresh</button>
+                    <button class="btn-ghost" onclick="cancelBroadcast(${b.id})"><i class="fas fa-stop"></i> Batalkan</button>
+                </div>` : ''}
+            </div>
+        `).join('');
+    } catch (e) {
+        console.error('Broadcast list error:', e);
+    }
+}
+
+async function sendBroadcast() {
+    const text = document.getElementById('broadcast-text').value.trim();
+    const language = document.getElementById('broadcast-language').value;
+    if (!text) { showToast('Tulis pesan broadcast', 'warning'); return; }
+    if (!confirm('Kirim broadcast ke semua user?')) return;
+    try {
+        const resp = await fetch('/api/admin/broadcasts', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ admin_telegram_id: currentUser.telegram_id, text, language })
+        });
+        if (!resp.ok) throw new Error('broadcast failed');
+        document.getElementById('broadcast-text').value = '';
+        showToast('Broadcast dimulai', 'success');
+        refreshBroadcasts();
+    } catch (e) {
+        showToast('Gagal memulai broadcast', 'error');
+    }
+}
+
+async function cancelBroadcast(id) {
+    try {
+        await fetch(`/api/admin/broadcasts/${id}/cancel`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ admin_telegram_id: currentUser.telegram_id })
+        });
+        refreshBroadcasts();
+    } catch (e) {
+        showToast('Gagal membatalkan broadcast', 'error');
+    }
+}
+
+async function loadSlowTraces(container) {
+    if (!currentUser) return;
+    try {
+        const resp = await fetch(`/api/stats/slow-traces?admin_telegram_id=${currentUser.telegram_id}`);
+        if (!resp.ok) return;
+        const data = await resp.json();
+        const section = document.createElement('div');
+        section.className = 'daily-signups-section';
+        section.innerHTML = `
+            <h3><i class="fas fa-stopwatch"></i> Request Lambat (&ge; ${data.threshold_ms} ms)</h3>
+            <div class="slow-trace-list">
+                ${data.traces.length === 0 ? '<div class="slow-trace-empty">Belum ada request lambat</div>' : data.traces.map(t => `
+                    <div class="slow-trace-item">
+                        <div class="slow-trace-head">
+                            <span class="slow-trace-path">${escapeHtml(t.method)} ${escapeHtml(t.path)}</span>
+                            <span class="slow-trace-total">${t.total_ms} ms</span>
+                        </div>
+                        <div class="slow-trace-breakdown">
+                            ${Object.entries(t.breakdown_ms).map(([k, v]) => `<span>${escapeHtml(k)}: ${v} ms</span>`).join('')}
+                            <span>lainnya: ${t.other_ms} ms</span>
+                        </div>
+                        <div class="slow-trace-meta">${escapeHtml(t.request_id)} &middot; ${new Date(t.started_at * 1000).toLocaleTimeString('id-ID')} &middot; ${t.status}</div>
+                    </div>
+                `).join('')}
+            </div>`;
+        container.appendChild(section);
+    } catch (e) {
+        console.error('Slow traces error:', e);
+    }
+}
+
 function copyRefLink() {
     const link = document.getElementById('ref-link').textContent;
     navigator.clipboard.writeText(link).then(() => {
@@ -1232,8 +1476,12 @@ async function loadSettings() {
     }
 
     try {
-        const resp = await fetch(`/api/settings/${currentUser.telegram_id}`);
-        const settings = await resp.json();
+        let settings = bootData.settings;
+        delete bootData.settings;
+        if (!settings) {
+            const resp = await fetch(`/api/settings/${currentUser.telegram_id}`);
+            settings = await resp.json();
+        }
 
         container.innerHTML = `
             <div class="settings-group">
@@ -1409,4 +1657,16 @@ document.addEventListener('keydown', function(e) {
     }
 });
 
+const ASSET_VERSION = new URL(document.currentScript.src).searchParams.get('v');
+
+function registerServiceWorker() {
+    if (!('serviceWorker' in navigator) || !ASSET_VERSION) return;
+    navigator.serviceWorker.register(`/sw.js?v=${ASSET_VERSION}`).catch(e => console.error('Service worker error:', e));
+}
+
 document.addEventListener('DOMContentLoaded', initApp);
+// Coming back from the payment page: pick up a new VIP tier without waiting for the token to expire
+document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'visible' && entitlement && entitlement.tier === 'free') refreshEntitlement();
+});
+window.addEventListener('load', registerServiceWorker);
@@ -0,0 +1,108 @@
+const VERSION = new URL(self.location.href).searchParams.get('v') || 'dev';
+const SHELL_CACHE = `shell-${VERSION}`;
+const API_CACHE = 'catalog-api';
+const COVER_CACHE = 'covers';
+const SHELL_ASSETS = ['/', `/static/css/style.css?v=${VERSION}`, `/static/js/app.js?v=${VERSION}`];
+const API_MAX_ENTRIES = 80;
+const COVER_BUDGET_BYTES = 40 * 1024 * 1024;
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(SHELL_CACHE).then(cache => cache.addAll(SHELL_ASSETS)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(caches.keys()
+        .then(keys => Promise.all(keys.filter(k => k.startsWith('shell-') && k !== SHELL_CACHE).map(k => caches.delete(k))))
+        .then(() => self.clients.claim()));
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') return;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) return;
+
+    if (request.mode === 'navigate' && url.pathname === '/') {
+        event.respondWith(staleWhileRevalidate(SHELL_CACHE, request, '/'));
+    } else if (url.pathname.startsWith('/static/') && url.searchParams.get('v') === VERSION) {
+        event.respondWith(caches.match(request).then(hit => hit || fetch(request)));
+    } else if (url.pathname === '/api/imgproxy') {
+        event.respondWith(coverFirst(request));
+    } else if (isCatalog(url)) {
+        event.respondWith(staleWhileRevalidate(API_CACHE, request, request.url, API_MAX_ENTRIES));
+    }
+});
+
+function isCatalog(url) {
+    // Episode lists carry CDN-ranked, expiring video URLs, so they always go to the network
+    if (url.pathname.startsWith('/api/proxy/')) return url.pathname !== '/api/proxy/allepisode';
+    return url.pathname === '/api/trending/local';
+}
+
+async function staleWhileRevalidate(cacheName, request, key, maxEntries) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(key);
+    const network = fetch(request).then(async response => {
+        if (response.ok) {
+            await cache.put(key, response.clone());
+            if (maxEntries) await trimEntries(cache, maxEntries);
+        }
+        return response;
+    });
+    if (cached) {
+        network.catch(() => {});
+        return cached;
+    }
+    return network;
+}
+
+async function trimEntries(cache, maxEntries) {
+    const keys = await cache.keys();
+    for (const key of keys.slice(0, Math.max(0, keys.length - maxEntries))) {
+        await cache.delete(key);
+    }
+}
+
+// Covers: cache-first, evicted least-recently-used once the byte budget is exceeded.
+// The in-memory index is rebuilt from cache insertion order when the worker restarts.
+let coverIndex = null;
+let coverBytes = 0;
+
+async function loadCoverIndex(cache) {
+    if (coverIndex) return;
+    coverIndex = new Map();
+    coverBytes = 0;
+    for (const key of await cache.keys()) {
+        const response = await cache.match(key);
+        const size = Number(response?.headers.get('X-SW-Bytes')) || 0;
+        coverIndex.set(key.url, size);
+        coverBytes += size;
+    }
+}
+
+async function coverFirst(request) {
+    const cache = await caches.open(COVER_CACHE);
+    await loadCoverIndex(cache);
+    const cached = await cache.match(request);
+    if (cached) {
+        const size = coverIndex.get(request.url) || 0;
+        coverIndex.delete(request.url);
+        coverIndex.set(request.url, size);
+        return cached;
+    }
+    const response = await fetch(request);
+    if (!response.ok) return response;
+    const body = await response.blob();
+    const headers = new Headers(response.headers);
+    headers.set('X-SW-Bytes', String(body.size));
+    await cache.put(request, new Response(body, { status: response.status, headers }));
+    coverBytes += body.size - (coverIndex.get(request.url) || 0);
+    coverIndex.set(request.url, body.size);
+    for (const [url, size] of coverIndex) {
+        if (coverBytes <= COVER_BUDGET_BYTES) break;
+        coverIndex.delete(url);
+        coverBytes -= size;
+        await cache.delete(url);
+    }
+    return new Response(body, { status: response.status, headers: response.headers });
+}
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from admission import Admission, RouteClass
+
+
+def _admission():
+    # The app defaults: 4 worker threads, 1 kept for webhooks and health checks
+    return Admission([
+        RouteClass('proxy', 2),
+        RouteClass('image', 2, queue=2, wait=1.0),
+        RouteClass('user', 3, queue=3, wait=1.0),
+        RouteClass('webhook', 1, queue=16, wait=1.0, pool='reserved'),
+        RouteClass('health', 1, queue=4, wait=1.0, pool='reserved'),
+    ], pools={'shared': 3, 'reserved': 1})
+
+
+def _admit_in_background(admission, name, results):
+    thread = threading.Thread(target=lambda: results.append(admission.admit(name)), daemon=True)
+    thread.start()
+    return thread
+
+
+def test_proxy_overflow_is_refused_at_once():
+    admission = _admission()
+    assert admission.admit('proxy') and admission.admit('proxy')
+    start = time.monotonic()
+    assert admission.admit('proxy') is None
+    assert time.monotonic() - start < 0.1
+
+
+def test_queued_request_runs_when_its_class_frees_up():
+    admission = _admission()
+    first, second = admission.admit('image'), admission.admit('image')
+    results = []
+    thread = _admit_in_background(admission, 'image', results)
+    time.sleep(0.05)
+    first.release()
+    thread.join(2)
+    assert results and results[0] is not None
+    second.release()
+    results[0].release()
+    assert admission.status()['pools']['shared']['in_use'] == 0
+
+
+def test_waiters_count_against_their_pool():
+    admission = _admission()
+    running = [admission.admit('image'), admission.admit('image')]
+    results = []
+    thread = _admit_in_background(admission, 'image', results)
+    time.sleep(0.05)
+    # Two running plus one queued image request hold all three shared threads
+    assert admission.status()['pools']['shared']['in_use'] == 3
+    assert admission.admit('user') is None
+    assert admission.admit('image') is None
+    for ticket in running:
+        ticket.release()
+    thread.join(2)
+    results[0].release()
+
+
+def test_reserved_classes_are_admitted_with_shared_pool_and_queues_full():
+    admission = _admission()
+    held = [admission.admit('image'), admission.admit('image')]
+    results = []
+    # Two running image requests plus one queued behind them fill the shared pool
+    thread = _admit_in_background(admission, 'image', results)
+    time.sleep(0.05)
+    for name in ('image', 'user', 'user', 'proxy'):
+        assert admission.admit(name) is None
+    status = admission.status()
+    assert status['classes']['image']['waiting'] == 1
+    assert status['pools']['shared']['in_use'] == status['pools']['shared']['size']
+
+    health = admission.admit('health')
+    assert health is not None
+    health.release()
+    webhook = admission.admit('webhook')
+    assert webhook is not None
+    webhook.release()
+
+    for ticket in held:
+        ticket.release()
+    thread.join(2)
+    results[0].release()
+
+
+def test_release_is_idempotent():
+    admission = _admission()
+    ticket = admission.admit('user')
+    ticket.release()
+    ticket.release()
+    assert admission.status()['classes']['user']['running'] == 0
+    assert admission.status()['pools']['shared']['in_use'] == 0
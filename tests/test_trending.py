@@ -0,0 +1,99 @@
+import math
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+import trending
+
+
+class _Connection:
+    def __init__(self, db):
+        self.db = db
+        self._batch = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        if self.db.fail:
+            raise RuntimeError('database is down')
+        self._batch.append(params)
+
+    def commit(self):
+        self.db.flushes.append(self._batch)
+
+    def rollback(self):
+        self._batch = []
+
+    def close(self):
+        pass
+
+
+class _Database:
+    def __init__(self):
+        self.flushes = []
+        self.fail = False
+
+    def connect(self):
+        return _Connection(self)
+
+
+def _views(flushes, book_id):
+    return sum(params[3] for batch in flushes for params in batch if params[0] == book_id)
+
+
+def test_plays_of_one_book_from_many_threads_are_all_counted():
+    db = _Database()
+    stats = trending.Trending(db.connect)
+    threads, plays = 16, 500
+    now = time.time() * trending.RATE
+    stop = threading.Event()
+
+    def play():
+        for i in range(plays):
+            stats.count_view(('41000', 'Judul', None, i == 0, now))
+
+    def flush_until_stopped():
+        while not stop.is_set():
+            stats.flush()
+
+    flusher = threading.Thread(target=flush_until_stopped)
+    flusher.start()
+    workers = [threading.Thread(target=play) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    stop.set()
+    flusher.join()
+    stats.flush()
+
+    assert _views(db.flushes, '41000') == threads * plays
+    assert sum(params[4] for batch in db.flushes for params in batch) == threads
+    # At most one upsert of the hot row per flush, however many plays it covers
+    assert all(len(batch) == 1 for batch in db.flushes)
+    scores = [params[5] for batch in db.flushes for params in batch]
+    total = max(scores) + math.log(sum(math.exp(s - max(scores)) for s in scores))
+    assert total == pytest.approx(now + math.log(threads * plays))
+
+
+def test_failed_flush_keeps_the_counts_for_the_next_one():
+    db = _Database()
+    stats = trending.Trending(db.connect)
+    now = time.time() * trending.RATE
+    for book_id in ('b', 'a', 'b'):
+        stats.count_view((book_id, None, None, True, now))
+
+    db.fail = True
+    with pytest.raises(RuntimeError):
+        stats.flush()
+    db.fail = False
+    assert stats.flush() == 2
+
+    batch, = db.flushes
+    # Sorted by book_id so workers flushing at once take row locks in the same order
+    assert [params[0] for params in batch] == ['a', 'b']
+    assert _views(db.flushes, 'b') == 2
@@ -0,0 +1,115 @@
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    def __init__(self, request_id, method, path):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.spans = []
+
+    def add(self, name, start, duration):
+        self.spans.append((name, start - self._start, duration))
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def breakdown(self):
+        totals = {}
+        for name, _, duration in self.spans:
+            category = name.split('.', 1)[0]
+            totals[category] = totals.get(category, 0.0) + duration
+        return totals
+
+    def to_dict(self, status=None, total=None):
+        total = self.elapsed() if total is None else total
+        breakdown = self.breakdown()
+        return {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "status": status,
+            "started_at": self.started_at,
+            "total_ms": round(total * 1000, 1),
+            "breakdown_ms": {k: round(v * 1000, 1) for k, v in breakdown.items()},
+            "other_ms": round(max(0.0, total - sum(breakdown.values())) * 1000, 1),
+            "spans": [
+                {"name": name, "offset_ms": round(offset * 1000, 1), "duration_ms": round(duration * 1000, 1)}
+                for name, offset, duration in self.spans
+            ],
+        }
+
+
+class SlowTraceBuffer:
+    def __init__(self, size=50):
+        self._lock = threading.Lock()
+        self._items = deque(maxlen=size)
+
+    def append(self, item):
+        with self._lock:
+            self._items.append(item)
+
+    def snapshot(self):
+        with self._lock:
+            return list(reversed(self._items))
+
+
+slow_traces = SlowTraceBuffer()
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def start(request_id, method, path):
+    trace = Trace(request_id, method, path)
+    _current.set(trace)
+    return trace
+
+
+def finish():
+    _current.set(None)
+
+
+def current():
+    return _current.get()
+
+
+def current_request_id():
+    trace = _current.get()
+    return trace.request_id if trace else '-'
+
+
+def record(name, start, duration):
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, start, duration)
+
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start, time.perf_counter() - start)
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = current_request_id()
+        return True
+
+
+# Text log lines; logs.configure() installs RequestIdFilter so %(request_id)s is always set
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'
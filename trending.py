@@ -0,0 +1,204 @@
+import logging
+import math
+import threading
+import time
+
+import metrics
+from cache import LRUCache
+from db import execute_prepared, prepare
+
+logger = logging.getLogger(__name__)
+
+HALF_LIFE_HOURS = 24
+# Scores are kept as log(sum(exp(RATE * t))) over every view, so ranking by log_score ranks by
+# exponentially decayed view count at any moment without rewriting old rows.
+RATE = math.log(2) / (HALF_LIFE_HOURS * 3600)
+
+SCHEMA_SQL = f"""
+    CREATE TABLE IF NOT EXISTS book_stats (
+        book_id VARCHAR(255) PRIMARY KEY,
+        title VARCHAR(500),
+        cover_url TEXT,
+        views INTEGER NOT NULL DEFAULT 0,
+        viewers INTEGER NOT NULL DEFAULT 0,
+        log_score DOUBLE PRECISION NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_book_stats_score ON book_stats (log_score DESC);
+    -- Who has ever watched each book. Kept apart from watch_history_log so archiving old months or a
+    -- user clearing their history does not make them count as a new viewer again.
+    CREATE TABLE IF NOT EXISTS book_viewers (
+        book_id VARCHAR(255) NOT NULL,
+        telegram_id BIGINT NOT NULL,
+        PRIMARY KEY (book_id, telegram_id)
+    );
+    INSERT INTO book_viewers (book_id, telegram_id)
+    SELECT DISTINCT book_id, telegram_id FROM watch_history_log
+    ON CONFLICT DO NOTHING;
+    INSERT INTO book_stats (book_id, title, cover_url, views, viewers, log_score)
+    SELECT book_id, MAX(title), MAX(cover_url), COUNT(*), COUNT(*),
+           MAX(peak) + ln(SUM(exp(GREATEST(w - peak, -700))))
+    FROM (
+        SELECT book_id, title, cover_url, extract(epoch FROM watched_at) * {RATE!r} AS w,
+               MAX(extract(epoch FROM watched_at) * {RATE!r}) OVER (PARTITION BY book_id) AS peak
+        FROM watch_history
+    ) h
+    GROUP BY book_id
+    ON CONFLICT (book_id) DO NOTHING;
+"""
+
+# Only the per-user rows are written on a play. book_stats is a single hot row per book, so its
+# increments are summed in memory and upserted by Trending.flush() instead of once per play.
+RECORD_VIEW = prepare('record_view', ('bigint', 'varchar', 'varchar', 'text', 'varchar'), """
+    WITH first_view AS (
+        INSERT INTO book_viewers (book_id, telegram_id) VALUES ($2, $1)
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    ), history AS (
+        INSERT INTO watch_history_log (telegram_id, book_id, title, cover_url, episode_number)
+        VALUES ($1, $2, $3, $4, $5)
+        RETURNING 1
+    )
+    SELECT EXISTS (SELECT 1 FROM first_view) AS first_view FROM history
+""")
+
+FLUSH_SQL = """
+    INSERT INTO book_stats (book_id, title, cover_url, views, viewers, log_score, updated_at)
+    VALUES (%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+    ON CONFLICT (book_id) DO UPDATE SET
+        title = COALESCE(EXCLUDED.title, book_stats.title),
+        cover_url = COALESCE(EXCLUDED.cover_url, book_stats.cover_url),
+        views = book_stats.views + EXCLUDED.views,
+        viewers = book_stats.viewers + EXCLUDED.viewers,
+        log_score = GREATEST(book_stats.log_score, EXCLUDED.log_score)
+            + ln(1 + exp(-LEAST(abs(book_stats.log_score - EXCLUDED.log_score), 700))),
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+TOP_SQL = """
+    SELECT book_id, title, cover_url, views, viewers FROM book_stats
+    ORDER BY log_score DESC
+    LIMIT %s OFFSET %s
+"""
+
+VIEWERS_SQL = "SELECT book_id, viewers FROM book_stats WHERE book_id = ANY(%s)"
+
+
+class Trending:
+    def __init__(self, get_db, cache_ttl=60, write_db=None):
+        self.get_db = get_db
+        # book_stats is flushed on the primary; get_db may point at a replica
+        self.write_db = write_db or get_db
+        self._cache = LRUCache(4 * 1024 * 1024, ttl=cache_ttl)
+        # book_id -> [views, viewers, log_score, title, cover_url] not yet in book_stats
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    def record_view(self, cur, telegram_id, book_id, title=None, cover_url=None, episode_number=1):
+        # Runs inside the caller's transaction; hand the result to count_view() once it commits
+        execute_prepared(cur, RECORD_VIEW, (telegram_id, str(book_id), title, cover_url, episode_number))
+        return (str(book_id), title, cover_url, cur.fetchone()['first_view'], time.time() * RATE)
+
+    def count_view(self, view):
+        book_id, title, cover_url, first_view, score = view
+        self._merge(book_id, [1, 1 if first_view else 0, score, title, cover_url])
+
+    def _merge(self, book_id, counts):
+        with self._pending_lock:
+            pending = self._pending.get(book_id)
+            if pending is None:
+                self._pending[book_id] = counts
+                return
+            pending[0] += counts[0]
+            pending[1] += counts[1]
+            high, low = max(pending[2], counts[2]), min(pending[2], counts[2])
+            pending[2] = high + math.log1p(math.exp(low - high))
+            pending[3] = counts[3] or pending[3]
+            pending[4] = counts[4] or pending[4]
+
+    def flush(self):
+        # One upsert per book per interval, in book_id order so concurrent workers lock rows alike.
+        # Counts that fail to write go back into the buffer for the next flush.
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        conn = self.write_db()
+        cur = conn.cursor()
+        try:
+            for book_id in sorted(pending):
+                views, viewers, score, title, cover_url = pending[book_id]
+                cur.execute(FLUSH_SQL, (book_id, title, cover_url, views, viewers, score))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            for book_id, counts in pending.items():
+                self._merge(book_id, counts)
+            raise
+        finally:
+            cur.close()
+            conn.close()
+        return len(pending)
+
+    def _flush_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Trending flush error: {e}")
+
+    def start_flusher(self, interval):
+        thread = threading.Thread(target=self._flush_loop, args=(interval,), name='trending-flush', daemon=True)
+        thread.start()
+        logger.info(f"Trending flusher started (every {interval}s)")
+        return thread
+
+    def top(self, page=1, per_page=20):
+        key = ('top', page, per_page)
+        cached = self._cache.get(key)
+        if cached is not None:
+            metrics.CACHE_LOOKUPS.inc('trending', 'hit')
+            return cached
+        metrics.CACHE_LOOKUPS.inc('trending', 'miss')
+        conn = self.get_db()
+        cur = conn.cursor()
+        try:
+            cur.execute(TOP_SQL, (per_page, (page - 1) * per_page))
+            items = [{
+                "bookId": row['book_id'],
+                "bookName": row['title'],
+                "coverWap": row['cover_url'],
+                "views": row['views'],
+                "viewers": row['viewers'],
+            } for row in cur.fetchall()]
+        finally:
+            cur.close()
+            conn.close()
+        self._cache.set(key, items, 256 * len(items) + 64)
+        return items
+
+    def viewers(self, book_ids):
+        counts = {}
+        missing = []
+        for book_id in book_ids:
+            cached = self._cache.get(('viewers', book_id))
+            if cached is None:
+                missing.append(book_id)
+            else:
+                counts[book_id] = cached
+        metrics.CACHE_LOOKUPS.inc('viewers', 'hit', amount=len(book_ids) - len(missing))
+        if missing:
+            metrics.CACHE_LOOKUPS.inc('viewers', 'miss', amount=len(missing))
+            conn = self.get_db()
+            cur = conn.cursor()
+            try:
+                cur.execute(VIEWERS_SQL, (missing,))
+                found = {row['book_id']: row['viewers'] for row in cur.fetchall()}
+            finally:
+                cur.close()
+                conn.close()
+            for book_id in missing:
+                counts[book_id] = found.get(book_id, 0)
+                self._cache.set(('viewers', book_id), counts[book_id], 64)
+        return counts
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def chat_key(update):
+    # Chat the update belongs to (falls back to the sender for inline queries), None if neither
+    for kind, payload in update.items():
+        if kind == 'update_id' or not isinstance(payload, dict):
+            continue
+        for holder in (payload, payload.get('message')):
+            if isinstance(holder, dict) and isinstance(holder.get('chat'), dict):
+                return holder['chat'].get('id')
+        sender = payload.get('from')
+        if isinstance(sender, dict):
+            return sender.get('id')
+    return None
+
+
+# Runs webhook updates on the bot loop: concurrently across chats, in arrival order within a chat
+class UpdateDispatcher:
+    def __init__(self, loop, handle, concurrency=32, max_pending=1000, seen_size=10000):
+        self.loop = loop
+        self.handle = handle
+        self.max_pending = max_pending
+        self.seen_size = seen_size
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._closing = False
+        self._seen = OrderedDict()
+        self._pending = 0
+        # Chat -> last scheduled task; a new update for the chat waits on it before running
+        self._tails = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def submit(self, update_id, chat_id, update):
+        with self._lock:
+            if update_id is not None:
+                if update_id in self._seen:
+                    metrics.TELEGRAM_UPDATES.inc('duplicate')
+                    return 'duplicate'
+            if self._closing or self._pending >= self.max_pending:
+                metrics.TELEGRAM_UPDATES.inc('rejected')
+                return 'busy'
+            if update_id is not None:
+                self._seen[update_id] = True
+                if len(self._seen) > self.seen_size:
+                    self._seen.popitem(last=False)
+            self._pending += 1
+        metrics.WEBHOOK_QUEUE_DEPTH.inc()
+        metrics.TELEGRAM_UPDATES.inc('accepted')
+        self.loop.call_soon_threadsafe(self._schedule, update_id, chat_id, update)
+        return 'accepted'
+
+    def drain(self, timeout):
+        # Refuse new updates (Telegram redelivers them elsewhere) and wait for accepted ones to finish.
+        # Returns how many were still unprocessed when the timeout ran out.
+        with self._lock:
+            self._closing = True
+            self._idle.wait_for(lambda: not self._pending, timeout)
+            return self._pending
+
+    def _schedule(self, update_id, chat_id, update):
+        previous = self._tails.get(chat_id) if chat_id is not None else None
+        task = self.loop.create_task(self._run(update_id, chat_id, update, previous))
+        if chat_id is not None:
+            self._tails[chat_id] = task
+
+    async def _run(self, update_id, chat_id, update, previous):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            async with self._semaphore:
+                await self.handle(update)
+        except Exception as e:
+            metrics.TELEGRAM_UPDATES.inc('error')
+            logger.error(f"Update {update_id} failed: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.notify_all()
+            metrics.WEBHOOK_QUEUE_DEPTH.dec()
+            if chat_id is not None and self._tails.get(chat_id) is asyncio.current_task():
+                del self._tails[chat_id]
@@ -1,14 +1,15 @@
 import os
 import threading
 import logging
-import time
 
-logging.basicConfig(level=logging.INFO)
+import logs
+
+logs.configure()
 logger = logging.getLogger(__name__)
 
 os.environ['REPLIT_DEPLOYMENT'] = '1'
 
-from app import app, init_db, _start_bot_with_retry
+from app import app, init_db, start_membership_sweeper, start_history_maintenance, start_recommendation_builder, start_trending_flusher, resume_broadcasts, home_snapshot, _start_bot_with_retry
 
 _init_lock = threading.Lock()
 _initialized = False
@@ -26,15 +27,21 @@ def _background_init():
     except Exception as e:
         logger.error(f"Database init error: {e}")
 
+    start_membership_sweeper()
+    start_history_maintenance()
+    start_recommendation_builder()
+    start_trending_flusher()
+    resume_broadcasts()
+    home_snapshot()
+
     if not os.environ.get('WEBAPP_URL'):
         domains = os.environ.get('REPLIT_DOMAINS', '')
         if domains:
             os.environ['WEBAPP_URL'] = f"https://{domains.split(',')[0]}"
             logger.info(f"Set WEBAPP_URL to {os.environ['WEBAPP_URL']}")
 
-    time.sleep(3)
     logger.info("Starting bot in WEBHOOK mode for production...")
-    _start_bot_with_retry(0, use_webhook=True)
+    _start_bot_with_retry(use_webhook=True)
 
 bg_thread = threading.Thread(target=_background_init, daemon=True)
 bg_thread.start()